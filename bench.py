@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the poll -> diff -> cache -> broadcast pipeline, run against
+local stand-ins so no network connection is needed.
+
+	python3 bench.py --output results.json
+	python3 bench.py --compare results.json
+
+Results are written as JSON. With --compare, any benchmark that is more
+than --threshold slower than in the given results is reported and the exit
+status is 1.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import client
+import streams
+from broadcasters import Broadcaster, BroadcastQueue, DiscordWebhookBroadcaster, IrcBroadcaster
+from client import StreamCache
+from fakehelix import FakeHelixServer, FakeTwitch
+from server import ListenServer
+from storage import SqliteStreamCache
+
+
+log = logging.getLogger("bench")
+
+
+
+class Workload(object):
+	"""
+	Synthetic streams for a number of games. churn() replaces a fraction of
+	the streams, half with new users and half with the same user starting a
+	new stream.
+	"""
+	def __init__(self, streams, games, seed=0):
+		self._random = random.Random(seed)
+		self._next_id = 0
+		self.games = ["Game {0}".format(i) for i in range(games)]
+
+		per_game = max(streams // games, 1)
+		self.streams = {
+			game: [self._new_stream(game) for _ in range(per_game)]
+			for game in self.games
+		}
+
+	def _new_id(self):
+		self._next_id += 1
+		return str(self._next_id)
+
+	def _new_stream(self, game, user_id=None):
+		if user_id is None:
+			user_id = self._new_id()
+
+		return {
+			"id": self._new_id(),
+			"user_id": user_id,
+			"user_login": "user{0}".format(user_id),
+			"user_name": "User{0}".format(user_id),
+			"game_id": game,
+			"game_name": game,
+			"type": "live",
+			"title": "Playing {0}".format(game),
+			"viewer_count": self._random.randint(0, 10000),
+			"started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - self._random.randint(0, 20 * 3600))),
+			"language": "en",
+			"thumbnail_url": "https://static-cdn.jtvnw.net/previews-ttv/live_user_user{0}-{{width}}x{{height}}.jpg".format(user_id),
+			"tag_ids": [],
+		}
+
+	def churn(self, fraction):
+		for game, game_streams in self.streams.items():
+			count = int(round(len(game_streams) * fraction))
+
+			for i in self._random.sample(range(len(game_streams)), count):
+				user_id = game_streams[i]["user_id"] if self._random.random() < 0.5 else None
+				game_streams[i] = self._new_stream(game, user_id)
+
+	def all_streams(self):
+		return [stream for game_streams in self.streams.values() for stream in game_streams]
+
+
+
+def measure(func, repeat):
+	"""
+	Runs func repeat times and returns the run times in seconds
+	"""
+	runs = []
+
+	for _ in range(repeat):
+		started = time.perf_counter()
+		func()
+		runs.append(time.perf_counter() - started)
+
+	return runs
+
+
+
+def result(name, params, runs, **extra):
+	r = {
+		"name": name,
+		"params": params,
+		"runs": runs,
+		"min": min(runs),
+		"median": statistics.median(runs),
+	}
+	r.update(extra)
+
+	log.info("{0} {1}: median {2:.6f}s".format(name, params, r["median"]))
+
+	return r
+
+
+
+def bench_diff(sizes, churn, repeat):
+	"""
+	StreamCache.update() and expire() for one poll of every game, as done by
+	streams.update_game()
+	"""
+	results = []
+
+	for stream_count, game_count in sizes:
+		workload = Workload(stream_count, game_count)
+		cfg = {"max_age": 8}
+		stream_cache = {}
+		trackers = {}
+
+		# Fill the trackers with the first poll
+		for game, game_streams in workload.streams.items():
+			streams.update_game(cfg, game, game_streams, stream_cache, trackers, time.time())
+
+		def poll():
+			now = time.time()
+			for game, game_streams in workload.streams.items():
+				streams.update_game(cfg, game, game_streams, stream_cache, trackers, now)
+
+		runs = []
+		for _ in range(repeat):
+			workload.churn(churn)
+			runs += measure(poll, 1)
+
+		results.append(result("diff", {"streams": stream_count, "games": game_count, "churn": churn}, runs))
+
+	return results
+
+
+
+def bench_cache(sizes, churn, repeat):
+	"""
+	Loading and saving the JSON and SQLite stream caches
+	"""
+	results = []
+
+	for stream_count, game_count in sizes:
+		workload = Workload(stream_count, game_count)
+		params = {"streams": stream_count, "games": game_count, "churn": churn}
+
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			json_file = os.path.join(tmp_dir, "streams.json")
+			stream_cache = {
+				game: StreamCache(game, 8, game_streams).to_streams()
+				for game, game_streams in workload.streams.items()
+			}
+
+			results.append(result("cache-json-save", params,
+			                      measure(lambda: streams.save_stream_cache(json_file, stream_cache), repeat)))
+			results.append(result("cache-json-load", params,
+			                      measure(lambda: streams.read_stream_cache(json_file), repeat)))
+
+			db = SqliteStreamCache(os.path.join(tmp_dir, "streams.db"))
+			trackers = {
+				game: StreamCache(game, 8, game_streams)
+				for game, game_streams in workload.streams.items()
+			}
+
+			def save_all():
+				for game, tracker in trackers.items():
+					db[game] = tracker.to_streams()
+
+			results.append(result("cache-sqlite-import", params, measure(save_all, 1)))
+
+			runs = []
+			for _ in range(repeat):
+				workload.churn(churn)
+				for game, tracker in trackers.items():
+					tracker.update(workload.streams[game])
+				runs += measure(save_all, 1)
+
+			results.append(result("cache-sqlite-update", params, runs))
+			results.append(result("cache-sqlite-load", params,
+			                      measure(lambda: [db.get(game) for game in workload.games], repeat)))
+			db.close()
+
+	return results
+
+
+
+def bench_poll(sizes, churn, repeat):
+	"""
+	A full streams.check_games() poll against fakehelix.py
+	"""
+	results = []
+
+	for stream_count, game_count in sizes:
+		twitch = FakeTwitch(games=game_count,
+		                    streams=max(stream_count // game_count, 1),
+		                    churn=churn,
+		                    churn_interval=3600,
+		                    rate_limit=1000000)
+		server = FakeHelixServer(("127.0.0.1", 0), twitch)
+		server.start()
+
+		cfg = dict(server.config(), max_age=8)
+		games = [game["name"] for game in twitch.games]
+		stream_cache = {}
+		trackers = {}
+
+		token_manager = client.get_token_manager(cfg)
+		streams.check_games(cfg, games, stream_cache, token_manager=token_manager, trackers=trackers)
+
+		def poll():
+			# Churn before every poll without waiting for the churn interval
+			twitch._last_churn -= twitch.churn_interval
+			streams.check_games(cfg, games, stream_cache, token_manager=token_manager, trackers=trackers)
+
+		results.append(result("poll", {"streams": stream_count, "games": game_count, "churn": churn},
+		                      measure(poll, repeat)))
+
+		server.shutdown()
+		server.server_close()
+
+	return results
+
+
+
+class CountingBroadcaster(Broadcaster):
+	def __init__(self):
+		self.count = 0
+		self.done = None
+		self.expected = 0
+
+	async def broadcast(self, streams):
+		self.count += len(streams)
+
+		if self.count >= self.expected:
+			self.done.set()
+
+
+
+class EventLoopThread(object):
+	"""
+	Runs an asyncio event loop in a background thread
+	"""
+	def __init__(self):
+		self.loop = asyncio.new_event_loop()
+		self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+		self._thread.start()
+
+	def run(self, coro, timeout=300):
+		return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+	def stop(self):
+		async def cancel_tasks():
+			tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+
+		self.run(cancel_tasks())
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self._thread.join()
+		self.loop.close()
+
+
+
+def bench_socket(batch_sizes, batches, repeat):
+	"""
+	Sending batches of streams over one BroadcasterConnection to a
+	ListenServer with a queued broadcaster
+	"""
+	results = []
+	workload = Workload(max(batch_sizes), 1)
+	all_streams = workload.all_streams()
+
+	for batch_size in batch_sizes:
+		loop_thread = EventLoopThread()
+		counter = CountingBroadcaster()
+
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			socket_path = os.path.join(tmp_dir, "bench.sock")
+			listen_server = ListenServer(socket_path, [BroadcastQueue(counter, maxsize=batches)])
+
+			async def start():
+				counter.done = asyncio.Event()
+				for broadcaster in listen_server.broadcasters:
+					await broadcaster.start()
+				await listen_server.start()
+
+			loop_thread.run(start())
+
+			def send():
+				counter.count = 0
+				counter.expected = batch_size * batches
+				loop_thread.loop.call_soon_threadsafe(counter.done.clear)
+
+				connection = streams.BroadcasterConnection(socket_path)
+				for _ in range(batches):
+					connection.send(all_streams[:batch_size])
+				connection.close()
+
+				loop_thread.run(counter.done.wait())
+
+			results.append(result("socket", {"batch_size": batch_size, "batches": batches},
+			                      measure(send, repeat)))
+
+			loop_thread.run(listen_server.close())
+			for broadcaster in listen_server.broadcasters:
+				loop_thread.run(broadcaster.close())
+
+		loop_thread.stop()
+
+	return results
+
+
+
+async def _irc_stand_in(reader, writer, received):
+	"""
+	Answers registration and counts PRIVMSG lines
+	"""
+	try:
+		while True:
+			line = await reader.readline()
+
+			if not line:
+				break
+
+			if line.startswith(b"USER "):
+				writer.write(b":bench 376 bench :End of /MOTD command\r\n")
+				await writer.drain()
+			elif line.startswith(b"PRIVMSG "):
+				received["lines"] += 1
+				if received["lines"] >= received["expected"]:
+					received["done"].set()
+	except asyncio.CancelledError:
+		# The benchmark is over
+		pass
+	finally:
+		writer.close()
+
+
+
+def bench_irc(batch_sizes, repeat):
+	"""
+	IrcBroadcaster.broadcast() to a local IRC stand-in, without flood control
+	"""
+	results = []
+	workload = Workload(max(batch_sizes), 1)
+	all_streams = workload.all_streams()
+
+	for coalesce in (False, True):
+		for batch_size in batch_sizes:
+			loop_thread = EventLoopThread()
+			received = {"lines": 0, "expected": 0, "done": None}
+
+			async def start():
+				received["done"] = asyncio.Event()
+				server = await asyncio.start_server(lambda r, w: _irc_stand_in(r, w, received), "127.0.0.1", 0)
+				port = server.sockets[0].getsockname()[1]
+
+				irc = IrcBroadcaster("127.0.0.1", "#bench", "bench", port=port,
+				                     rate=1000000, burst=1000000, coalesce=coalesce, outbox_size=batch_size)
+				await irc.start()
+				return server, irc
+
+			server, irc = loop_thread.run(start())
+			expected = len(irc.format_messages(all_streams[:batch_size]))
+
+			async def broadcast():
+				received["lines"] = 0
+				received["expected"] = expected
+				received["done"].clear()
+				await irc.broadcast(all_streams[:batch_size])
+				await received["done"].wait()
+
+			results.append(result("irc", {"batch_size": batch_size, "coalesce": coalesce},
+			                      measure(lambda: loop_thread.run(broadcast()), repeat)))
+
+			async def stop():
+				await irc.close()
+				server.close()
+
+			loop_thread.run(stop())
+			loop_thread.stop()
+
+	return results
+
+
+
+class DiscordStandInHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		self.server.requests += 1
+
+		self.send_response(204)
+		self.send_header("X-RateLimit-Remaining", "1000")
+		self.send_header("X-RateLimit-Reset-After", "1")
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+
+
+def bench_discord(batch_sizes, repeat):
+	"""
+	DiscordWebhookBroadcaster.broadcast() to a local webhook stand-in
+	"""
+	try:
+		import requests
+	except ImportError:
+		log.warning("requests is not installed, skipping the Discord benchmark")
+		return []
+
+	results = []
+	workload = Workload(max(batch_sizes), 1)
+	all_streams = workload.all_streams()
+
+	server = ThreadingHTTPServer(("127.0.0.1", 0), DiscordStandInHandler)
+	server.daemon_threads = True
+	server.requests = 0
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	loop_thread = EventLoopThread()
+	discord = DiscordWebhookBroadcaster("http://127.0.0.1:{0}/webhook".format(server.server_address[1]))
+	loop_thread.run(discord.start())
+
+	for batch_size in batch_sizes:
+		server.requests = 0
+		runs = measure(lambda: loop_thread.run(discord.broadcast(all_streams[:batch_size])), repeat)
+		results.append(result("discord", {"batch_size": batch_size}, runs,
+		                      requests_per_broadcast=server.requests / repeat))
+
+	loop_thread.run(discord.close())
+	loop_thread.stop()
+	server.shutdown()
+	server.server_close()
+
+	return results
+
+
+
+def compare(results, baseline, threshold):
+	"""
+	Returns the benchmarks whose median is more than threshold slower than
+	in baseline
+	"""
+	def key(r):
+		return (r["name"], json.dumps(r["params"], sort_keys=True))
+
+	baseline_by_key = {key(r): r for r in baseline["results"]}
+	regressions = []
+
+	for r in results["results"]:
+		old = baseline_by_key.get(key(r))
+
+		if old is None or old["median"] == 0:
+			continue
+
+		change = r["median"] / old["median"] - 1
+
+		if change > threshold:
+			regressions.append({
+				"name": r["name"],
+				"params": r["params"],
+				"baseline": old["median"],
+				"median": r["median"],
+				"change": change,
+			})
+
+	return regressions
+
+
+
+BENCHMARKS = ["diff", "cache", "poll", "socket", "irc", "discord"]
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmarks for twitchwatch")
+	parser.add_argument("benchmarks",
+	                    nargs="*",
+	                    default=BENCHMARKS,
+	                    help="Benchmarks to run: {0}. Default: all".format(", ".join(BENCHMARKS)))
+	parser.add_argument("--sizes",
+	                    default="10:1,1000:10,10000:50,100000:500",
+	                    help="Comma separated list of streams:games workloads. Default: 10:1,1000:10,10000:50,100000:500")
+	parser.add_argument("--poll-sizes",
+	                    default="100:1,1000:10,10000:100",
+	                    help="Workloads for the poll benchmark, which goes through HTTP. Default: 100:1,1000:10,10000:100")
+	parser.add_argument("--batch-sizes",
+	                    default="1,10,100",
+	                    help="Comma separated list of broadcast batch sizes. Default: 1,10,100")
+	parser.add_argument("--churn",
+	                    type=float,
+	                    default=0.05,
+	                    help="Fraction of streams replaced between polls. Default: 0.05")
+	parser.add_argument("--repeat",
+	                    type=int,
+	                    default=5,
+	                    help="Number of times to run each benchmark. Default: 5")
+	parser.add_argument("--output",
+	                    help="File to write the results to. Default: stdout")
+	parser.add_argument("--compare",
+	                    help="Results file to compare against")
+	parser.add_argument("--threshold",
+	                    type=float,
+	                    default=0.2,
+	                    help="Slowdown, as a fraction, that counts as a regression. Default: 0.2")
+	parser.add_argument("--log-level",
+	                    default="info",
+	                    help="Logging level, e.g., debug, info, warning, error, critical. Default: info")
+	args = parser.parse_args()
+
+	# streams.py logs everything at DEBUG by default
+	logging.getLogger().setLevel(logging.WARNING)
+	log.setLevel(getattr(logging, args.log_level.upper()))
+
+	def parse_sizes(s):
+		return [tuple(int(n) for n in size.split(":")) for size in s.split(",")]
+
+	sizes = parse_sizes(args.sizes)
+	poll_sizes = parse_sizes(args.poll_sizes)
+	batch_sizes = [int(n) for n in args.batch_sizes.split(",")]
+
+	results = []
+
+	with tempfile.TemporaryDirectory() as cache_home:
+		# Keep tokens and game ids for fakehelix.py out of the real cache
+		client.XDG_CACHE_HOME = cache_home
+
+		for name in args.benchmarks:
+			if name == "diff":
+				results += bench_diff(sizes, args.churn, args.repeat)
+			elif name == "cache":
+				results += bench_cache(sizes, args.churn, args.repeat)
+			elif name == "poll":
+				results += bench_poll(poll_sizes, args.churn, args.repeat)
+			elif name == "socket":
+				results += bench_socket(batch_sizes, 100, args.repeat)
+			elif name == "irc":
+				results += bench_irc(batch_sizes, args.repeat)
+			elif name == "discord":
+				results += bench_discord(batch_sizes, args.repeat)
+			else:
+				parser.error("Unknown benchmark {0}".format(name))
+
+	output = {
+		"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"results": results,
+	}
+
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(output, f, indent=2)
+	else:
+		print(json.dumps(output, indent=2))
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+
+		regressions = compare(output, baseline, args.threshold)
+
+		for r in regressions:
+			log.error("{0} {1} is {2:.0%} slower: {3:.6f}s -> {4:.6f}s".format(r["name"], r["params"], r["change"], r["baseline"], r["median"]))
+
+		if regressions:
+			raise SystemExit(1)
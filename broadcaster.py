@@ -1,20 +1,295 @@
 #!/usr/bin/env python3
 
+import time
+# For --profile, the time spent importing everything below
+_import_started = (time.perf_counter(), time.process_time())
+
 import argparse
-import asyncore
+import asyncio
+import json
 import logging
+import signal
+import sys
+import tempfile
 from logging.handlers import WatchedFileHandler
-import os
 
 from server import ListenServer
-from broadcasters import IrcBroadcaster, DbusBroadcaster, DiscordWebhookBroadcaster
+from broadcasters import BroadcastQueue, IrcBroadcaster, DbusBroadcaster, DiscordWebhookBroadcaster
+from streams import StreamChecker
+from filters import StreamFilter
 import config
+import metrics
+import profiling
 
 
 LOG_FORMAT = "%(asctime)s — %(name)s — %(levelname)s — %(message)s"
 logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
 log = logging.getLogger()
 
+IMPORT_TIME = (time.perf_counter() - _import_started[0], time.process_time() - _import_started[1])
+
+
+
+def make_stream_filter(cfg):
+	"""
+	Compiles the config's "filter", which every stream has to match before
+	it reaches the broadcasters. The top-level "blacklist" is added to it.
+	"""
+	return StreamFilter.from_config(cfg.get("filter"), blacklist=cfg.get("blacklist"))
+
+
+
+def make_broadcaster(bc, global_filter=None):
+	"""
+	Creates the broadcaster for one entry in the config's "broadcasters"
+	list, wrapped in its own BroadcastQueue. Returns None if it can't be
+	created.
+
+	global_filter returns the current global filter, for IRC commands.
+	"""
+	new_broadcaster = None
+
+	# The broadcaster's own "filter", plus its "games" list
+	try:
+		stream_filter = StreamFilter.from_config(bc.get("filter"),
+		                                         name=bc.get("name") or bc['type'],
+		                                         games=bc.get("games"))
+	except Exception as e:
+		log.error("Could not compile the filter for {0}".format(bc.get("name") or bc['type']))
+		log.exception(e)
+		return None
+
+	if bc['type'] == "irc":
+		try:
+			new_broadcaster = IrcBroadcaster(network=bc["network"],
+			                                 port=bc.get("port", 6667),
+			                                 room=bc["room"],
+			                                 nick=bc["nick"],
+			                                 stream_filter=stream_filter,
+			                                 global_filter=global_filter,
+			                                 rate=bc.get("rate", 0.5),
+			                                 burst=bc.get("burst", 4),
+			                                 coalesce=bc.get("coalesce", False),
+			                                 cmd_limit=bc.get("cmd-limit", 30),
+			                                 cmd_cache_ttl=bc.get("cmd-cache-ttl", 60),
+			                                 outbox_size=bc.get("outbox-size", 100))
+		except Exception as e:
+			log.error("Could not create IrcBroadcaster")
+			log.exception(e)
+	elif bc['type'] == "dbus":
+		try:
+			new_broadcaster = DbusBroadcaster(coalesce_window=bc.get("coalesce-window", 2),
+			                                  replace_window=bc.get("replace-window", 60),
+			                                  max_listed=bc.get("max-listed", 5))
+		except Exception as e:
+			log.error("Could not create DbusBroadcaster")
+			log.exception(e)
+	elif bc['type'] == "discord":
+		try:
+			new_broadcaster = DiscordWebhookBroadcaster(webhook_url=bc['webhook-url'])
+		except Exception as e:
+			log.error("Could not create DiscordWebhookBroadcaster")
+			log.exception(e)
+
+	if new_broadcaster is None:
+		return None
+
+	# Each broadcaster gets its own queue so a slow one can't hold up the others
+	try:
+		return BroadcastQueue(new_broadcaster,
+		                      maxsize=bc.get("queue-size", 100),
+		                      overflow=bc.get("overflow", "block"),
+		                      name=bc.get("name"),
+		                      stream_filter=None if stream_filter.empty else stream_filter)
+	except Exception as e:
+		log.error("Could not create BroadcastQueue")
+		log.exception(e)
+		return None
+
+
+
+def broadcaster_settings(bc):
+	"""
+	Returns everything a broadcaster is built from, as a string to compare
+	between configs. The global filter isn't part of it, as it is read
+	from the ListenServer when needed.
+	"""
+	return json.dumps({"broadcaster": bc}, sort_keys=True)
+
+
+
+class BroadcasterSet(object):
+	"""
+	The running broadcasters. update() brings them in line with a config,
+	starting new broadcasters and closing removed ones, and leaves any whose
+	settings haven't changed running, e.g., without dropping an IRC
+	connection.
+
+	queues is updated in place, so it can be shared with the ListenServer.
+	global_filter returns the current global filter, for IRC commands.
+	"""
+	def __init__(self, global_filter=None):
+		self.global_filter = global_filter
+		self.queues = []
+		self._settings = []
+		self._lock = asyncio.Lock()
+
+	async def update(self, cfg):
+		async with self._lock:
+			running = list(zip(self._settings, self.queues))
+			settings = []
+			queues = []
+
+			for bc in cfg.get("broadcasters", []):
+				key = broadcaster_settings(bc)
+				match = next((i for i, (running_key, queue) in enumerate(running) if running_key == key), None)
+
+				if match is not None:
+					settings.append(key)
+					queues.append(running.pop(match)[1])
+					continue
+
+				queue = make_broadcaster(bc, self.global_filter)
+				if queue is None:
+					continue
+
+				try:
+					await queue.start()
+				except Exception as e:
+					log.error("Could not start {0!r}".format(queue))
+					log.exception(e)
+					continue
+
+				log.info("Started {0!r}".format(queue))
+				settings.append(key)
+				queues.append(queue)
+
+			for key, queue in running:
+				log.info("Closing {0!r}".format(queue))
+				await self._close_queue(queue)
+
+			self._settings = settings
+			self.queues[:] = queues
+
+	async def _close_queue(self, queue):
+		try:
+			await queue.close()
+		except Exception as e:
+			log.exception(e)
+
+	async def close(self):
+		async with self._lock:
+			for queue in self.queues:
+				await self._close_queue(queue)
+
+			self._settings = []
+			self.queues[:] = []
+
+
+
+async def reload(broadcaster_set, checker, server):
+	"""
+	Reads the config file again and updates the filter and the broadcasters
+	that changed
+	"""
+	log.info("Reloading the config")
+
+	try:
+		cfg = config.reload_config()
+	except Exception:
+		log.error("Could not reload the config, keeping the old one")
+		return
+
+	try:
+		stream_filter = make_stream_filter(cfg)
+	except Exception as e:
+		log.error("Could not compile the new filter, keeping the old one")
+		log.exception(e)
+	else:
+		server.stream_filter = stream_filter
+
+	await broadcaster_set.update(cfg)
+
+	# Waits for any thin-client check to finish, which can take a while if
+	# it is rate limited
+	await asyncio.to_thread(checker.update_config, cfg)
+
+
+
+async def watch_config(broadcaster_set, checker, server, interval):
+	"""
+	Reloads the config whenever the config file's mtime changes
+	"""
+	while True:
+		await asyncio.sleep(interval)
+
+		if config.config_changed():
+			try:
+				await reload(broadcaster_set, checker, server)
+			except Exception as e:
+				log.error("Could not update the broadcasters")
+				log.exception(e)
+
+
+
+async def run(cfg):
+	"""
+	Starts the broadcasters and the listen server and runs until cancelled.
+
+	kill -USR1 starts and stops a cProfile session, written to profile-dir.
+	kill -HUP reloads the config, as does changing the config file.
+	"""
+	loop = asyncio.get_running_loop()
+
+	profiling.install_signal_handler(cfg.get("profile-dir") or tempfile.gettempdir(),
+	                                 "twitchwatch-broadcaster",
+	                                 loop=loop)
+
+	# IRC commands use the server's filter, which reloads replace
+	broadcaster_set = BroadcasterSet(global_filter=lambda: server.stream_filter)
+
+	# Answers streams.py --thin-client checks
+	checker = StreamChecker(cfg)
+
+	# A bad filter is logged rather than stopping every broadcaster, and can
+	# be fixed with a reload
+	try:
+		stream_filter = make_stream_filter(cfg)
+	except Exception as e:
+		log.error("Could not compile the filter, broadcasting every stream until it's fixed")
+		log.exception(e)
+		stream_filter = None
+
+	# Create the broadcast server
+	server = ListenServer(cfg['socket'], broadcaster_set.queues, checker=checker, stream_filter=stream_filter)
+
+	# Held on to until done, so a reload isn't garbage collected partway
+	reload_tasks = set()
+
+	def reload_on_signal():
+		task = asyncio.create_task(reload(broadcaster_set, checker, server))
+		reload_tasks.add(task)
+		task.add_done_callback(reload_tasks.discard)
+
+	loop.add_signal_handler(signal.SIGHUP, reload_on_signal)
+	watcher = asyncio.create_task(watch_config(broadcaster_set, checker, server, cfg.get("config-check-interval", 10)))
+
+	try:
+		with profiling.phase("start"):
+			await broadcaster_set.update(cfg)
+
+		await server.start()
+		await server.serve_forever()
+	finally:
+		# Always clean up
+		watcher.cancel()
+
+		for task in reload_tasks:
+			task.cancel()
+
+		await server.close()
+		await broadcaster_set.close()
+
 
 
 if __name__ == "__main__":
@@ -29,8 +304,27 @@ if __name__ == "__main__":
 	parser.add_argument("--log-file",
 	                    default=None,
 	                    help="File to send logging output")
+	parser.add_argument("--metrics-port",
+	                    type=int,
+	                    help="Serve Prometheus metrics on this local port. Default: off")
+	parser.add_argument("--profile",
+	                    default=False,
+	                    action="store_true",
+	                    help="Print the wall and CPU time taken by each phase to stderr on exit")
+	parser.add_argument("--profile-output",
+	                    help="Profile the whole run with cProfile and write the stats to this file, for reading with pstats")
 	args = parser.parse_args()
 
+	profile = args.profile or args.profile_output is not None
+	profile_output = args.profile_output
+
+	if profile:
+		profiling.PROFILER.enabled = True
+		profiling.PROFILER.record("import", *IMPORT_TIME)
+
+	if profile_output:
+		profiling.PROFILER.start_cprofile()
+
 	log.setLevel({
 		'debug': logging.DEBUG,
 		'info': logging.INFO,
@@ -44,51 +338,19 @@ if __name__ == "__main__":
 		log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
 		log.addHandler(log_handler)
 
-	cfg = config.get_config(args)
-
-	broadcasters = []
-
-	for bc in cfg.get("broadcasters", []):
-		new_broadcaster = None
-
-		if bc['type'] == "irc":
-			try:
-				new_broadcaster = IrcBroadcaster(network=bc["network"],
-				                                 port=bc.get("port", 6667),
-				                                 room=bc["room"],
-				                                 nick=bc["nick"],
-				                                 games=bc.get("games", []),
-				                                 blacklist=cfg.get("blacklist", []))
-			except Exception as e:
-				log.error("Could not create IrcBroadcaster")
-				log.exception(e)
-		elif bc['type'] == "dbus":
-			try:
-				new_broadcaster = DbusBroadcaster()
-			except Exception as e:
-				log.error("Could not create DbusBroadcaster")
-				log.exception(e)
-		elif bc['type'] == "discord":
-			try:
-				new_broadcaster = DiscordWebhookBroadcaster(webhook_url=bc['webhook-url'])
-			except Exception as e:
-				log.error("Could not create DiscordWebhookBroadcaster")
-				log.exception(e)
-
-		if new_broadcaster:
-			broadcasters.append(new_broadcaster)
-
-	# Get the path to the UNIX socket file for the listen server
-	socket_file_path = cfg['socket']
+	with profiling.phase("config"):
+		cfg = config.get_config(args)
 
-	# Create the broadcast server
-	ListenServer(socket_file_path, broadcasters)
+	if cfg.get("metrics-port"):
+		metrics.start_metrics_server(int(cfg["metrics-port"]), cfg.get("metrics-host", "127.0.0.1"))
 
 	try:
-		asyncore.loop()
+		asyncio.run(run(cfg))
 	except KeyboardInterrupt:
 		pass
 	finally:
-		# Always clean up
-		if os.path.exists(socket_file_path):
-			os.unlink(socket_file_path)
+		if profile_output:
+			profiling.PROFILER.stop_cprofile(profile_output)
+
+		if profile:
+			sys.stderr.write(profiling.PROFILER.report() + "\n")
@@ -1,168 +1,615 @@
-from datetime import datetime, timedelta
-import asyncore
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import logging
 import re
-from client import get_current_streams
+import time
+from client import chunks, get_current_streams
+from filters import FilterChain
+from helix import HelixError, HelixRateLimitError, HelixUnavailableError
+import metrics
+import profiling
+
+
+BROADCAST_SECONDS = metrics.histogram("twitchwatch_broadcast_seconds",
+                                      "Time taken by each broadcaster's broadcast() call",
+                                      ["broadcaster"])
+BROADCAST_ERRORS = metrics.counter("twitchwatch_broadcast_errors_total",
+                                   "broadcast() calls that raised an exception",
+                                   ["broadcaster"])
+QUEUE_DEPTH = metrics.gauge("twitchwatch_queue_depth",
+                            "Batches of streams waiting in each broadcaster's queue",
+                            ["broadcaster"])
+QUEUE_DROPPED = metrics.counter("twitchwatch_queue_dropped_total",
+                                "Batches of streams dropped because a broadcaster's queue was full",
+                                ["broadcaster"])
+QUEUE_LATENCY_SECONDS = metrics.histogram("twitchwatch_queue_latency_seconds",
+                                          "Time from a batch being queued until its broadcaster finished with it",
+                                          ["broadcaster"])
+DISCORD_RATELIMIT_REMAINING = metrics.gauge("twitchwatch_discord_ratelimit_remaining",
+                                            "Requests left in each Discord webhook's rate limit bucket",
+                                            ["webhook"])
+
+
+
+class Broadcaster(object):
+	"""
+	Base class for broadcasters. broadcast() is a coroutine, so anything that
+	blocks (HTTP requests, DBus calls) should be run in a thread with
+	asyncio.to_thread() to keep the event loop free for the other
+	broadcasters.
+	"""
+	async def start(self):
+		"""
+		Called once the event loop is running, e.g., to open connections
+		"""
+		pass
+
+	async def broadcast(self, streams):
+		raise NotImplementedError
+
+	async def close(self):
+		pass
+
+
+
+class BroadcastQueue(Broadcaster):
+	"""
+	Gives a broadcaster its own bounded queue and worker task so a slow or
+	failing sink doesn't hold up the others, or the listen server.
+
+	overflow decides what happens when the queue is full:
+	  block       - wait for space (default)
+	  drop-oldest - discard the oldest queued batch to make room
+	  drop-newest - discard the incoming batch
+	"""
+	OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+	def __init__(self, broadcaster, maxsize=100, overflow="block", name=None, stream_filter=None):
+		"""
+		name labels the queue's metrics, defaulting to the broadcaster's class
+
+		stream_filter is a filters.StreamFilter for the streams only this
+		broadcaster should leave out
+		"""
+		if overflow not in self.OVERFLOW_POLICIES:
+			raise ValueError("Unknown overflow policy {0}".format(overflow))
+
+		self.name = name or type(broadcaster).__name__
+		self.log = logging.getLogger("BroadcastQueue ({0})".format(self.name))
+
+		self.broadcaster = broadcaster
+		self.stream_filter = stream_filter
+		self._maxsize = maxsize
+		self._overflow = overflow
+		self._queue = None
+		self._worker = None
+
+		# Counters
+		self.processed = 0
+		self.dropped = 0
+		self.errors = 0
+		self.max_depth = 0
+		self.last_latency = 0.0
+		self.max_latency = 0.0
+		self.total_latency = 0.0
+
+	def __repr__(self):
+		return "<BroadcastQueue {0!r}>".format(self.broadcaster)
+
+	@property
+	def depth(self):
+		return self._queue.qsize() if self._queue is not None else 0
+
+	def stats(self):
+		"""
+		Returns a dict of the queue counters. Latencies are in seconds, from
+		the time a batch was queued until the broadcaster finished with it.
+		"""
+		return {
+			"depth": self.depth,
+			"max_depth": self.max_depth,
+			"processed": self.processed,
+			"dropped": self.dropped,
+			"errors": self.errors,
+			"last_latency": self.last_latency,
+			"max_latency": self.max_latency,
+			"total_latency": self.total_latency,
+		}
+
+	async def start(self):
+		self._queue = asyncio.Queue(self._maxsize)
+		await self.broadcaster.start()
+		self._worker = asyncio.create_task(self._work())
+
+	async def broadcast(self, streams):
+		if self.stream_filter is not None:
+			streams = self.stream_filter.filter(streams)
+
+			if not streams:
+				return
+
+		item = (asyncio.get_running_loop().time(), streams)
+
+		if self._queue.full():
+			if self._overflow == "drop-newest":
+				self.log.warning("Queue full, dropping {0} streams".format(len(streams)))
+				self.dropped += 1
+				QUEUE_DROPPED.inc(broadcaster=self.name)
+				return
+			elif self._overflow == "drop-oldest":
+				queued_at, old_streams = self._queue.get_nowait()
+				self._queue.task_done()
+				self.log.warning("Queue full, dropping {0} older streams".format(len(old_streams)))
+				self.dropped += 1
+				QUEUE_DROPPED.inc(broadcaster=self.name)
+
+		await self._queue.put(item)
+		self.max_depth = max(self.max_depth, self._queue.qsize())
+		QUEUE_DEPTH.set(self._queue.qsize(), broadcaster=self.name)
+
+	async def _work(self):
+		loop = asyncio.get_running_loop()
+
+		while True:
+			queued_at, streams = await self._queue.get()
+			started = loop.time()
+
+			try:
+				with profiling.phase("broadcast:{0}".format(self.name)):
+					await self.broadcaster.broadcast(streams)
+			except Exception as e:
+				self.errors += 1
+				BROADCAST_ERRORS.inc(broadcaster=self.name)
+				self.log.exception(e)
+			finally:
+				self._queue.task_done()
+
+			finished = loop.time()
+			BROADCAST_SECONDS.observe(finished - started, broadcaster=self.name)
+			QUEUE_LATENCY_SECONDS.observe(finished - queued_at, broadcaster=self.name)
+			QUEUE_DEPTH.set(self._queue.qsize(), broadcaster=self.name)
 
+			latency = finished - queued_at
+			self.processed += 1
+			self.last_latency = latency
+			self.max_latency = max(self.max_latency, latency)
+			self.total_latency += latency
 
+	async def close(self):
+		if self._worker is not None:
+			self._worker.cancel()
+			self._worker = None
 
-class IrcBroadcaster(asyncore.dispatcher):
-	def __init__(self, network, room, nick, games=[], blacklist=[], port=6667, cmd_limit=30):
+		await self.broadcaster.close()
+
+
+
+class TokenBucket(object):
+	"""
+	Allows rate actions per second on average, with bursts of up to burst
+	actions at once
+	"""
+	def __init__(self, rate, burst=1):
+		self.rate = rate
+		self.burst = burst
+		self._tokens = burst
+		self._updated = time.monotonic()
+
+	def _refill(self):
+		now = time.monotonic()
+		self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	async def acquire(self):
 		"""
-		cmd_limit is the minimum amount of time, in seconds, between IRC command requests
+		Waits until a token is available and takes it
 		"""
-		import socket
+		self._refill()
+
+		while self._tokens < 1:
+			await asyncio.sleep((1 - self._tokens) / self.rate)
+			self._refill()
 
+		self._tokens -= 1
+
+
+
+class IrcBroadcaster(Broadcaster):
+	# The maximum length of an IRC line in bytes, including the trailing CR-LF
+	MAX_LINE_LENGTH = 512
+
+	def __init__(self, network, room, nick, stream_filter=None, port=6667, cmd_limit=30,
+	             rate=0.5, burst=4, coalesce=False, cmd_cache_ttl=60, cmd_workers=2, outbox_size=100,
+	             global_filter=None):
+		"""
+		stream_filter is a filters.StreamFilter for the streams listed in
+		answers to commands, along with the filter global_filter returns,
+		e.g., the ListenServer's, so a reloaded filter is used straight away.
+		Broadcasts are filtered before they get here.
+
+		cmd_limit is the minimum amount of time, in seconds, before a user can
+		ask about the same game again
+
+		Command lookups run in a pool of cmd_workers threads and the results
+		are cached for cmd_cache_ttl seconds per game.
+
+		Messages to the room are queued and sent at no more than rate messages
+		per second, with bursts of up to burst messages, to avoid being kicked
+		for flooding. With coalesce several streams are sent on one line. At
+		most outbox_size messages are queued, dropping the oldest, and none
+		while disconnected.
+		"""
 		self.log = logging.getLogger("IrcBroadcaster")
 		self.log.debug("__init__()")
 
-		asyncore.dispatcher.__init__(self)
-
 		self._irc_network = network
 		self._irc_port = port
 		self._irc_room = room
 		self._irc_nick = nick
-		self._games = games
-		self._irc_registered = False
-		self._blacklist = blacklist
-		self._last_check = None
+		self._stream_filter = stream_filter
+		self._global_filter = global_filter
+		self._last_checks = {}
 		self._last_check_limit = cmd_limit
-		self._buffer = ''
-		self._states = []
-
-		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self._results = {}
+		self._results_ttl = cmd_cache_ttl
+		self._lookups = {}
+		self._command_tasks = set()
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=cmd_workers)
+
+		regex_string = r"\:(\S+)\!\S+ PRIVMSG {room} \:{nick}\: ([a-zA-Z0-9'-: ]+)"
+		self._command_regex = re.compile(regex_string.format(room=re.escape(room), nick=re.escape(nick)))
+
+		self._coalesce = coalesce
+		self._bucket = TokenBucket(rate, burst)
+		self._outbox = collections.deque(maxlen=outbox_size)
+		self._dropping = False
+		self._outbox_ready = None
+		self._joined = None
+		self._reader = None
+		self._writer = None
+		self._read_task = None
+		self._write_task = None
+
+	async def start(self):
+		self.log.debug("start()")
+
+		self._outbox_ready = asyncio.Event()
+		self._joined = asyncio.Event()
 
 		try:
-			self.connect((network, port))
+			self._reader, self._writer = await asyncio.open_connection(self._irc_network, self._irc_port)
 		except Exception as e:
-			self.log.error("Could not create IrcBroadcaster")
+			self.log.error("Could not connect to {0}:{1}".format(self._irc_network, self._irc_port))
 			self.log.error(e)
-			self.close()
+			return
+
+		self._dropping = False
+
+		self.log.info("Sending NICK details")
+		self.send("NICK {0}\r\n".format(self._irc_nick))
+		self.send("USER {0} {0} {0} :Python IRC\r\n".format(self._irc_nick))
+
+		self._read_task = asyncio.create_task(self._read_loop())
+		self._write_task = asyncio.create_task(self._write_loop())
+
+	async def close(self):
+		self.log.debug("close()")
 
-	def writable(self):
-		return False
-		# return (len(self._buffer) > 0)
+		for task in [self._read_task, self._write_task, *self._command_tasks]:
+			if task is not None and task is not asyncio.current_task():
+				task.cancel()
 
-	def handle_write(self):
-		sent = self.send(self._buffer)
-		self._buffer = self._buffer[sent:]
+		self._executor.shutdown(wait=False, cancel_futures=True)
 
-	def handle_read(self):
-		self.log.debug("handle_read()")
+		if self._writer is not None:
+			self._writer.close()
+			self._writer = None
 
-		buffer = b''
+	async def _read_loop(self):
 		while True:
-			try:
-				buffer += self.recv(1024)
-			except BlockingIOError as e:
-				break
+			data = await self._reader.readline()
+
+			if not data:
+				self.log.error("Connection to {0} closed".format(self._irc_network))
+				await self.close()
+				return
 
-		if buffer:
 			# Data is received as bytes, convert to string
-			str_data = buffer.decode('UTF-8')
+			line = data.decode('UTF-8', errors='replace').rstrip('\r\n')
+			self.log.debug(line)
+
+			try:
+				await self.handle_line(line)
+			except Exception as e:
+				self.log.exception(e)
+
+	async def _write_loop(self):
+		"""
+		Sends queued messages once the room has been joined, paced by the
+		token bucket
+		"""
+		await self._joined.wait()
+
+		while True:
+			while not self._outbox:
+				self._outbox_ready.clear()
+				await self._outbox_ready.wait()
+
+			await self._bucket.acquire()
+
+			self.send(self._outbox.popleft())
+			await self._writer.drain()
 
-			# Print out the data, commas prevents newline
-			self.log.debug(str_data)
+	async def handle_line(self, line):
+		if line.find("End of /MOTD command") != -1:
+			self.log.info("Responding to welcome")
+			self._irc_join(self._irc_room)
 
-			for line in str_data.split('\r\n'):
-				if line.find("End of /MOTD command") != -1:
-					self.log.info("Responding to welcome")
-					self._irc_join(self._irc_room)
+		elif line.find("MOTD File is missing") != -1:
+			self.log.info("Missing MOTD")
+			self._irc_join(self._irc_room)
 
-				elif line.find("MOTD File is missing") != -1:
-					self.log.info("Missing MOTD")
-					self._irc_join(self._irc_room)
+		elif line.startswith("PING "):
+			self.log.info("Responding to PING")
+			self.send('PONG %s\r\n' % line.split()[1])
 
-				elif line.startswith("PING "):
-					self.log.info("Responding to PING")
-					self.send('PONG %s\r\n' % line.split()[1])
+		else:
+			match = self._command_regex.search(line)
 
-				elif not self._irc_registered:
-					self.log.info("Sending NICK details")
-					self.send("NICK {0}\r\n".format(self._irc_nick))
-					self.send("USER {0} {0} {0} :Python IRC\r\n".format(self._irc_nick))
-					self._irc_registered = True
+			if match:
+				user, message = match.groups()
+				self.log.debug("Got message: %s" % message)
 
+				if message == 'quit':
+					await self.close()
 				else:
-					regex_string = "\:(\S+)\!\S+ PRIVMSG {room} \:{nick}\: ([a-zA-Z0-9'-: ]+)"
-					regex = re.compile(regex_string.format(room=self._irc_room, nick=self._irc_nick))
-					match = regex.search(line)
-
-					if match:
-						user, message = match.groups()
-						self.log.debug("Got message: %s" % message)
-
-						if message == 'quit':
-							self.close()
-						else:
-							# Make sure a certain amount of time has passed since the last command request
-							if self._last_check is None or datetime.now() >= (self._last_check + timedelta(seconds=self._last_check_limit)):
-								self._last_check = datetime.now()
-
-								# Get the current list of streams
-								current_streams = get_current_streams(message)
-
-								for stream in current_streams:
-									if stream["channel"]["name"] in self._blacklist:
-										self.log.info("Channel {0} is blacklisted".format(stream["channel"]["name"]))
-										current_streams.remove(stream)
-
-								# Construct a message to send to IRC
-								stream_urls = [stream["channel"]["url"] for stream in current_streams]
-
-								if stream_urls:
-									msg = "{user}: Current {game} streams include {streams}".format(user=user,
-									                                                                game=message,
-									                                                                streams=", ".join(stream_urls))
-								else:
-									msg = "{user}: There are no {game} streams.".format(user=user, game=message)
-
-								self._irc_send(msg)
-							else:
-								# Not enough time has passed since the last request
-								self.log.info("Not enough time since last command request")
+					# Answer in a separate task so the connection keeps being
+					# read, holding on to it until it's done so it isn't
+					# garbage collected
+					task = asyncio.create_task(self._answer_command(user, message))
+					self._command_tasks.add(task)
+					task.add_done_callback(self._command_tasks.discard)
+
+	def _command_allowed(self, user, game):
+		"""
+		Each user can ask about each game at most once every cmd_limit seconds
+		"""
+		now = time.monotonic()
+		key = (user, game.lower())
+
+		if now < self._last_checks.get(key, 0) + self._last_check_limit:
+			return False
+
+		# Forget requests that no longer limit anyone
+		if len(self._last_checks) > 1000:
+			self._last_checks = {
+				k: t
+				for k, t
+				in self._last_checks.items()
+				if now < t + self._last_check_limit
+			}
+
+		self._last_checks[key] = now
+		return True
+
+	async def _lookup_streams(self, game):
+		"""
+		Returns the current streams for a game from the result cache, or from
+		Twitch in a worker thread. Concurrent lookups for the same game share
+		one request.
+		"""
+		key = game.lower()
+		now = time.monotonic()
+
+		cached = self._results.get(key)
+		if cached is not None and now < cached[0] + self._results_ttl:
+			return cached[1]
+
+		if key not in self._lookups:
+			stream_filter = FilterChain([
+				self._global_filter() if self._global_filter is not None else None,
+				self._stream_filter,
+			])
+
+			loop = asyncio.get_running_loop()
+			self._lookups[key] = loop.run_in_executor(self._executor,
+			                                          functools.partial(get_current_streams, game, stream_filter=stream_filter))
+
+		try:
+			streams = await asyncio.shield(self._lookups[key])
+		finally:
+			self._lookups.pop(key, None)
+
+		now = time.monotonic()
+
+		# Forget results too old to be used
+		if len(self._results) > 1000:
+			self._results = {
+				k: result
+				for k, result
+				in self._results.items()
+				if now < result[0] + self._results_ttl
+			}
+
+		self._results[key] = (now, streams)
+
+		return streams
+
+	async def _answer_command(self, user, message):
+		if not self._command_allowed(user, message):
+			self.log.info("Not enough time since {0} last asked about {1}".format(user, message))
+			return
+
+		try:
+			current_streams = await self._lookup_streams(message)
+		except (HelixRateLimitError, HelixUnavailableError) as e:
+			self.log.warning(e)
+			self._irc_send("{user}: Twitch is busy, try again in a minute.".format(user=user))
+			return
+		except HelixError as e:
+			self.log.error(e)
+			self._irc_send("{user}: Could not get the {game} streams.".format(user=user, game=message))
+			return
+		except Exception as e:
+			self.log.exception(e)
+			self._irc_send("{user}: Could not get the {game} streams.".format(user=user, game=message))
+			return
+
+		# Construct a message to send to IRC
+		stream_urls = ["https://www.twitch.tv/%s" % stream["user_login"] for stream in current_streams]
+
+		if stream_urls:
+			msg = "{user}: Current {game} streams include {streams}".format(user=user,
+			                                                                game=message,
+			                                                                streams=", ".join(stream_urls))
+		else:
+			msg = "{user}: There are no {game} streams.".format(user=user, game=message)
+
+		self._irc_send(msg)
 
 	def send(self, msg):
 		self.log.debug("send()")
-		msg = bytes(msg, "UTF-8")
-		return super().send(msg)
+
+		if self._writer is None:
+			self.log.warning("Not connected, dropping message")
+			return
+
+		self._writer.write(bytes(msg, "UTF-8"))
+
+	def _privmsg_max_length(self):
+		"""
+		The number of bytes available for the text of a PRIVMSG to the room
+		"""
+		return self.MAX_LINE_LENGTH - len(bytes("PRIVMSG %s : \r\n" % self._irc_room, "UTF-8"))
+
+	def _truncate(self, msg, max_length=None):
+		if max_length is None:
+			max_length = self._privmsg_max_length()
+
+		encoded = bytes(msg, "UTF-8")
+
+		if len(encoded) <= max_length:
+			return msg
+
+		return encoded[:max_length].decode("UTF-8", errors="ignore")
 
 	def _irc_send(self, msg):
+		"""
+		Queues a message to the room
+		"""
 		self.log.debug("_irc_send()")
-		self.send("PRIVMSG %s : %s\r\n" % (self._irc_room, msg))
+
+		# Nothing reconnects, so messages would only pile up
+		if self._writer is None:
+			if not self._dropping:
+				self.log.warning("Not connected to {0}, dropping messages".format(self._irc_network))
+				self._dropping = True
+			return
+
+		self._outbox.append("PRIVMSG %s : %s\r\n" % (self._irc_room, self._truncate(msg)))
+
+		if self._outbox_ready is not None:
+			self._outbox_ready.set()
 
 	def _irc_join(self, chan):
 		self.log.debug("_irc_join()")
 		self.send("JOIN %s\r\n" % chan)
+		self._joined.set()
 
-		msg = ''
-		while msg.find('End of /NAMES list.') == -1:
-			try:
-				msg = self.recv(2048).decode('UTF-8')
-			except BlockingIOError as e:
-				break
+	def _coalesce_messages(self, messages, separator=" || "):
+		"""
+		Joins messages into as few lines as fit in a PRIVMSG
+		"""
+		max_length = self._privmsg_max_length()
+		lines = []
+		line = ""
 
-			msg = msg.strip('\r\n')
-			self.log.info(msg)
+		for msg in messages:
+			msg = self._truncate(msg)
 
-	def broadcast(self, streams):
-		self.log.debug("broadcast()")
+			if line and len(bytes(line + separator + msg, "UTF-8")) > max_length:
+				lines.append(line)
+				line = ""
+
+			line = line + separator + msg if line else msg
+
+		if line:
+			lines.append(line)
+
+		return lines
+
+	def format_messages(self, streams):
+		"""
+		Returns the lines broadcast() sends to the room for the streams
+		"""
+		messages = []
 
-		# Only send the notification if the game list is empty
-		# or if the game is in the list
 		for stream in streams:
-			if self._games == [] or stream["game_name"] in self._games:
-				self._irc_send("{game} | {status} | {url}".format(game=stream['game_name'],
-				                                                  url="https://www.twitch.tv/%s" % stream['user_name'],
-				                                                  status=stream['title'].replace('\n', ' ')))
+			msg = "{game} | {{status}} | {url}".format(game=stream['game_name'],
+			                                           url="https://www.twitch.tv/%s" % stream['user_login'])
+
+			# Shorten the title rather than lose the URL off the end
+			status_length = self._privmsg_max_length() - len(bytes(msg, "UTF-8")) + len("{status}")
+			status = self._truncate(stream['title'].replace('\n', ' '), max(status_length, 0))
+
+			messages.append(msg.format(status=status))
 
+		if self._coalesce:
+			messages = self._coalesce_messages(messages)
+
+		return messages
+
+	async def broadcast(self, streams):
+		self.log.debug("broadcast()")
 
-class DbusBroadcaster(object):
-	def __init__(self, **kwargs):
+		for msg in self.format_messages(streams):
+			self._irc_send(msg)
+
+
+class DbusBroadcaster(Broadcaster):
+	"""
+	Sends desktop notifications through org.freedesktop.Notifications.
+
+	Streams arriving within coalesce_window seconds of each other are shown
+	in one notification, listing up to max_listed of them. For
+	replace_window seconds after a notification is shown, new streams
+	update it in place (with replaces_id) rather than stacking another on
+	top.
+
+	One session bus connection is kept open, and used from a single worker
+	thread as DBus calls block.
+
+	Docs: https://specifications.freedesktop.org/notification-spec/latest/
+	"""
+	APP_NAME = "TwitchWatch"
+
+	def __init__(self, coalesce_window=2, replace_window=60, max_listed=5, **kwargs):
 		self.log = logging.getLogger("DbusBroadcaster")
 		self.log.debug("__init__()")
 
-		self.get_interface()
+		self._coalesce_window = coalesce_window
+		self._replace_window = replace_window
+		self._max_listed = max_listed
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self._interface = None
+		self._pending = []
+		self._flush_task = None
+		# Notify can be slow, and a flush needs the one before it to have
+		# recorded the notification it showed
+		self._flush_lock = asyncio.Lock()
+
+		# The notification on screen, if any, its newest streams and how many
+		# it is for
+		self._notification_id = 0
+		self._shown = []
+		self._shown_count = 0
+		self._shown_at = 0
+
+	async def start(self):
+		loop = asyncio.get_running_loop()
+		await loop.run_in_executor(self._executor, self.get_interface)
 
 	def get_interface(self):
 		import dbus
@@ -174,28 +621,148 @@ class DbusBroadcaster(object):
 		obj = session_bus.get_object(_bus_name, _object_path)
 		self._interface = dbus.Interface(obj, _interface_name)
 
-	def send_notification(self, stream):
-		self.log.debug("send_notification()")
-		msg_summary = "New \"{0}\" stream".format(stream['game_name'])
-		msg_body = "https://www.twitch.tv/{0}".format(stream['user_name'])
-		self._interface.Notify("TwitchWatch", 0, "", msg_summary, msg_body, [], {}, -1)
+	def format_notification(self, streams, count=None):
+		"""
+		Returns the summary and body of a notification for the streams,
+		newest first. count is the number of streams it is for, if there are
+		more than those given.
+		"""
+		if count is None:
+			count = len(streams)
+
+		if count == 1:
+			stream = streams[0]
+			return ("New \"{0}\" stream".format(stream['game_name']),
+			        "https://www.twitch.tv/{0}".format(stream['user_login']))
+
+		lines = [
+			"{0}: https://www.twitch.tv/{1}".format(stream['game_name'], stream['user_login'])
+			for stream
+			in streams[:self._max_listed]
+		]
 
-	def broadcast(self, streams):
-		self.log.debug("broadcast()")
+		if count > len(lines):
+			lines.append("and {0} more".format(count - len(lines)))
+
+		return "{0} new streams".format(count), "\n".join(lines)
 
+	def send_notification(self, summary, body, replaces_id=0):
+		"""
+		Shows a notification, replacing replaces_id if it is still open,
+		and returns its id. Reconnects once if the session bus connection
+		was lost.
+		"""
 		import dbus
 
-		for stream in streams:
-			try:
-				self.send_notification(stream)
-			except dbus.exceptions.DBusException:
-				self.logger.warn("DBus session invalid, reconnecting.")
+		self.log.debug("send_notification()")
+
+		try:
+			if self._interface is None:
 				self.get_interface()
-				self.send_notification(stream)
 
+			return int(self._interface.Notify(self.APP_NAME, replaces_id, "", summary, body, [], {}, -1))
+		except dbus.exceptions.DBusException:
+			self.log.warning("DBus session invalid, reconnecting.")
+			self.get_interface()
+			return int(self._interface.Notify(self.APP_NAME, replaces_id, "", summary, body, [], {}, -1))
+
+	async def broadcast(self, streams):
+		"""
+		Queues the streams for the next notification, which is shown
+		coalesce_window seconds after the first of them arrived
+		"""
+		self.log.debug("broadcast()")
+
+		self._pending += streams
+
+		if self._flush_task is None:
+			self._flush_task = asyncio.create_task(self._flush_later())
+
+	async def _flush_later(self):
+		try:
+			await asyncio.sleep(self._coalesce_window)
+		finally:
+			self._flush_task = None
+
+		await self._flush()
+
+	async def _flush(self):
+		async with self._flush_lock:
+			await self._show_pending()
+
+	async def _show_pending(self):
+		streams, self._pending = self._pending, []
+
+		if not streams:
+			return
+
+		now = time.monotonic()
+		streams = streams[::-1]
+		count = len(streams)
+		replaces_id = 0
 
+		# Add to the notification on screen rather than covering it
+		if self._notification_id and now - self._shown_at < self._replace_window:
+			streams = streams + self._shown
+			count += self._shown_count
+			replaces_id = self._notification_id
 
-class DiscordWebhookBroadcaster(object):
+		streams = streams[:self._max_listed]
+		summary, body = self.format_notification(streams, count)
+
+		loop = asyncio.get_running_loop()
+
+		try:
+			self._notification_id = await loop.run_in_executor(self._executor, self.send_notification,
+			                                                   summary, body, replaces_id)
+		except Exception as e:
+			self.log.error("Could not show a notification for {0} streams".format(len(streams)))
+			self.log.exception(e)
+			return
+
+		self._shown = streams
+		self._shown_count = count
+		self._shown_at = now
+
+	async def close(self):
+		if self._flush_task is not None:
+			self._flush_task.cancel()
+			self._flush_task = None
+
+		# Show whatever was still waiting
+		await self._flush()
+
+		self._executor.shutdown(wait=False)
+
+
+
+class RateLimitBucket(object):
+	"""
+	Tracks a Discord rate limit bucket from the X-RateLimit-* response headers
+
+	Docs: https://discord.com/developers/docs/topics/rate-limits
+	"""
+	def __init__(self):
+		self.remaining = None
+		self.reset_at = 0
+
+	def delay(self):
+		"""
+		Returns the number of seconds to wait before the next request
+		"""
+		if self.remaining == 0:
+			return max(self.reset_at - time.monotonic(), 0)
+		return 0
+
+	def update(self, headers):
+		if "X-RateLimit-Remaining" in headers:
+			self.remaining = int(headers["X-RateLimit-Remaining"])
+		if "X-RateLimit-Reset-After" in headers:
+			self.reset_at = time.monotonic() + float(headers["X-RateLimit-Reset-After"])
+
+
+
+class DiscordWebhookBroadcaster(Broadcaster):
 	"""
 	{
 		"broadcasters": [
@@ -205,35 +772,110 @@ class DiscordWebhookBroadcaster(object):
 			}
 		]
 	}
+
+	webhook-url can also be a list of webhook URLs. Each one has its own
+	rate limit bucket.
 	"""
-	def __init__(self, webhook_url, **kwargs):
+	# The maximum number of embeds Discord accepts in one message
+	MAX_EMBEDS = 10
+
+	def __init__(self, webhook_url, max_retries=3, **kwargs):
 		self.log = logging.getLogger("DiscordBroadcaster")
 		self.log.debug("__init__()")
-		self.webhook_url = webhook_url
 
-	def broadcast(self, streams):
+		if isinstance(webhook_url, str):
+			webhook_url = [webhook_url]
+
+		self.webhook_urls = webhook_url
+		self._max_retries = max_retries
+		self._buckets = {url: RateLimitBucket() for url in self.webhook_urls}
+		self._session = None
+
+	async def start(self):
+		import requests
+
+		# One session keeps the connection to Discord alive between messages
+		self._session = requests.Session()
+
+	async def close(self):
+		if self._session is not None:
+			self._session.close()
+			self._session = None
+
+	def make_embed(self, stream):
+		embed = {
+			"author": {
+				"name": stream.get('user_name', stream['user_login'])
+			},
+			"title": stream.get('game_name', ""),
+			"description": stream.get('title', ""),
+			"url": "https://www.twitch.tv/{0}".format(stream['user_login']),
+		}
+
+		# Streams from EventSub events may not have every field
+		if stream.get('thumbnail_url'):
+			embed["thumbnail"] = {
+				"url": stream['thumbnail_url'].format(width=32, height=32)
+			}
+
+		return embed
+
+	async def broadcast(self, streams):
 		self.log.debug("broadcast()")
 		self.log.info(streams)
 
-		import requests
+		embeds = [self.make_embed(stream) for stream in streams]
 
-		url = self.webhook_url
+		await asyncio.gather(*[
+			self._send_embeds(url, embeds)
+			for url
+			in self.webhook_urls
+		])
 
-		for stream in streams:
-			payload = {
-				"embeds": [
-					{
-						"author": {
-							"name": stream['user_name']
-						},
-						"title": stream['game_name'],
-						"description": stream['title'],
-						"url": "https://www.twitch.tv/{0}".format(stream['user_name']),
-						"thumbnail": {
-							"url": stream['thumbnail_url'].format(width=32, height=32)
-						}
-					}
-				]
-			}
+	async def _send_embeds(self, url, embeds):
+		for chunk in chunks(embeds, self.MAX_EMBEDS):
+			await self._post(url, {"embeds": chunk})
+
+	def _webhook_name(self, url):
+		"""
+		Labels a webhook by its id, leaving the secret token out of the metrics
+		"""
+		parts = url.rstrip("/").split("/")
+		return parts[-2] if len(parts) >= 2 else url
+
+	async def _post(self, url, payload):
+		"""
+		Posts a message to a webhook, waiting for its rate limit bucket and
+		retrying after a 429
+		"""
+		bucket = self._buckets[url]
+
+		for attempt in range(self._max_retries + 1):
+			delay = bucket.delay()
+			if delay:
+				self.log.info("Waiting {0:.2f}s for the rate limit to reset".format(delay))
+				await asyncio.sleep(delay)
+
+			# requests blocks, so keep it off the event loop
+			response = await asyncio.to_thread(self._session.post, url, json=payload, timeout=30)
+			bucket.update(response.headers)
+
+			if bucket.remaining is not None:
+				DISCORD_RATELIMIT_REMAINING.set(bucket.remaining, webhook=self._webhook_name(url))
+
+			if response.status_code == 429:
+				try:
+					retry_after = float(response.json()["retry_after"])
+				except Exception:
+					retry_after = float(response.headers.get("Retry-After", 1))
+
+				self.log.warning("Rate limited, retrying in {0:.2f}s".format(retry_after))
+				await asyncio.sleep(retry_after)
+				continue
+
+			if not response.ok:
+				self.log.error("Webhook request failed with {0}: {1}".format(response.status_code, response.text))
+
+			return
 
-			response = requests.post(url, json=payload)
+		self.log.error("Giving up after {0} rate limited attempts".format(self._max_retries + 1))
@@ -1,14 +1,40 @@
+import calendar
 import logging
-import urllib.request
 import urllib.parse
 import json
-from twitchAPI.twitch import Twitch
+import fcntl
+import os
+import threading
+import time
+from xdg import XDG_CACHE_HOME
 
 import config
+from filters import StreamFilter
+from helix import HelixAuthError, HelixSession
+import metrics
+import profiling
 
 
 log = logging.getLogger(__name__)
 
+TWITCH_AUTH_URL = "https://id.twitch.tv/oauth2/token"
+TWITCH_API_URL = "https://api.twitch.tv/helix"
+
+# The maximum number of names/ids, and of results per page, Helix accepts
+HELIX_MAX_IDS = 100
+
+HELIX_REQUESTS = metrics.counter("twitchwatch_helix_requests_total",
+                                 "Helix API requests by endpoint and HTTP status",
+                                 ["endpoint", "status"])
+HELIX_REQUEST_SECONDS = metrics.histogram("twitchwatch_helix_request_seconds",
+                                          "Time taken by Helix API requests",
+                                          ["endpoint"])
+HELIX_RATELIMIT_REMAINING = metrics.gauge("twitchwatch_helix_ratelimit_remaining",
+                                          "Helix requests left in the current rate limit window")
+POLL_PHASE_SECONDS = metrics.histogram("twitchwatch_poll_phase_seconds",
+                                       "Time taken by each phase of fetching the current streams",
+                                       ["phase"])
+
 
 def make_safe_name(string):
 	"""
@@ -27,83 +53,651 @@ def make_safe_name(string):
 	return new_string
 
 
-def get_game_id(twitch_client, game):
-	'''
-	Returns the game_id for a game
+def chunks(items, size):
+	"""
+	Splits a list into lists of at most size items
+	"""
+	return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+
+class AppTokenManager(object):
+	"""
+	Keeps the Twitch app access token in memory and in a file under
+	$XDG_CACHE_HOME/twitchwatch so every process can share one token instead
+	of doing an OAuth round trip for each request.
+
+	Docs: https://dev.twitch.tv/docs/authentication/getting-tokens-oauth#client-credentials-grant-flow
+	"""
+	def __init__(self, client_id, client_secret, token_file=None, refresh_margin=300,
+	             auth_url=TWITCH_AUTH_URL, api_url=TWITCH_API_URL):
+		"""
+		refresh_margin is the number of seconds before expiry that a token is
+		considered stale and gets replaced
+
+		auth_url and api_url can point at a stand-in server such as
+		fakehelix.py instead of Twitch
+		"""
+		self.log = logging.getLogger("AppTokenManager")
+
+		if token_file is None:
+			token_file = os.path.join(XDG_CACHE_HOME, "twitchwatch", "app_token.json")
+
+		self.client_id = client_id
+		self.auth_url = auth_url
+		self.api_url = api_url
+		self._client_secret = client_secret
+		self._token_file = token_file
+		self._refresh_margin = refresh_margin
+		self._token = None
+		self._expires_at = 0
+		self._rejected_token = None
+
+	def _is_fresh(self, expires_at):
+		return time.time() < expires_at - self._refresh_margin
+
+	def _read_token_file(self):
+		try:
+			with open(self._token_file) as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			return None, 0
+
+		if data.get("client_id") != self.client_id or data.get("auth_url", TWITCH_AUTH_URL) != self.auth_url:
+			return None, 0
+
+		return data.get("access_token"), data.get("expires_at", 0)
+
+	def _write_token_file(self):
+		config.write_json_atomic(self._token_file, {
+			"client_id": self.client_id,
+			"auth_url": self.auth_url,
+			"access_token": self._token,
+			"expires_at": self._expires_at,
+		})
+
+	def _request_token(self):
+		self.log.debug("_request_token()")
+
+		data = urllib.parse.urlencode({
+			"client_id": self.client_id,
+			"client_secret": self._client_secret,
+			"grant_type": "client_credentials",
+		}).encode("utf-8")
+
+		with POLL_PHASE_SECONDS.time(phase="token"), profiling.phase("auth"):
+			token = get_session().request("POST", self.auth_url, body=data, headers={
+				"Content-Type": "application/x-www-form-urlencoded",
+			})
+
+		return token["access_token"], time.time() + token["expires_in"]
+
+	def get_token(self):
+		"""
+		Returns a valid app access token, requesting a new one only when
+		neither this process nor the token file has a fresh one
+		"""
+		if self._token and self._is_fresh(self._expires_at):
+			return self._token
+
+		token_dir = os.path.dirname(self._token_file)
+		os.makedirs(token_dir, exist_ok=True)
+
+		# Hold a lock while refreshing so concurrent processes don't all
+		# request their own token
+		with open(self._token_file + ".lock", "w") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+
+			token, expires_at = self._read_token_file()
+
+			if token and token != self._rejected_token and self._is_fresh(expires_at):
+				self.log.debug("Using token from {0}".format(self._token_file))
+				self._token, self._expires_at = token, expires_at
+			else:
+				self.log.info("Requesting a new app access token")
+				self._token, self._expires_at = self._request_token()
+				self._write_token_file()
+
+		return self._token
+
+	def invalidate(self):
+		"""
+		Forget the current token, e.g., after Twitch rejected it
+		"""
+		self._rejected_token = self._token
+		self._token = None
+		self._expires_at = 0
+
+
+
+_token_managers = {}
+
+def get_token_manager(cfg=None):
+	"""
+	Returns the AppTokenManager for the configured client-id, creating it on
+	first use. The Twitch URLs can be changed with auth-url and api-url.
+	"""
+	if cfg is None:
+		cfg = config.get_config()
+
+	key = (cfg['client-id'], cfg.get('auth-url', TWITCH_AUTH_URL), cfg.get('api-url', TWITCH_API_URL))
+
+	if key not in _token_managers:
+		token_file = None
+
+		# Keep tokens from a stand-in server apart from the Twitch one
+		if key[1] != TWITCH_AUTH_URL:
+			token_name = "app_token-{0}.json".format(make_safe_name(urllib.parse.urlsplit(key[1]).netloc))
+			token_file = os.path.join(XDG_CACHE_HOME, "twitchwatch", token_name)
+
+		_token_managers[key] = AppTokenManager(cfg['client-id'], cfg['client-secret'],
+		                                       token_file=token_file,
+		                                       auth_url=key[1],
+		                                       api_url=key[2])
+
+	return _token_managers[key]
+
+
+
+class RateLimit(object):
+	"""
+	The Helix rate limit bucket as last seen in the Ratelimit-* response
+	headers. The bucket holds limit points, refilled at limit per minute,
+	and reset_at is when it will be full again, in seconds since the epoch.
+	Everything is None until a response has been seen.
+
+	Docs: https://dev.twitch.tv/docs/api/guide#twitch-rate-limits
+	"""
+	__slots__ = ("limit", "remaining", "reset_at")
+
+	def __init__(self):
+		self.limit = None
+		self.remaining = None
+		self.reset_at = None
+
+	def update(self, headers):
+		if not headers:
+			return
+
+		try:
+			if headers.get("Ratelimit-Limit") is not None:
+				self.limit = int(headers["Ratelimit-Limit"])
+			if headers.get("Ratelimit-Remaining") is not None:
+				self.remaining = int(headers["Ratelimit-Remaining"])
+				HELIX_RATELIMIT_REMAINING.set(self.remaining)
+			if headers.get("Ratelimit-Reset") is not None:
+				self.reset_at = int(headers["Ratelimit-Reset"])
+		except ValueError:
+			pass
+
+
+# Shared by every Helix request made by this process
+RATE_LIMIT = RateLimit()
+
+_session = None
+
+def get_session():
+	"""
+	Returns the HelixSession shared by every Twitch request made by this
+	process. Its circuit breaker state is kept in $XDG_CACHE_HOME/twitchwatch
+	so other processes know when Twitch is failing.
+	"""
+	global _session
+
+	if _session is None:
+		_session = HelixSession(state_dir=os.path.join(XDG_CACHE_HOME, "twitchwatch"))
+
+	return _session
+
+
+
+def helix_request(token_manager, path, params=None, data=None, token=None):
+	"""
+	Makes an authenticated request to the Helix API and returns the parsed
+	JSON response. With data the request is a POST of data as JSON.
+	Rate limits, 5xx responses and network errors are retried by the
+	HelixSession.
+
+	:param token: A user access token to use instead of the app access
+	              token. It isn't retried if Twitch rejects it.
+	:raises helix.HelixError: A subclass for the kind of failure
+	"""
+	url = "{0}/{1}".format(token_manager.api_url, path)
+
+	if params:
+		url += "?" + urllib.parse.urlencode(params, doseq=True)
+
+	body = None
+	headers = {"Client-Id": token_manager.client_id}
+
+	if data is not None:
+		body = bytes(json.dumps(data), "utf-8")
+		headers["Content-Type"] = "application/json"
+
+	def on_response(status, response_headers, seconds):
+		HELIX_REQUEST_SECONDS.observe(seconds, endpoint=path)
+		HELIX_REQUESTS.inc(endpoint=path, status=status)
+		RATE_LIMIT.update(response_headers)
+
+	for attempt in range(2):
+		log.debug("Requesting: %s" % url)
+
+		headers["Authorization"] = "Bearer {0}".format(token or token_manager.get_token())
+
+		try:
+			return get_session().request("POST" if body is not None else "GET", url,
+			                             body=body, headers=headers, on_response=on_response)
+		except HelixAuthError:
+			if attempt == 0 and token is None:
+				log.info("App access token was rejected, requesting a new one")
+				token_manager.invalidate()
+				continue
+			raise
+
+
+
+class GameIndex(object):
+	"""
+	Persistent, case-insensitive index of game names to game ids, stored in
+	$XDG_CACHE_HOME/twitchwatch/games.json. A game's id effectively never
+	changes, so entries are only looked up again once they are older than ttl.
 
 	Docs: https://dev.twitch.tv/docs/api/reference#get-games
-	'''
+	"""
+	def __init__(self, index_file=None, ttl=7 * 24 * 3600):
+		"""
+		ttl is the number of seconds an entry is used before it is refreshed
+		"""
+		self.log = logging.getLogger("GameIndex")
+
+		if index_file is None:
+			index_file = os.path.join(XDG_CACHE_HOME, "twitchwatch", "games.json")
+
+		self._index_file = index_file
+		self._ttl = ttl
+		# Several threads look up games at once, e.g., IRC commands
+		self._lock = threading.Lock()
+		self._games = self._read_index_file()
+
+	def _read_index_file(self):
+		try:
+			with open(self._index_file) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
+
+	def _is_fresh(self, entry):
+		return time.time() < entry["fetched_at"] + self._ttl
+
+	def get_ids(self, names, token_manager):
+		"""
+		Returns a dict of game name to game_id for every game Twitch knows.
+		Missing and expired entries are looked up together, up to
+		HELIX_MAX_IDS names per request. Expired entries are still used if
+		the refresh fails.
+		"""
+		ids = {}
+		lookup = []
+
+		with self._lock:
+			for name in names:
+				entry = self._games.get(name.lower())
+
+				if entry is not None:
+					ids[name] = entry["id"]
+
+				if entry is None or not self._is_fresh(entry):
+					lookup.append(name)
+
+		if not lookup:
+			return ids
+
+		# The requests are made without the lock, so one slow lookup doesn't
+		# hold up the others
+		fetched = {}
+
+		try:
+			for chunk in chunks(lookup, HELIX_MAX_IDS):
+				response = helix_request(token_manager, "games", {"name": chunk})
+				log.debug(response)
+
+				for game in response["data"]:
+					fetched[game["name"].lower()] = {
+						"id": game["id"],
+						"name": game["name"],
+						"fetched_at": time.time(),
+					}
+		except Exception as e:
+			self._add(fetched)
+
+			if any(name not in ids for name in lookup):
+				raise
+			self.log.warning("Could not refresh game ids, using cached ids")
+			self.log.exception(e)
+			return ids
+
+		self._add(fetched)
+
+		for name in lookup:
+			entry = fetched.get(name.lower())
+			if entry is not None:
+				ids[name] = entry["id"]
+
+		return ids
+
+	def _add(self, entries):
+		"""
+		Adds looked up entries and writes the index file, if there are any.
+		A failed write is only logged, as the entries are still used.
+		"""
+		if not entries:
+			return
+
+		with self._lock:
+			self._games.update(entries)
+
+			try:
+				config.write_json_atomic(self._index_file, self._games)
+			except OSError as e:
+				self.log.warning("Could not write {0}: {1}".format(self._index_file, e))
+
+	def get_id(self, name, token_manager):
+		"""
+		Returns the game_id for a game name, or None if Twitch doesn't know
+		the game
+		"""
+		return self.get_ids([name], token_manager).get(name)
+
+
+
+_game_indexes = {}
+
+def get_game_index(api_url=TWITCH_API_URL):
+	"""
+	Returns the GameIndex for api_url. Each API gets its own index file so
+	ids from a stand-in server are never used with Twitch.
+	"""
+	if api_url not in _game_indexes:
+		index_file = None
+
+		if api_url != TWITCH_API_URL:
+			index_name = "games-{0}.json".format(make_safe_name(urllib.parse.urlsplit(api_url).netloc))
+			index_file = os.path.join(XDG_CACHE_HOME, "twitchwatch", index_name)
+
+		_game_indexes[api_url] = GameIndex(index_file)
+
+	return _game_indexes[api_url]
+
+
+
+def get_game_id(game, token_manager=None):
+	"""
+	Returns the game_id for a game, or None if the game can't be found
+	"""
+	if token_manager is None:
+		token_manager = get_token_manager()
+
+	return get_game_index(token_manager.api_url).get_id(game, token_manager)
 
-	cfg = config.get_config()
 
-	twitch = Twitch(cfg['client-id'], cfg['client-secret'])
 
-	# First need to fetch the game_id
-	query = urllib.parse.urlencode({
-		"name": game,
-	})
-	url = "https://api.twitch.tv/helix/games?%s" % query
+def iter_streams(token_manager, game_ids, max_pages=None, max_streams=None, page_size=HELIX_MAX_IDS):
+	"""
+	Yields the current streams for up to HELIX_MAX_IDS game ids, following
+	the Helix pagination cursor lazily so a page is only requested once the
+	caller has used the previous one. Stops after max_pages pages or
+	max_streams streams, whichever comes first.
+
+	Docs: https://dev.twitch.tv/docs/api/guide#pagination
+	"""
+	params = {
+		"game_id": game_ids,
+		"first": min(page_size, HELIX_MAX_IDS),
+	}
+	pages = 0
+	count = 0
+
+	while max_pages is None or pages < max_pages:
+		response = helix_request(token_manager, "streams", params)
+		pages += 1
 
-	log.debug("Requesting: %s" % url)
+		for stream in response["data"]:
+			yield stream
+			count += 1
 
-	request = urllib.request.Request(url)
-	request.add_header("Accept", "application/vnd.twitchtv.v3+json")
-	request.add_header("Client-Id", cfg['client-id'])
+			if max_streams is not None and count >= max_streams:
+				return
 
-	response = urllib.request.urlopen(request)
+		cursor = response.get("pagination", {}).get("cursor")
 
-	# Read the data out of the response
-	data = response.read().decode("utf-8")
-	log.debug(data)
+		if not cursor or not response["data"]:
+			return
 
-	return json.loads(data)['data'][0]['id']
+		params["after"] = cursor
 
 
 
-def get_current_streams(game, limit=5, blacklist=[]):
+def get_current_streams(game, limit=5, blacklist=[], token_manager=None, stream_filter=None):
 	"""
 		Fetches the current list of Twitch streams for a game
 
 		e.g., https://api.twitch.tv/helix/streams?game_id=12345&limit=5
 
 		Docs: https://dev.twitch.tv/docs/api/reference#get-streams
+
+		:param limit: The maximum number of streams to return, or None for all
+		:param blacklist: Channel names to leave out of the results
+		:param stream_filter: A filters.StreamFilter (or FilterChain) the
+		                      results have to match, instead of blacklist
+		:param token_manager: The AppTokenManager to authenticate with.
+		                      Defaults to the one for the configured client-id.
+		:return: List of streams, empty if Twitch doesn't know the game
+		:raises helix.HelixError: A subclass for the kind of failure
 	"""
-	cfg = config.get_config()
+	if token_manager is None:
+		token_manager = get_token_manager()
 
-	twitch = Twitch(cfg['client-id'], cfg['client-secret'])
-	twitch.authenticate_app([])
+	with POLL_PHASE_SECONDS.time(phase="game_ids"), profiling.phase("game_lookup"):
+		game_id = get_game_id(game, token_manager)
 
-	try:
-		response = twitch.get_games(names=[game])
-	except Exception as e:
-		log.exception(e)
-		return None
+	if game_id is None:
+		log.warning("Could not find a game called {0}".format(game))
+		return []
 
-	log.debug(response)
+	if stream_filter is None:
+		stream_filter = StreamFilter(blacklist=blacklist)
 
-	game_id = [game['id'] for game in response['data']]
+	streams = []
 
-	try:
-		response = twitch.get_streams(game_id=game_id)
-		log.debug(response)
-	except Exception as e:
-		log.exception(e)
-		return None
+	with POLL_PHASE_SECONDS.time(phase="streams"), profiling.phase("stream_fetch"):
+		for stream in iter_streams(token_manager, [game_id], page_size=limit or HELIX_MAX_IDS):
+			if not stream_filter.matches(stream):
+				log.debug("Leaving out {0}".format(stream["user_name"]))
+				continue
 
-	return response['data']
+			streams.append(stream)
 
+			if limit is not None and len(streams) >= limit:
+				break
 
+	return streams
 
-class StreamCache(object):
+
+
+def get_current_streams_many(games, token_manager=None, max_pages=None):
+	"""
+	Fetches the current Twitch streams for several games with as few
+	requests as possible: one /games request for any ids not already in the
+	game index and one paginated /streams query per HELIX_MAX_IDS games.
+
+	:param max_pages: The maximum number of pages to fetch per query, or None for all
+
+	:return: Dict of game name to list of streams. Games Twitch doesn't know
+	         get an empty list.
+	:raises helix.HelixError: A subclass for the kind of failure
+	"""
+	if token_manager is None:
+		token_manager = get_token_manager()
+
+	with POLL_PHASE_SECONDS.time(phase="game_ids"), profiling.phase("game_lookup"):
+		game_ids = get_game_index(token_manager.api_url).get_ids(games, token_manager)
+
+	for game in games:
+		if game not in game_ids:
+			log.warning("Could not find a game called {0}".format(game))
+
+	streams_by_game_id = {game_id: [] for game_id in game_ids.values()}
+
+	with POLL_PHASE_SECONDS.time(phase="streams"), profiling.phase("stream_fetch"):
+		for chunk in chunks(list(streams_by_game_id), HELIX_MAX_IDS):
+			for stream in iter_streams(token_manager, chunk, max_pages=max_pages):
+				streams_by_game_id.setdefault(stream["game_id"], []).append(stream)
+
+	return {
+		game: streams_by_game_id.get(game_ids.get(game), [])
+		for game in games
+	}
+
+
+
+def parse_timestamp(s):
+	"""
+	Takes a Helix UTC datetime string, e.g., 2019-12-03T00:03:33Z, and
+	returns it as seconds since the epoch. Numbers are assumed to already be
+	seconds since the epoch and are returned as they are.
 	"""
-	Does caching stuff for a particular game.
+	if isinstance(s, (int, float)):
+		return int(s)
+
+	# Slicing the fixed-width string is several times faster than strptime
+	return calendar.timegm((int(s[0:4]), int(s[5:7]), int(s[8:10]),
+	                        int(s[11:13]), int(s[14:16]), int(s[17:19])))
+
+
+
+class StreamRecord(object):
+	"""
+	The parts of a stream StreamCache needs to remember
 	"""
+	__slots__ = ("stream_id", "started_at")
+
+	def __init__(self, stream_id, started_at):
+		self.stream_id = stream_id
+		self.started_at = started_at
 
-	def __init__(self, game):
-		pass
 
-	def write():
-		pass
 
-	def read():
-		pass
+class StreamCache(object):
+	"""
+	Tracks the streams for a particular game to work out which are new.
+
+	Stream IDs change each time the stream is started so streams are tracked
+	by the channel (user) ID instead, as this won't change. A stream is new
+	if the user hasn't been seen before, or if it has a different ID and the
+	user's previous stream started more than max_age hours ago.
+
+	Only a StreamRecord is kept per user, so memory doesn't grow with the
+	size of the Helix stream data.
+	"""
+	def __init__(self, game, max_age=8, streams=[]):
+		"""
+		streams is a list of cached streams, as returned by to_streams()
+		"""
+		self.game = game
+		self.max_age = max_age
+		self.changed = False
+		self._records = {}
+		self._live = set()
+
+		for stream in streams:
+			self._records[stream["user_id"]] = StreamRecord(stream["id"], parse_timestamp(stream["started_at"]))
+
+	def __len__(self):
+		return len(self._records)
+
+	def update(self, current_streams, now=None, partial=False):
+		"""
+		Takes the current streams for the game and returns the new ones. Only
+		users whose stream changed are updated.
+
+		:param now: The time of the check in seconds since the epoch
+		:param partial: current_streams are only some of the game's streams,
+		                e.g., from an EventSub stream.online event, so users
+		                missing from them may still be live
+		"""
+		if now is None:
+			now = time.time()
+
+		max_age = self.max_age * 3600
+		new_streams = []
+		live = set()
+
+		for stream in current_streams:
+			user_id = stream["user_id"]
+			live.add(user_id)
+
+			record = self._records.get(user_id)
+
+			if record is not None and record.stream_id == stream["id"]:
+				continue
+
+			started_at = parse_timestamp(stream["started_at"])
+
+			if record is None or now - record.started_at > max_age:
+				new_streams.append(stream)
+
+			self._records[user_id] = StreamRecord(stream["id"], started_at)
+			self.changed = True
+
+		if partial:
+			self._live |= live
+		else:
+			self._live = live
+
+		return new_streams
+
+	def set_offline(self, user_id):
+		"""
+		Marks a user as no longer streaming, e.g., after an EventSub
+		stream.offline event, so expire() can forget them
+		"""
+		self._live.discard(user_id)
+
+	def expire(self, now=None):
+		"""
+		Forgets users who aren't streaming and whose last stream started more
+		than max_age hours ago, in one pass over the pre-parsed start times
+		"""
+		if now is None:
+			now = time.time()
+
+		oldest = now - self.max_age * 3600
+
+		expired = [
+			user_id
+			for user_id, record
+			in self._records.items()
+			if record.started_at < oldest and user_id not in self._live
+		]
+
+		for user_id in expired:
+			del self._records[user_id]
+
+		if expired:
+			self.changed = True
+
+	def to_streams(self):
+		"""
+		Returns the tracked streams as a list of compact stream dicts for
+		the stream cache. started_at is kept in seconds since the epoch so it
+		doesn't need parsing again.
+		"""
+		return [
+			{
+				"user_id": user_id,
+				"id": record.stream_id,
+				"started_at": record.started_at,
+			}
+			for user_id, record
+			in self._records.items()
+		]
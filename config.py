@@ -1,6 +1,7 @@
 import logging
 import os
 import json
+import tempfile
 from xdg import (
 	XDG_CACHE_HOME,
 	XDG_CONFIG_HOME,
@@ -16,9 +17,30 @@ def set_logging_level(level):
 		logging.getLogger().setLevel(getattr(logging, level.upper()))
 
 
-def read_config_file(path):
+def write_json_atomic(path, data):
+	"""
+	Writes data as JSON to path via a temporary file so that other processes
+	never see a partially written file
+	"""
+	file_dir = os.path.dirname(path)
+	os.makedirs(file_dir, exist_ok=True)
+
+	fd, tmp_path = tempfile.mkstemp(dir=file_dir, prefix=".{0}.".format(os.path.basename(path)))
+	try:
+		with os.fdopen(fd, "w") as f:
+			json.dump(data, f)
+		os.replace(tmp_path, path)
+	except Exception:
+		os.unlink(tmp_path)
+		raise
+
+
+def read_config_file(path, strict=False):
 	"""
 	Takes a path to a JSON file, reads and parses it, returns as dict
+
+	:param strict: Raise an error if the file can't be parsed, instead of
+	               returning an empty dict
 	"""
 	log.debug("Looking for config '{0}'".format(path))
 
@@ -32,27 +54,46 @@ def read_config_file(path):
 				log.error("Could not read config file '{0}'".format(path))
 				log.exception(e)
 
+				if strict:
+					raise
+
 	return {}
 
 
-def get_config(args=None, appname="twitchwatch"):
-	"""
-	Reads a JSON configuration file. Searches several paths, picking the first
-	file it finds.
+# The last config read by get_config(), so it isn't searched for, read and
+# parsed on every call
+_loaded = None
 
-	:param appname: The name of the application. Used for config and runtime directory names.
-	:return: Dict with the merged set of configuration options
-	"""
-	if args:
-		# Change from an object to a dict
-		args = vars(args)
 
-		# Rename log_level back to log-level
-		args["cache-file"] = args.pop("cache_file", None)
-		args["log-level"] = args.pop("log_level", None)
-		args["max-age"] = args.pop("max_age", None)
-	else:
-		args = {}
+def _args_to_dict(args):
+	# Change from an object to a dict
+	args = dict(vars(args))
+
+	# Rename log_level back to log-level
+	args["cache-file"] = args.pop("cache_file", None)
+	args["log-level"] = args.pop("log_level", None)
+	args["max-age"] = args.pop("max_age", None)
+	args["poll-interval"] = args.pop("interval", None)
+	args["metrics-port"] = args.pop("metrics_port", None)
+	args["thin-client"] = args.pop("thin_client", None)
+
+	return args
+
+
+def _mtimes(paths):
+	mtimes = []
+
+	for path in paths:
+		try:
+			mtimes.append(os.stat(path).st_mtime_ns)
+		except OSError:
+			mtimes.append(None)
+
+	return tuple(mtimes)
+
+
+def _load(args, appname, strict=False):
+	global _loaded
 
 	# Set the logging level
 	set_logging_level(args.get("log-level"))
@@ -66,8 +107,11 @@ def get_config(args=None, appname="twitchwatch"):
 	cfg = {
 		"socket": os.path.join(run_dir, "{0}.sock".format(appname)),
 		"cache_file": os.path.join(cache_dir, "streams.json"),
+		"cache-backend": "json",
+		"cache-db": os.path.join(cache_dir, "streams.db"),
 		"log_level": "critical",
 		"max_age": 8,
+		"poll-interval": 900,
 	}
 
 	# The paths to search for the config file
@@ -79,8 +123,17 @@ def get_config(args=None, appname="twitchwatch"):
 			os.path.join(os.path.dirname(os.path.realpath(__file__)), cfg_file_name)
 		]
 
+	# Taken before reading so a change made while reading is seen next time
+	mtimes = _mtimes(cfg_paths)
+
 	for path in cfg_paths:
-		settings_from_file = read_config_file(path)
+		try:
+			settings_from_file = read_config_file(path, strict=strict)
+		except Exception:
+			# Keep the old config, and wait for the file to change again
+			_loaded["mtimes"] = mtimes
+			raise
+
 		log.debug(settings_from_file)
 
 		if settings_from_file != {}:
@@ -97,4 +150,61 @@ def get_config(args=None, appname="twitchwatch"):
 
 	log.info("Final configuration: {0}".format(cfg))
 
+	_loaded = {
+		"args": args,
+		"appname": appname,
+		"paths": cfg_paths,
+		"mtimes": mtimes,
+		"cfg": cfg,
+	}
+
 	return cfg
+
+
+def config_changed():
+	"""
+	Returns True if a config file has been changed, added or removed since
+	get_config() read it
+	"""
+	return _loaded is not None and _mtimes(_loaded["paths"]) != _loaded["mtimes"]
+
+
+def reload_config():
+	"""
+	Reads the config file again, keeping the command-line settings given to
+	get_config(). If the file can't be parsed, e.g., it's only half written,
+	the error is raised and get_config() keeps returning the old config.
+	"""
+	if _loaded is None:
+		return get_config()
+
+	return _load(_loaded["args"], _loaded["appname"], strict=True)
+
+
+def get_config(args=None, appname="twitchwatch"):
+	"""
+	Reads a JSON configuration file. Searches several paths, picking the first
+	file it finds.
+
+	The config is kept in memory: later calls without args return it, only
+	reading the file again once its mtime changes, and keep the command-line
+	settings from the first call.
+
+	:param appname: The name of the application. Used for config and runtime directory names.
+	:return: Dict with the merged set of configuration options
+	"""
+	if args:
+		return _load(_args_to_dict(args), appname)
+
+	if _loaded is None or _loaded["appname"] != appname:
+		return _load({}, appname)
+
+	if config_changed():
+		log.info("Config file changed, reloading")
+
+		try:
+			return reload_config()
+		except Exception:
+			pass
+
+	return _loaded["cfg"]
@@ -0,0 +1,376 @@
+"""
+Twitch EventSub over a WebSocket, to hear about a channel going live as soon
+as it happens instead of at the next poll.
+
+An EventSubClient subscribes to stream.online and stream.offline for a list
+of channels and calls back with each event. Twitch sends a keepalive message
+when there's nothing else to send, so a connection that has been quiet for
+longer than the keepalive timeout is assumed dead and replaced. A
+session_reconnect message moves the session to a new connection, keeping its
+subscriptions; after any other reconnect the subscriptions are made again, as
+Twitch deletes them when a connection closes.
+
+WebSocket subscriptions have to be made with a user access token, for any
+user, rather than the app access token used for everything else.
+
+Docs: https://dev.twitch.tv/docs/eventsub/handling-websocket-events
+"""
+
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+
+from client import HELIX_MAX_IDS, chunks, helix_request
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+EVENTSUB_URL = "wss://eventsub.wss.twitch.tv/ws"
+
+# Subscription type: version
+SUBSCRIPTION_TYPES = {
+	"stream.online": "1",
+	"stream.offline": "1",
+}
+
+# Message ids are remembered this long, in seconds, to drop redelivered
+# messages
+MESSAGE_ID_TTL = 600
+
+EVENTSUB_MESSAGES = metrics.counter("twitchwatch_eventsub_messages_total",
+                                    "EventSub WebSocket messages received by type",
+                                    ["type"])
+EVENTSUB_CONNECTIONS = metrics.counter("twitchwatch_eventsub_connections_total",
+                                       "EventSub WebSocket connections made, by reason",
+                                       ["reason"])
+EVENTSUB_SUBSCRIPTIONS = metrics.gauge("twitchwatch_eventsub_subscriptions",
+                                       "EventSub subscriptions on the current session")
+
+
+
+def get_user_ids(token_manager, logins):
+	"""
+	Returns a dict of login to user id for the logins Twitch knows
+
+	Docs: https://dev.twitch.tv/docs/api/reference#get-users
+	"""
+	ids = {}
+
+	for chunk in chunks([login.lower() for login in logins], HELIX_MAX_IDS):
+		response = helix_request(token_manager, "users", {"login": chunk})
+
+		for user in response["data"]:
+			ids[user["login"]] = user["id"]
+
+	return ids
+
+
+
+def stream_from_event(token_manager, event):
+	"""
+	Returns a stream, like the ones from /helix/streams, for a stream.online
+	event, with the game and title from the channel's information. The
+	stream may not be in /helix/streams yet, but the channel always is.
+	viewer_count is left out as it isn't known yet, and thumbnail_url is
+	the usual preview address for the channel.
+
+	Docs: https://dev.twitch.tv/docs/api/reference#get-channel-information
+	"""
+	response = helix_request(token_manager, "channels", {"broadcaster_id": event["broadcaster_user_id"]})
+	channel = response["data"][0] if response["data"] else {}
+
+	return {
+		"id": event["id"],
+		"user_id": event["broadcaster_user_id"],
+		"user_login": event["broadcaster_user_login"],
+		"user_name": event["broadcaster_user_name"],
+		"game_id": channel.get("game_id", ""),
+		"game_name": channel.get("game_name", ""),
+		"type": event.get("type", "live"),
+		"title": channel.get("title", ""),
+		"started_at": event["started_at"],
+		"language": channel.get("broadcaster_language", ""),
+		"thumbnail_url": "https://static-cdn.jtvnw.net/previews-ttv/live_user_{0}-{{width}}x{{height}}.jpg".format(
+			event["broadcaster_user_login"]),
+	}
+
+
+
+class EventSubClient(object):
+	"""
+	:param token_manager: The AppTokenManager for looking up channels, and
+	                      whose client id the subscriptions are made for
+	:param user_token: A user access token for making the subscriptions
+	:param channels: Logins of the channels to subscribe to
+	:param on_online: Coroutine function called with each stream.online event
+	:param on_offline: Coroutine function called with each stream.offline
+	                   event
+	:param keepalive_margin: Seconds to wait past the keepalive timeout
+	                         before reconnecting
+	:param retry_delay: Seconds to wait before the first reconnect after a
+	                    failure, doubling up to max_retry_delay
+	"""
+	def __init__(self, token_manager, user_token, channels, on_online, on_offline=None, url=EVENTSUB_URL,
+	             keepalive_margin=5, retry_delay=1, max_retry_delay=300):
+		self.log = logging.getLogger("EventSubClient")
+
+		self.token_manager = token_manager
+		self.channels = list(channels)
+		self.url = url
+		self.keepalive_margin = keepalive_margin
+		self.retry_delay = retry_delay
+		self.max_retry_delay = max_retry_delay
+		self._user_token = user_token
+		self._on_online = on_online
+		self._on_offline = on_offline
+		self._websocket = None
+		self._seen = {}
+
+		self.session_id = None
+		# Subscription id: (type, user id)
+		self.subscriptions = {}
+
+	async def run(self):
+		"""
+		Connects, subscribes and passes events on until cancelled. Failed
+		connections are retried with a jittered, growing delay.
+		"""
+		delay = self.retry_delay
+		reason = "start"
+
+		while True:
+			try:
+				EVENTSUB_CONNECTIONS.inc(reason=reason)
+				self._websocket, session = await self._connect(self.url)
+
+				try:
+					await self._subscribe(session["id"])
+					delay = self.retry_delay
+					await self._receive(session)
+				finally:
+					await self._websocket.close()
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				self.log.error("EventSub connection failed")
+				self.log.exception(e)
+
+			self.session_id = None
+			self.subscriptions = {}
+			EVENTSUB_SUBSCRIPTIONS.set(0)
+
+			wait = delay * random.uniform(0.5, 1)
+			self.log.info("Reconnecting in {0:.1f} seconds".format(wait))
+			await asyncio.sleep(wait)
+
+			delay = min(delay * 2, self.max_retry_delay)
+			reason = "lost"
+
+	async def _connect(self, url):
+		"""
+		Opens a connection and waits for its session_welcome message.
+		Returns the connection and the welcome's session.
+		"""
+		# Only needed by the daemon, and only with eventsub-channels
+		from websockets.asyncio.client import connect
+
+		self.log.info("Connecting to {0}".format(url))
+
+		# Twitch sends keepalive messages instead of answering pings
+		websocket = await connect(url, ping_interval=None)
+
+		try:
+			message = json.loads(await asyncio.wait_for(websocket.recv(), 10 + self.keepalive_margin))
+		except BaseException:
+			await websocket.close()
+			raise
+
+		if message.get("metadata", {}).get("message_type") != "session_welcome":
+			await websocket.close()
+			raise ConnectionError("Expected a session_welcome message, got {0}".format(message))
+
+		EVENTSUB_MESSAGES.inc(type="session_welcome")
+
+		session = message["payload"]["session"]
+		self.session_id = session["id"]
+		self.log.info("EventSub session {0}".format(session["id"]))
+
+		return websocket, session
+
+	async def _subscribe(self, session_id):
+		"""
+		Subscribes to every subscription type for every channel. Twitch
+		closes a connection that has no subscriptions ten seconds after the
+		welcome, so the requests are made at once.
+		"""
+		user_ids = await asyncio.to_thread(get_user_ids, self.token_manager, self.channels)
+
+		for login in self.channels:
+			if login.lower() not in user_ids:
+				self.log.warning("Could not find a channel called {0}".format(login))
+
+		wanted = [
+			(subscription_type, version, user_id)
+			for user_id in user_ids.values()
+			for subscription_type, version in SUBSCRIPTION_TYPES.items()
+		]
+
+		results = await asyncio.gather(*[
+			asyncio.to_thread(self._create_subscription, session_id, *request)
+			for request
+			in wanted
+		], return_exceptions=True)
+
+		for (subscription_type, version, user_id), result in zip(wanted, results):
+			if isinstance(result, Exception):
+				self.log.error("Could not subscribe to {0} for {1}: {2}".format(subscription_type, user_id, result))
+				continue
+
+			self.subscriptions[result["id"]] = (subscription_type, user_id)
+
+		EVENTSUB_SUBSCRIPTIONS.set(len(self.subscriptions))
+		self.log.info("{0} subscriptions on session {1}".format(len(self.subscriptions), session_id))
+
+		if wanted and not self.subscriptions:
+			raise ConnectionError("Could not make any subscriptions")
+
+	def _create_subscription(self, session_id, subscription_type, version, user_id):
+		"""
+		Docs: https://dev.twitch.tv/docs/api/reference#create-eventsub-subscription
+		"""
+		response = helix_request(self.token_manager, "eventsub/subscriptions", data={
+			"type": subscription_type,
+			"version": version,
+			"condition": {"broadcaster_user_id": user_id},
+			"transport": {"method": "websocket", "session_id": session_id},
+		}, token=self._user_token)
+
+		return response["data"][0]
+
+	def _is_duplicate(self, message_id):
+		"""
+		Returns True if the message id has been seen before, remembering it
+		if not
+		"""
+		now = time.monotonic()
+
+		if len(self._seen) > 1000:
+			self._seen = {k: t for k, t in self._seen.items() if now - t < MESSAGE_ID_TTL}
+
+		if message_id in self._seen:
+			return True
+
+		self._seen[message_id] = now
+		return False
+
+	async def _receive(self, session):
+		"""
+		Handles messages until the connection is closed or goes quiet. A
+		session_reconnect message replaces self._websocket.
+		"""
+		keepalive = session.get("keepalive_timeout_seconds") or 10
+
+		while True:
+			try:
+				raw = await asyncio.wait_for(self._websocket.recv(), keepalive + self.keepalive_margin)
+			except asyncio.TimeoutError:
+				self.log.warning("No message for {0} seconds, reconnecting".format(keepalive + self.keepalive_margin))
+				return
+
+			message = json.loads(raw)
+			metadata = message.get("metadata", {})
+			message_type = metadata.get("message_type", "unknown")
+
+			EVENTSUB_MESSAGES.inc(type=message_type)
+
+			if self._is_duplicate(metadata.get("message_id")):
+				self.log.debug("Dropping redelivered message {0}".format(metadata.get("message_id")))
+				continue
+
+			if message_type == "session_keepalive":
+				continue
+			elif message_type == "notification":
+				await self._notify(message["payload"])
+			elif message_type == "session_reconnect":
+				reconnect_url = message["payload"]["session"]["reconnect_url"]
+				self.log.info("Moving to {0}".format(reconnect_url))
+
+				# The new connection keeps the subscriptions, so the old one
+				# is only closed once it has been welcomed
+				EVENTSUB_CONNECTIONS.inc(reason="reconnect")
+				websocket, session = await self._connect(reconnect_url)
+				await self._websocket.close()
+
+				self._websocket = websocket
+				keepalive = session.get("keepalive_timeout_seconds") or keepalive
+			elif message_type == "revocation":
+				subscription = message["payload"]["subscription"]
+				self.log.warning("Twitch revoked the {0} subscription for {1}: {2}".format(
+					subscription["type"], subscription["condition"].get("broadcaster_user_id"), subscription["status"]))
+
+				self.subscriptions.pop(subscription["id"], None)
+				EVENTSUB_SUBSCRIPTIONS.set(len(self.subscriptions))
+			else:
+				self.log.warning("Unexpected message {0}".format(message))
+
+	async def _notify(self, payload):
+		subscription_type = payload["subscription"]["type"]
+		event = payload["event"]
+
+		self.log.info("{0}: {1}".format(subscription_type, event.get("broadcaster_user_login")))
+
+		callback = None
+		if subscription_type == "stream.online":
+			callback = self._on_online
+		elif subscription_type == "stream.offline":
+			callback = self._on_offline
+
+		if callback is None:
+			return
+
+		try:
+			await callback(event)
+		except Exception as e:
+			self.log.error("Could not handle {0} for {1}".format(subscription_type, event.get("broadcaster_user_login")))
+			self.log.exception(e)
+
+
+
+class EventSubThread(object):
+	"""
+	Runs an EventSubClient on its own event loop in a background thread, for
+	the streams.py daemon, which doesn't use asyncio
+	"""
+	def __init__(self, client):
+		self.client = client
+		self._thread = None
+		self._loop = None
+		self._task = None
+		self._started = threading.Event()
+
+	def start(self):
+		self._thread = threading.Thread(target=asyncio.run, args=(self._main(),), name="eventsub", daemon=True)
+		self._thread.start()
+		self._started.wait()
+
+	async def _main(self):
+		self._loop = asyncio.get_running_loop()
+		self._task = asyncio.current_task()
+		self._started.set()
+
+		try:
+			await self.client.run()
+		except asyncio.CancelledError:
+			pass
+
+	def stop(self, timeout=10):
+		if self._thread is None:
+			return
+
+		self._loop.call_soon_threadsafe(self._task.cancel)
+		self._thread.join(timeout)
+		self._thread = None
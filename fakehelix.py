@@ -0,0 +1,704 @@
+#!/usr/bin/env python3
+"""
+A stand-in for the Twitch Helix API, for testing and benchmarking twitchwatch
+without a network connection.
+
+Point twitchwatch at it with these settings in config.json:
+
+	"api-url": "http://127.0.0.1:8080/helix",
+	"auth-url": "http://127.0.0.1:8080/oauth2/token"
+
+With --eventsub-port it also serves EventSub over a WebSocket, at
+ws://127.0.0.1:<port>/ws, and subscribed channels go live and offline at
+random.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LOG_FORMAT = "%(asctime)s — %(name)s — %(levelname)s — %(message)s"
+log = logging.getLogger("fakehelix")
+
+
+
+class FakeTwitch(object):
+	"""
+	The streams, tokens and rate limit served by FakeHelixServer.
+
+	Every churn_interval seconds a churn fraction of each game's streams end
+	and are replaced by new ones, half from new users and half from the same
+	user starting a new stream.
+	"""
+	def __init__(self, games=10, streams=100, churn=0.05, churn_interval=1.0,
+	             rate_limit=800, token_expiry=3600, seed=None):
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+		self._next_id = 1
+
+		self.churn = churn
+		self.churn_interval = churn_interval
+		self.token_expiry = token_expiry
+		self._last_churn = time.monotonic()
+
+		# Rate limit bucket, refilled every minute like Helix
+		self.rate_limit = rate_limit
+		self._remaining = rate_limit
+		self._reset_at = time.time() + 60
+
+		self.tokens = {}
+
+		# User id: channel information, as returned by /helix/channels
+		self.channels = {}
+
+		self.games = [
+			{"id": str(100000 + i), "name": "Game {0}".format(i), "box_art_url": ""}
+			for i in range(games)
+		]
+		self._games_by_name = {game["name"].lower(): game for game in self.games}
+		self.streams = {
+			game["id"]: [self._new_stream(game) for _ in range(streams)]
+			for game in self.games
+		}
+
+	def _new_id(self):
+		self._next_id += 1
+		return str(self._next_id)
+
+	def _new_stream(self, game, user_id=None):
+		if user_id is None:
+			user_id = self._new_id()
+
+		self.channels[user_id] = {
+			"broadcaster_id": user_id,
+			"broadcaster_login": "user{0}".format(user_id),
+			"broadcaster_name": "User{0}".format(user_id),
+			"broadcaster_language": self._random.choice(["en", "en", "de", "fr", "es"]),
+			"game_id": game["id"],
+			"game_name": game["name"],
+			"title": "Playing {0} with user {1}".format(game["name"], user_id),
+		}
+
+		return {
+			"id": self._new_id(),
+			"user_id": user_id,
+			"user_login": "user{0}".format(user_id),
+			"user_name": "User{0}".format(user_id),
+			"game_id": game["id"],
+			"game_name": game["name"],
+			"type": "live",
+			"title": self.channels[user_id]["title"],
+			"viewer_count": self._random.randint(0, 10000),
+			"started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+			"language": self.channels[user_id]["broadcaster_language"],
+			"thumbnail_url": "https://static-cdn.jtvnw.net/previews-ttv/live_user_user{0}-{{width}}x{{height}}.jpg".format(user_id),
+			"tag_ids": [],
+		}
+
+	def _apply_churn(self):
+		ticks = int((time.monotonic() - self._last_churn) / self.churn_interval)
+
+		if ticks < 1 or self.churn <= 0:
+			return
+
+		self._last_churn += ticks * self.churn_interval
+
+		for game in self.games:
+			streams = self.streams[game["id"]]
+			count = min(len(streams), int(round(len(streams) * self.churn * ticks)))
+
+			for i in self._random.sample(range(len(streams)), count):
+				# Half the replacements are returning users
+				user_id = streams[i]["user_id"] if self._random.random() < 0.5 else None
+				streams[i] = self._new_stream(game, user_id)
+
+	def new_token(self):
+		with self._lock:
+			token = uuid.uuid4().hex
+			self.tokens[token] = time.time() + self.token_expiry
+			return token
+
+	def check_token(self, token):
+		with self._lock:
+			return self.tokens.get(token, 0) > time.time()
+
+	def take_rate_limit(self):
+		"""
+		Takes a request from the rate limit bucket. Returns the Ratelimit-*
+		headers and whether the request is allowed.
+		"""
+		with self._lock:
+			now = time.time()
+			if now >= self._reset_at:
+				self._remaining = self.rate_limit
+				self._reset_at = now + 60
+
+			allowed = self._remaining > 0
+			if allowed:
+				self._remaining -= 1
+
+			headers = {
+				"Ratelimit-Limit": str(self.rate_limit),
+				"Ratelimit-Remaining": str(self._remaining),
+				"Ratelimit-Reset": str(int(self._reset_at)),
+			}
+
+			return headers, allowed
+
+	def get_games(self, names):
+		return [
+			self._games_by_name[name.lower()]
+			for name
+			in names
+			if name.lower() in self._games_by_name
+		]
+
+	def get_users(self, logins):
+		"""
+		Every login like "user123" exists, with the id 123
+		"""
+		users = []
+
+		for login in logins:
+			match = re.match(r"^user(\d+)$", login.lower())
+
+			if match:
+				users.append({
+					"id": match.group(1),
+					"login": login.lower(),
+					"display_name": "User{0}".format(match.group(1)),
+					"type": "",
+					"broadcaster_type": "",
+				})
+
+		return users
+
+	def get_channels(self, user_ids):
+		with self._lock:
+			return [self.channels[user_id] for user_id in user_ids if user_id in self.channels]
+
+	def set_live(self, user_id, live):
+		"""
+		Starts a stream of a random game for the user, or ends the user's
+		streams. Returns the new stream, or None.
+		"""
+		with self._lock:
+			for game_id, streams in self.streams.items():
+				self.streams[game_id] = [stream for stream in streams if stream["user_id"] != user_id]
+
+			if not live:
+				return None
+
+			game = self._random.choice(self.games)
+			stream = self._new_stream(game, user_id)
+			self.streams[game["id"]].append(stream)
+
+			return stream
+
+	def get_streams(self, game_ids, first=20, after=None):
+		"""
+		Returns a page of streams for the game ids, busiest first, and the
+		cursor for the next page
+		"""
+		with self._lock:
+			self._apply_churn()
+
+			streams = []
+			for game_id in game_ids:
+				streams += self.streams.get(game_id, [])
+
+		streams.sort(key=lambda stream: (-stream["viewer_count"], stream["id"]))
+
+		offset = int(base64.urlsafe_b64decode(after).decode()) if after else 0
+		page = streams[offset:offset + first]
+
+		cursor = None
+		if offset + first < len(streams):
+			cursor = base64.urlsafe_b64encode(str(offset + first).encode()).decode()
+
+		return page, cursor
+
+
+
+class FakeHelixHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	# The headers and body are written separately, which stalls kept-alive
+	# connections on delayed ACKs unless Nagle's algorithm is off
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		log.debug(format % args)
+
+	def _send_json(self, status, data, headers={}):
+		body = bytes(json.dumps(data), "utf-8")
+
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		for k, v in headers.items():
+			self.send_header(k, v)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _inject_faults(self):
+		"""
+		Adds the configured latency and returns an error status to send
+		instead of a real response, if one was picked
+		"""
+		server = self.server
+
+		if server.latency:
+			time.sleep(server.latency)
+
+		if server.error_rate:
+			return server.pick_error()
+
+		return None
+
+	def do_POST(self):
+		url = urllib.parse.urlsplit(self.path)
+
+		# Read the form body so the connection can be reused
+		length = int(self.headers.get("Content-Length", 0))
+		body = self.rfile.read(length)
+
+		if url.path == "/helix/eventsub/subscriptions" and self.server.eventsub is not None:
+			# Any token will do, as a real one would be a user access token
+			try:
+				status, data = self.server.eventsub.subscribe(json.loads(body))
+			except (ValueError, KeyError):
+				status, data = 400, {"error": "Bad Request", "status": 400}
+
+			self._send_json(status, data)
+			return
+
+		if url.path != "/oauth2/token":
+			self._send_json(404, {"error": "Not Found", "status": 404})
+			return
+
+		error = self._inject_faults()
+		if error:
+			self._send_json(error, {"error": "Injected", "status": error})
+			return
+
+		self._send_json(200, {
+			"access_token": self.server.twitch.new_token(),
+			"expires_in": self.server.twitch.token_expiry,
+			"token_type": "bearer",
+		})
+
+	def do_GET(self):
+		url = urllib.parse.urlsplit(self.path)
+		query = urllib.parse.parse_qs(url.query)
+		twitch = self.server.twitch
+
+		if url.path not in ("/helix/games", "/helix/streams", "/helix/users", "/helix/channels"):
+			self._send_json(404, {"error": "Not Found", "status": 404})
+			return
+
+		token = self.headers.get("Authorization", "").replace("Bearer ", "", 1)
+		if not twitch.check_token(token):
+			self._send_json(401, {"error": "Unauthorized", "status": 401, "message": "Invalid OAuth token"})
+			return
+
+		headers, allowed = twitch.take_rate_limit()
+
+		if not allowed:
+			self._send_json(429, {"error": "Too Many Requests", "status": 429}, headers)
+			return
+
+		error = self._inject_faults()
+		if error:
+			self._send_json(error, {"error": "Injected", "status": error}, headers)
+			return
+
+		if url.path == "/helix/games":
+			self._send_json(200, {"data": twitch.get_games(query.get("name", []))}, headers)
+		elif url.path == "/helix/users":
+			self._send_json(200, {"data": twitch.get_users(query.get("login", []))}, headers)
+		elif url.path == "/helix/channels":
+			self._send_json(200, {"data": twitch.get_channels(query.get("broadcaster_id", []))}, headers)
+		else:
+			first = min(int(query.get("first", ["20"])[0]), 100)
+			after = query.get("after", [None])[0]
+			page, cursor = twitch.get_streams(query.get("game_id", []), first, after)
+
+			self._send_json(200, {
+				"data": page,
+				"pagination": {"cursor": cursor} if cursor else {},
+			}, headers)
+
+
+
+class FakeEventSub(object):
+	"""
+	Serves EventSub over a WebSocket at ws://host:port/ws, with the
+	subscriptions made through FakeHelixServer.
+
+	Sessions get a keepalive message after keepalive seconds without any
+	other message. Every churn_interval seconds each subscribed channel goes
+	live or offline with a chance of churn, and every reconnect_interval
+	seconds, if set, each session is asked to move to a new connection.
+	"""
+	# The most subscriptions Twitch allows on one WebSocket session
+	MAX_TOTAL_COST = 10
+
+	def __init__(self, twitch, host="127.0.0.1", port=8081, keepalive=10, churn=0.05, churn_interval=1.0,
+	             reconnect_interval=None, seed=None):
+		self.twitch = twitch
+		self.host = host
+		self.port = port
+		self.keepalive = keepalive
+		self.churn = churn
+		self.churn_interval = churn_interval
+		self.reconnect_interval = reconnect_interval
+		self._lock = threading.Lock()
+		self._loop = None
+		self._server = None
+		self._random = random.Random(seed)
+		self._started = threading.Event()
+
+		# Session id: {"websocket": ..., "subscriptions": {id: subscription}}
+		self.sessions = {}
+		self.live = set()
+
+	@property
+	def url(self):
+		return "ws://{0}:{1}/ws".format(self.host, self.port)
+
+	def subscribe(self, data):
+		"""
+		Adds a subscription to a session, for POST /helix/eventsub/subscriptions.
+		Returns the HTTP status and response.
+		"""
+		session_id = data["transport"]["session_id"]
+
+		with self._lock:
+			session = self.sessions.get(session_id)
+
+			if data["transport"].get("method") != "websocket" or session is None:
+				return 400, {"error": "Bad Request", "status": 400, "message": "session does not exist"}
+
+			for subscription in session["subscriptions"].values():
+				if subscription["type"] == data["type"] and subscription["condition"] == data["condition"]:
+					return 409, {"error": "Conflict", "status": 409, "message": "subscription already exists"}
+
+			if len(session["subscriptions"]) >= self.MAX_TOTAL_COST:
+				return 429, {"error": "Too Many Requests", "status": 429, "message": "websocket transport cost exceeded"}
+
+			subscription = {
+				"id": str(uuid.uuid4()),
+				"status": "enabled",
+				"type": data["type"],
+				"version": data["version"],
+				"condition": data["condition"],
+				"transport": {"method": "websocket", "session_id": session_id},
+				"created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+				"cost": 1,
+			}
+			session["subscriptions"][subscription["id"]] = subscription
+			total = len(session["subscriptions"])
+
+		return 202, {"data": [subscription], "total": total, "total_cost": total, "max_total_cost": self.MAX_TOTAL_COST}
+
+	def _message(self, message_type, payload, subscription=None):
+		metadata = {
+			"message_id": str(uuid.uuid4()),
+			"message_type": message_type,
+			"message_timestamp": time.strftime("%Y-%m-%dT%H:%M:%S.000000000Z", time.gmtime()),
+		}
+
+		if subscription is not None:
+			metadata["subscription_type"] = subscription["type"]
+			metadata["subscription_version"] = subscription["version"]
+
+		return json.dumps({"metadata": metadata, "payload": payload})
+
+	def _session(self, session_id, reconnect_url=None):
+		return {
+			"id": session_id,
+			"status": "reconnecting" if reconnect_url else "connected",
+			"keepalive_timeout_seconds": None if reconnect_url else self.keepalive,
+			"reconnect_url": reconnect_url,
+			"connected_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+		}
+
+	async def _handle(self, websocket):
+		"""
+		Welcomes a connection, to a new session or, from a reconnect URL, to
+		the session it is replacing, then sends keepalives until it closes
+		"""
+		query = urllib.parse.parse_qs(urllib.parse.urlsplit(websocket.request.path).query)
+		session_id = query.get("session", [None])[0]
+
+		with self._lock:
+			session = self.sessions.get(session_id)
+
+			if session is None:
+				session_id = str(uuid.uuid4())
+				session = self.sessions[session_id] = {"subscriptions": {}}
+
+			session["websocket"] = websocket
+			session["sent_at"] = time.monotonic()
+
+		log.info("EventSub session {0}".format(session_id))
+		await websocket.send(self._message("session_welcome", {"session": self._session(session_id)}))
+
+		try:
+			while True:
+				try:
+					await asyncio.wait_for(websocket.recv(), self.keepalive / 2)
+				except asyncio.TimeoutError:
+					pass
+
+				with self._lock:
+					current = session.get("websocket") is websocket
+					quiet = time.monotonic() - session["sent_at"] >= self.keepalive
+
+				if not current:
+					# Moved to a new connection; the client closes this one
+					continue
+
+				if quiet:
+					session["sent_at"] = time.monotonic()
+					await websocket.send(self._message("session_keepalive", {}))
+		except Exception:
+			pass
+		finally:
+			with self._lock:
+				# Twitch deletes the subscriptions when a connection closes,
+				# unless the session moved to a new one
+				if self.sessions.get(session_id) is session and session.get("websocket") is websocket:
+					del self.sessions[session_id]
+
+			log.info("EventSub session {0} closed".format(session_id))
+
+	async def _send(self, session, message):
+		session["sent_at"] = time.monotonic()
+
+		try:
+			await session["websocket"].send(message)
+		except Exception as e:
+			log.debug("Could not send to an EventSub session: {0}".format(e))
+
+	async def _churn(self):
+		while True:
+			await asyncio.sleep(self.churn_interval)
+
+			with self._lock:
+				sessions = list(self.sessions.values())
+
+			for session in sessions:
+				subscriptions = list(session["subscriptions"].values())
+				user_ids = set(subscription["condition"]["broadcaster_user_id"] for subscription in subscriptions)
+
+				for user_id in user_ids:
+					if self._random.random() >= self.churn:
+						continue
+
+					live = user_id not in self.live
+					stream = self.twitch.set_live(user_id, live)
+
+					if live:
+						self.live.add(user_id)
+						subscription_type = "stream.online"
+						event = {"id": stream["id"], "type": "live", "started_at": stream["started_at"]}
+					else:
+						self.live.discard(user_id)
+						subscription_type = "stream.offline"
+						event = {}
+
+					event.update({
+						"broadcaster_user_id": user_id,
+						"broadcaster_user_login": "user{0}".format(user_id),
+						"broadcaster_user_name": "User{0}".format(user_id),
+					})
+
+					for subscription in subscriptions:
+						if subscription["type"] == subscription_type \
+						   and subscription["condition"]["broadcaster_user_id"] == user_id:
+							await self._send(session, self._message("notification", {
+								"subscription": subscription,
+								"event": event,
+							}, subscription))
+
+	async def _reconnect(self):
+		while True:
+			await asyncio.sleep(self.reconnect_interval)
+
+			with self._lock:
+				sessions = list(self.sessions.items())
+
+			for session_id, session in sessions:
+				reconnect_url = "{0}?session={1}".format(self.url, session_id)
+				await self._send(session, self._message("session_reconnect", {
+					"session": self._session(session_id, reconnect_url),
+				}))
+
+	async def _serve(self):
+		from websockets.asyncio.server import serve
+
+		self._loop = asyncio.get_running_loop()
+
+		async with serve(self._handle, self.host, self.port) as server:
+			self._server = server
+			self.port = server.sockets[0].getsockname()[1]
+			self._started.set()
+
+			tasks = [asyncio.create_task(self._churn())]
+			if self.reconnect_interval:
+				tasks.append(asyncio.create_task(self._reconnect()))
+
+			await server.serve_forever()
+
+	def start(self):
+		"""
+		Serves connections in a background thread
+		"""
+		thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+		thread.start()
+		self._started.wait()
+		return thread
+
+
+
+class FakeHelixServer(ThreadingHTTPServer):
+	"""
+	Serves /oauth2/token, /helix/games, /helix/streams, /helix/users,
+	/helix/channels and, with an eventsub, /helix/eventsub/subscriptions from
+	a FakeTwitch.
+
+	latency is added to every response, in seconds, and error_rate is the
+	fraction of requests that fail with one of error_statuses, picked with
+	seed so a run's errors can be repeated.
+	"""
+	daemon_threads = True
+
+	def __init__(self, address, twitch, latency=0, error_rate=0, error_statuses=(429, 500, 503), eventsub=None,
+	             seed=None):
+		super().__init__(address, FakeHelixHandler)
+		self.twitch = twitch
+		self.latency = latency
+		self.error_rate = error_rate
+		self.error_statuses = error_statuses
+		self.eventsub = eventsub
+		self._random = random.Random(seed)
+		self._random_lock = threading.Lock()
+
+	def pick_error(self):
+		"""
+		Returns an error status for a request to fail with, or None
+		"""
+		with self._random_lock:
+			if self._random.random() < self.error_rate:
+				return self._random.choice(self.error_statuses)
+
+		return None
+
+	@property
+	def url(self):
+		host, port = self.server_address[:2]
+		return "http://{0}:{1}".format(host, port)
+
+	def config(self):
+		"""
+		Returns the config settings that point twitchwatch at this server
+		"""
+		cfg = {
+			"client-id": "fakehelix",
+			"client-secret": "fakehelix",
+			"api-url": self.url + "/helix",
+			"auth-url": self.url + "/oauth2/token",
+		}
+
+		if self.eventsub is not None:
+			cfg["eventsub-url"] = self.eventsub.url
+			cfg["eventsub-token"] = "fakehelix"
+
+		return cfg
+
+	def start(self):
+		"""
+		Serves requests in a background thread
+		"""
+		thread = threading.Thread(target=self.serve_forever, daemon=True)
+		thread.start()
+		return thread
+
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="A stand-in for the Twitch Helix API")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--games", type=int, default=10,
+	                    help="Number of games, named \"Game 0\", \"Game 1\", etc. Default: 10")
+	parser.add_argument("--streams", type=int, default=100,
+	                    help="Number of streams per game. Default: 100")
+	parser.add_argument("--churn", type=float, default=0.05,
+	                    help="Fraction of each game's streams replaced every churn interval. Default: 0.05")
+	parser.add_argument("--churn-interval", type=float, default=1.0,
+	                    help="Seconds between churns. Default: 1")
+	parser.add_argument("--latency", type=float, default=0,
+	                    help="Seconds added to every response. Default: 0")
+	parser.add_argument("--error-rate", type=float, default=0,
+	                    help="Fraction of requests that fail with a 429, 500 or 503. Default: 0")
+	parser.add_argument("--rate-limit", type=int, default=800,
+	                    help="Requests allowed per minute. Default: 800")
+	parser.add_argument("--seed", type=int, default=None,
+	                    help="Random seed for reproducible streams, errors and EventSub churn")
+	parser.add_argument("--eventsub-port", type=int, default=None,
+	                    help="Serve EventSub over a WebSocket on this port. Default: off")
+	parser.add_argument("--eventsub-keepalive", type=int, default=10,
+	                    help="Seconds between EventSub keepalive messages. Default: 10")
+	parser.add_argument("--eventsub-churn", type=float, default=0.05,
+	                    help="Chance of each subscribed channel going live or offline every churn interval. Default: 0.05")
+	parser.add_argument("--eventsub-reconnect-interval", type=float, default=None,
+	                    help="Seconds between asking EventSub sessions to reconnect. Default: never")
+	parser.add_argument("--log-level", default="info")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=getattr(logging, args.log_level.upper()), format=LOG_FORMAT)
+
+	twitch = FakeTwitch(games=args.games,
+	                    streams=args.streams,
+	                    churn=args.churn,
+	                    churn_interval=args.churn_interval,
+	                    rate_limit=args.rate_limit,
+	                    seed=args.seed)
+	eventsub = None
+	if args.eventsub_port is not None:
+		eventsub = FakeEventSub(twitch,
+		                        host=args.host,
+		                        port=args.eventsub_port,
+		                        keepalive=args.eventsub_keepalive,
+		                        churn=args.eventsub_churn,
+		                        churn_interval=args.churn_interval,
+		                        reconnect_interval=args.eventsub_reconnect_interval,
+		                        seed=args.seed)
+		eventsub.start()
+
+	server = FakeHelixServer((args.host, args.port), twitch,
+	                         latency=args.latency,
+	                         error_rate=args.error_rate,
+	                         eventsub=eventsub,
+	                         seed=args.seed)
+
+	log.info("Serving on {0}".format(server.url))
+	log.info(json.dumps(server.config()))
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
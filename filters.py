@@ -0,0 +1,207 @@
+"""
+Decides which streams get broadcast.
+
+A StreamFilter is compiled once from its settings, e.g., the config's
+"filter" object,
+
+	{
+		"blacklist": ["somechannel"],
+		"allowlist": [],
+		"games": ["My Game"],
+		"languages": ["en"],
+		"min-viewers": 5,
+		"title-include": ["speedrun", "any%"],
+		"title-exclude": ["rerun"]
+	}
+
+so checking a stream is a few set lookups and at most two regex searches,
+however long the lists are. Empty settings don't filter anything. A
+pattern's leading inline flags, e.g., "(?s)", only apply to that pattern.
+"""
+
+import logging
+import re
+
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+STREAMS_FILTERED = metrics.counter("twitchwatch_streams_filtered_total",
+                                   "Streams left out by a filter before broadcasting",
+                                   ["filter"])
+
+
+
+def _lower_set(values):
+	return frozenset(str(value).lower() for value in values or ())
+
+
+# Inline flags at the start of a pattern, e.g., "(?i)"
+_LEADING_FLAGS = re.compile(r"^\(\?([aiLmsux]+)\)")
+
+
+def _title_group(pattern):
+	"""
+	Returns the pattern as a group that can be joined with others. Leading
+	inline flags are scoped to the group, as flags for the whole expression
+	are only allowed at its start.
+
+	:raises ValueError: If the pattern isn't a valid regex
+	"""
+	try:
+		re.compile(pattern, re.IGNORECASE)
+	except re.error as e:
+		raise ValueError("Bad title pattern {0!r}: {1}".format(pattern, e)) from e
+
+	flags = _LEADING_FLAGS.match(pattern)
+
+	if flags is not None:
+		return "(?{0}:{1})".format(flags.group(1), pattern[flags.end():])
+
+	return "(?:{0})".format(pattern)
+
+
+def _compile_titles(patterns):
+	"""
+	Returns one regex matching any of the patterns, or None if there are none
+	"""
+	if not patterns:
+		return None
+
+	if isinstance(patterns, str):
+		patterns = [patterns]
+
+	return re.compile("|".join(_title_group(pattern) for pattern in patterns), re.IGNORECASE)
+
+
+
+class StreamFilter(object):
+	"""
+	:param blacklist: Channels (login or display name) to leave out
+	:param allowlist: If not empty, only these channels are kept
+	:param games: If not empty, only streams of these games (names or ids)
+	              are kept
+	:param languages: If not empty, only streams in these languages are kept
+	:param min_viewers: Streams with fewer viewers are left out
+	:param title_include: If not empty, a title has to match one of these
+	                      regexes
+	:param title_exclude: Streams whose title matches one of these regexes
+	                      are left out
+	:param name: Labels the filter's metrics
+	"""
+	def __init__(self, blacklist=(), allowlist=(), games=(), languages=(), min_viewers=0,
+	             title_include=(), title_exclude=(), name="global"):
+		self.name = name
+		self._blacklist = _lower_set(blacklist)
+		self._allowlist = _lower_set(allowlist)
+		self._games = _lower_set(games)
+		self._languages = _lower_set(languages)
+		self._min_viewers = int(min_viewers or 0)
+		self._title_include = _compile_titles(title_include)
+		self._title_exclude = _compile_titles(title_exclude)
+
+	@classmethod
+	def from_config(cls, settings, name="global", **extra):
+		"""
+		Compiles a filter from a config "filter" object. extra adds lists to
+		the settings, e.g., blacklist=cfg["blacklist"] for the old top-level
+		"blacklist" setting.
+		"""
+		settings = dict(settings or {})
+
+		for key, values in extra.items():
+			if values:
+				key = key.replace("_", "-")
+				settings[key] = list(settings.get(key, [])) + list(values)
+
+		return cls(blacklist=settings.get("blacklist", ()),
+		           allowlist=settings.get("allowlist", ()),
+		           games=settings.get("games", ()),
+		           languages=settings.get("languages", ()),
+		           min_viewers=settings.get("min-viewers", 0),
+		           title_include=settings.get("title-include", ()),
+		           title_exclude=settings.get("title-exclude", ()),
+		           name=name)
+
+	def __repr__(self):
+		return "<StreamFilter {0}>".format(self.name)
+
+	@property
+	def empty(self):
+		"""
+		True if the filter keeps every stream
+		"""
+		return not (self._blacklist or self._allowlist or self._games or self._languages or self._min_viewers
+		            or self._title_include is not None or self._title_exclude is not None)
+
+	def matches(self, stream):
+		"""
+		Returns True if the stream should be broadcast
+		"""
+		if self._blacklist or self._allowlist:
+			login = stream.get("user_login", "").lower()
+			user_name = stream.get("user_name", "").lower()
+
+			if login in self._blacklist or user_name in self._blacklist:
+				return False
+
+			if self._allowlist and login not in self._allowlist and user_name not in self._allowlist:
+				return False
+
+		if self._games and stream.get("game_name", "").lower() not in self._games \
+		   and str(stream.get("game_id", "")) not in self._games:
+			return False
+
+		if self._languages and stream.get("language", "").lower() not in self._languages:
+			return False
+
+		# Streams from EventSub events don't have a viewer count yet
+		if self._min_viewers and stream.get("viewer_count", self._min_viewers) < self._min_viewers:
+			return False
+
+		if self._title_include is not None and not self._title_include.search(stream.get("title", "")):
+			return False
+
+		if self._title_exclude is not None and self._title_exclude.search(stream.get("title", "")):
+			return False
+
+		return True
+
+	def filter(self, streams):
+		"""
+		Returns the streams that should be broadcast
+		"""
+		if self.empty:
+			return streams
+
+		kept = [stream for stream in streams if self.matches(stream)]
+
+		if len(kept) < len(streams):
+			log.debug("{0}: left out {1} of {2} streams".format(self.name, len(streams) - len(kept), len(streams)))
+			STREAMS_FILTERED.inc(len(streams) - len(kept), filter=self.name)
+
+		return kept
+
+
+
+class FilterChain(object):
+	"""
+	Keeps the streams every one of its filters keeps, e.g., the global
+	filter and a broadcaster's own
+	"""
+	def __init__(self, filters):
+		self.filters = [stream_filter for stream_filter in filters if stream_filter is not None and not stream_filter.empty]
+
+	@property
+	def empty(self):
+		return not self.filters
+
+	def matches(self, stream):
+		return all(stream_filter.matches(stream) for stream_filter in self.filters)
+
+	def filter(self, streams):
+		for stream_filter in self.filters:
+			streams = stream_filter.filter(streams)
+
+		return streams
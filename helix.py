@@ -0,0 +1,369 @@
+"""
+The HTTP layer under every Twitch request: Helix API calls and app access
+token requests.
+
+A HelixSession keeps connections open between requests, up to max_idle per
+host, so a poll doesn't pay for a TCP and TLS handshake per page. Requests
+that fail with a 429 are retried once the rate limit bucket resets (from the
+Ratelimit-Reset header), and those that fail with a 5xx or a network error
+are retried with jittered exponential backoff. Each host has a
+CircuitBreaker that stops requests for a while after several failures in a
+row, so an outage isn't made worse by retries.
+
+Failures are raised as HelixError subclasses, so callers can tell a rate
+limit from an outage.
+
+Docs: https://dev.twitch.tv/docs/api/guide#twitch-rate-limits
+"""
+
+import http.client
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import config
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+HELIX_RETRIES = metrics.counter("twitchwatch_helix_retries_total",
+                                "Twitch requests retried, by reason",
+                                ["reason"])
+HELIX_CIRCUIT_OPEN = metrics.gauge("twitchwatch_helix_circuit_open",
+                                   "1 while requests to a host are stopped after repeated failures",
+                                   ["host"])
+
+
+
+class HelixError(Exception):
+	"""
+	A Twitch request failed. status is the HTTP status, if there was a
+	response.
+	"""
+	def __init__(self, message, status=None, headers=None):
+		super().__init__(message)
+		self.status = status
+		self.headers = headers or {}
+
+
+class HelixRequestError(HelixError):
+	"""
+	Twitch rejected the request, e.g., with a 400 or 409, so retrying won't
+	help
+	"""
+
+
+class HelixAuthError(HelixRequestError):
+	"""
+	Twitch rejected the access token (401)
+	"""
+
+
+class HelixRateLimitError(HelixError):
+	"""
+	The rate limit was used up (429). reset_at is when the bucket refills, in
+	seconds since the epoch, if Twitch said.
+	"""
+	def __init__(self, message, status=429, headers=None, reset_at=None):
+		super().__init__(message, status, headers)
+		self.reset_at = reset_at
+
+
+class HelixServerError(HelixError):
+	"""
+	Twitch kept failing with a 5xx
+	"""
+
+
+class HelixConnectionError(HelixError):
+	"""
+	Twitch couldn't be reached
+	"""
+
+
+class HelixUnavailableError(HelixError):
+	"""
+	The request wasn't made because the host's circuit breaker is open.
+	open_until is when requests will be tried again, in seconds since the
+	epoch.
+	"""
+	def __init__(self, message, open_until=None):
+		super().__init__(message)
+		self.open_until = open_until
+
+
+
+class CircuitBreaker(object):
+	"""
+	Opens after failure_threshold failures in a row, refusing requests for
+	cooldown seconds. The first request after that is let through, and
+	another failure opens it again straight away.
+
+	With state_file, the time the breaker is open until is kept in a file so
+	other processes, e.g., the next cron runs, don't try either.
+	"""
+	def __init__(self, name, failure_threshold=5, cooldown=60, state_file=None):
+		self.name = name
+		self.failure_threshold = failure_threshold
+		self.cooldown = cooldown
+		self.failures = 0
+		self.open_until = 0
+		self._state_file = state_file
+		self._lock = threading.Lock()
+
+		self._read_state_file()
+
+	def _read_state_file(self):
+		if self._state_file is None:
+			return
+
+		try:
+			with open(self._state_file) as f:
+				state = json.load(f)
+		except (OSError, ValueError):
+			return
+
+		if state.get("open_until", 0) > time.time():
+			self.open_until = state["open_until"]
+			self.failures = self.failure_threshold
+
+	def _write_state_file(self):
+		if self._state_file is None:
+			return
+
+		try:
+			config.write_json_atomic(self._state_file, {"open_until": self.open_until})
+		except OSError as e:
+			log.warning("Could not write {0}: {1}".format(self._state_file, e))
+
+	def allow(self):
+		return time.time() >= self.open_until
+
+	def record_success(self):
+		with self._lock:
+			was_open = self.open_until != 0
+			self.failures = 0
+			self.open_until = 0
+
+			if was_open:
+				log.info("{0} is answering again".format(self.name))
+				HELIX_CIRCUIT_OPEN.set(0, host=self.name)
+				self._write_state_file()
+
+	def record_failure(self):
+		with self._lock:
+			self.failures += 1
+
+			if self.failures < self.failure_threshold:
+				return
+
+			self.open_until = time.time() + self.cooldown
+			log.warning("{0} failed {1} times in a row, not trying again for {2} seconds".format(
+				self.name, self.failures, self.cooldown))
+			HELIX_CIRCUIT_OPEN.set(1, host=self.name)
+			self._write_state_file()
+
+
+
+class HelixSession(object):
+	"""
+	:param max_retries: Retries after the first attempt of a request
+	:param backoff: Longest wait, in seconds, before the first retry after a
+	                5xx or network error. It doubles for each retry, up to
+	                max_backoff, and the actual wait is picked at random up
+	                to it.
+	:param max_rate_limit_wait: Longest wait for the rate limit to reset
+	                            before giving up with a HelixRateLimitError
+	:param timeout: Socket timeout, in seconds
+	:param max_idle: Open connections kept per host
+	:param state_dir: Directory for the circuit breakers' state files, or
+	                  None to keep them in memory
+	"""
+	def __init__(self, max_retries=3, backoff=0.5, max_backoff=30, max_rate_limit_wait=60, timeout=30, max_idle=4,
+	             failure_threshold=5, cooldown=60, state_dir=None):
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.max_rate_limit_wait = max_rate_limit_wait
+		self.timeout = timeout
+		self.max_idle = max_idle
+		self.failure_threshold = failure_threshold
+		self.cooldown = cooldown
+		self.state_dir = state_dir
+		self._idle = {}
+		self._breakers = {}
+		self._lock = threading.Lock()
+
+	def breaker(self, host):
+		"""
+		Returns the CircuitBreaker for a host
+		"""
+		with self._lock:
+			if host not in self._breakers:
+				state_file = None
+
+				if self.state_dir is not None:
+					state_file = os.path.join(self.state_dir, "circuit-{0}.json".format(host.replace(":", "_")))
+
+				self._breakers[host] = CircuitBreaker(host, self.failure_threshold, self.cooldown, state_file)
+
+			return self._breakers[host]
+
+	def _get_connection(self, scheme, host):
+		"""
+		Returns an idle connection to the host and True, or a new one and
+		False
+		"""
+		with self._lock:
+			idle = self._idle.get((scheme, host))
+
+			if idle:
+				return idle.pop(), True
+
+		if scheme == "https":
+			return http.client.HTTPSConnection(host, timeout=self.timeout), False
+
+		return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+	def _put_connection(self, scheme, host, connection):
+		with self._lock:
+			idle = self._idle.setdefault((scheme, host), [])
+
+			if len(idle) < self.max_idle:
+				idle.append(connection)
+				return
+
+		connection.close()
+
+	def close(self):
+		with self._lock:
+			idle, self._idle = self._idle, {}
+
+		for connections in idle.values():
+			for connection in connections:
+				connection.close()
+
+	def _send(self, method, url, body, headers):
+		"""
+		Makes one request and returns (status, headers, body). A kept-alive
+		connection the server has since closed is replaced with a new one.
+		"""
+		url = urllib.parse.urlsplit(url)
+		path = url.path + ("?" + url.query if url.query else "")
+
+		while True:
+			connection, reused = self._get_connection(url.scheme, url.netloc)
+
+			try:
+				connection.request(method, path, body=body, headers=headers)
+				response = connection.getresponse()
+				data = response.read()
+			except (OSError, http.client.HTTPException):
+				connection.close()
+
+				if reused:
+					# The server timed out the idle connection
+					continue
+				raise
+
+			if response.will_close:
+				connection.close()
+			else:
+				self._put_connection(url.scheme, url.netloc, connection)
+
+			return response.status, response.headers, data
+
+	def _backoff(self, attempt, headers=None):
+		retry_after = (headers or {}).get("Retry-After")
+
+		if retry_after is not None:
+			try:
+				return min(float(retry_after), self.max_backoff)
+			except ValueError:
+				pass
+
+		return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+	def request(self, method, url, body=None, headers=None, on_response=None):
+		"""
+		Makes a request, retrying as needed, and returns the parsed JSON
+		response.
+
+		:param on_response: Called as on_response(status, headers, seconds)
+		                    after every attempt, with a status of "error" if
+		                    there was no response
+		:raises HelixError: A subclass for the kind of failure
+		"""
+		host = urllib.parse.urlsplit(url).netloc
+		breaker = self.breaker(host)
+		headers = dict(headers or {})
+		attempt = 0
+
+		while True:
+			if not breaker.allow():
+				raise HelixUnavailableError("Not trying {0} until {1}".format(
+					host, time.strftime("%H:%M:%S", time.localtime(breaker.open_until))), breaker.open_until)
+
+			started = time.perf_counter()
+
+			try:
+				status, response_headers, data = self._send(method, url, body, headers)
+			except (OSError, http.client.HTTPException) as e:
+				if on_response is not None:
+					on_response("error", None, time.perf_counter() - started)
+
+				breaker.record_failure()
+
+				if attempt >= self.max_retries:
+					raise HelixConnectionError("Could not reach {0}: {1}".format(host, e)) from e
+
+				wait = self._backoff(attempt)
+				log.info("Could not reach {0} ({1}), retrying in {2:.1f}s".format(host, e, wait))
+				HELIX_RETRIES.inc(reason="connection")
+			else:
+				if on_response is not None:
+					on_response(status, response_headers, time.perf_counter() - started)
+
+				if status < 400:
+					breaker.record_success()
+					return json.loads(data) if data else {}
+
+				message = "{0} {1} failed with {2}: {3}".format(method, url, status, data[:200].decode("utf-8", "replace"))
+
+				if status == 401:
+					raise HelixAuthError(message, status, response_headers)
+
+				if status == 429:
+					# Twitch is up, so this doesn't count against the breaker
+					reset_at = None
+					try:
+						reset_at = int(response_headers.get("Ratelimit-Reset"))
+					except (TypeError, ValueError):
+						pass
+
+					wait = self._backoff(attempt) if reset_at is None else max(reset_at - time.time(), 0) + random.uniform(0, 1)
+
+					if attempt >= self.max_retries or wait > self.max_rate_limit_wait:
+						raise HelixRateLimitError(message, status, response_headers, reset_at)
+
+					log.info("Rate limited by {0}, retrying in {1:.1f}s".format(host, wait))
+					HELIX_RETRIES.inc(reason="rate_limit")
+				elif status >= 500:
+					breaker.record_failure()
+
+					if attempt >= self.max_retries:
+						raise HelixServerError(message, status, response_headers)
+
+					wait = self._backoff(attempt, response_headers)
+					log.info("{0} answered {1}, retrying in {2:.1f}s".format(host, status, wait))
+					HELIX_RETRIES.inc(reason="server")
+				else:
+					raise HelixRequestError(message, status, response_headers)
+
+			attempt += 1
+			time.sleep(wait)
@@ -0,0 +1,242 @@
+"""
+Counters, gauges and histograms exposed in the Prometheus text format.
+
+Metrics are created once at module level, e.g.,
+
+	REQUESTS = metrics.counter("twitchwatch_requests_total", "Requests made", ["endpoint"])
+	REQUESTS.inc(endpoint="streams")
+
+and rendered with render(), served over HTTP by start_metrics_server().
+
+Docs: https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+# Histogram buckets in seconds, from 1ms to 1 minute
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+
+def _format_labels(label_names, label_values, extra=()):
+	labels = list(zip(label_names, label_values)) + list(extra)
+
+	if not labels:
+		return ""
+
+	return "{" + ",".join(
+		'{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+		for k, v
+		in labels
+	) + "}"
+
+
+def _format_value(value):
+	if value == float("inf"):
+		return "+Inf"
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value) if isinstance(value, float) else str(value)
+
+
+
+class Metric(object):
+	type = None
+
+	def __init__(self, name, help, label_names=()):
+		self.name = name
+		self.help = help
+		self.label_names = tuple(label_names)
+		self._lock = threading.Lock()
+		self._values = {}
+
+	def _key(self, labels):
+		if set(labels) != set(self.label_names):
+			raise ValueError("{0} takes the labels {1}".format(self.name, self.label_names))
+
+		return tuple(str(labels[name]) for name in self.label_names)
+
+	def render(self):
+		lines = [
+			"# HELP {0} {1}".format(self.name, self.help),
+			"# TYPE {0} {1}".format(self.name, self.type),
+		]
+
+		with self._lock:
+			for key, value in sorted(self._values.items()):
+				lines += self._render_value(key, value)
+
+		return lines
+
+	def _render_value(self, key, value):
+		return ["{0}{1} {2}".format(self.name, _format_labels(self.label_names, key), _format_value(value))]
+
+
+
+class Counter(Metric):
+	type = "counter"
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+
+
+class Gauge(Metric):
+	type = "gauge"
+
+	def set(self, value, **labels):
+		key = self._key(labels)
+
+		with self._lock:
+			self._values[key] = value
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+	def dec(self, amount=1, **labels):
+		self.inc(-amount, **labels)
+
+
+
+class Histogram(Metric):
+	type = "histogram"
+
+	def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+		super().__init__(name, help, label_names)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, **labels):
+		key = self._key(labels)
+
+		with self._lock:
+			counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[i] += 1
+
+			self._values[key] = (counts, total + value, count + 1)
+
+	@contextmanager
+	def time(self, **labels):
+		"""
+		Observes the time taken by the with block
+		"""
+		started = time.perf_counter()
+
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - started, **labels)
+
+	def _render_value(self, key, value):
+		counts, total, count = value
+		lines = []
+
+		for bound, bucket_count in zip(self.buckets, counts):
+			lines.append("{0}_bucket{1} {2}".format(self.name,
+			                                        _format_labels(self.label_names, key, [("le", _format_value(float(bound)))]),
+			                                        bucket_count))
+
+		lines.append("{0}_bucket{1} {2}".format(self.name, _format_labels(self.label_names, key, [("le", "+Inf")]), count))
+		lines.append("{0}_sum{1} {2}".format(self.name, _format_labels(self.label_names, key), _format_value(total)))
+		lines.append("{0}_count{1} {2}".format(self.name, _format_labels(self.label_names, key), count))
+
+		return lines
+
+
+
+class Registry(object):
+	def __init__(self):
+		self._metrics = {}
+		self._lock = threading.Lock()
+
+	def register(self, metric):
+		with self._lock:
+			# Modules may be imported more than once, e.g., as __main__
+			if metric.name in self._metrics:
+				return self._metrics[metric.name]
+
+			self._metrics[metric.name] = metric
+			return metric
+
+	def render(self):
+		with self._lock:
+			metrics = list(self._metrics.values())
+
+		lines = []
+		for metric in metrics:
+			lines += metric.render()
+
+		return "\n".join(lines) + "\n"
+
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, label_names=()):
+	return REGISTRY.register(Counter(name, help, label_names))
+
+
+def gauge(name, help, label_names=()):
+	return REGISTRY.register(Gauge(name, help, label_names))
+
+
+def histogram(name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+	return REGISTRY.register(Histogram(name, help, label_names, buckets))
+
+
+def render():
+	"""
+	Returns every metric in the Prometheus text format
+	"""
+	return REGISTRY.render()
+
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+	"""
+	Serves the metrics at http://host:port/metrics from a background thread
+	"""
+	# http.server is slow to import and most runs never serve metrics
+	from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+	class MetricsHandler(BaseHTTPRequestHandler):
+		def log_message(self, format, *args):
+			log.debug(format % args)
+
+		def do_GET(self):
+			if self.path not in ("/", "/metrics"):
+				self.send_error(404)
+				return
+
+			body = bytes(render(), "utf-8")
+
+			self.send_response(200)
+			self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+	server = ThreadingHTTPServer((host, port), MetricsHandler)
+	server.daemon_threads = True
+
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+
+	log.info("Serving metrics on http://{0}:{1}/metrics".format(host, server.server_address[1]))
+
+	return server
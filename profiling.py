@@ -0,0 +1,132 @@
+"""
+Per-phase wall and CPU time, and cProfile sessions, for the --profile flag.
+
+Code marks its phases with
+
+	with profiling.phase("stream_fetch"):
+		...
+
+which costs next to nothing until PROFILER.enabled is set. Phases can nest,
+e.g., auth happens inside game_lookup, and the outer phase's time includes
+the inner one's. CPU time is for the whole process, so in broadcaster.py it
+includes whatever else the event loop ran during a phase.
+"""
+
+import logging
+import os
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+
+
+class Profiler(object):
+	def __init__(self):
+		self.enabled = False
+		self._lock = threading.Lock()
+		# Phase name: [calls, wall seconds, CPU seconds]
+		self._phases = {}
+		self._cprofile = None
+
+	def record(self, name, wall, cpu):
+		with self._lock:
+			totals = self._phases.setdefault(name, [0, 0.0, 0.0])
+			totals[0] += 1
+			totals[1] += wall
+			totals[2] += cpu
+
+	@contextmanager
+	def phase(self, name):
+		"""
+		Records the wall and CPU time taken by the with block
+		"""
+		if not self.enabled:
+			yield
+			return
+
+		wall = time.perf_counter()
+		cpu = time.process_time()
+
+		try:
+			yield
+		finally:
+			self.record(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+	def report(self):
+		"""
+		Returns a table of the phases, slowest first
+		"""
+		with self._lock:
+			phases = sorted(self._phases.items(), key=lambda item: -item[1][1])
+
+		lines = ["{0:<24} {1:>8} {2:>12} {3:>12}".format("phase", "calls", "wall (ms)", "cpu (ms)")]
+
+		for name, (calls, wall, cpu) in phases:
+			lines.append("{0:<24} {1:>8} {2:>12.3f} {3:>12.3f}".format(name, calls, wall * 1000, cpu * 1000))
+
+		return "\n".join(lines)
+
+	@property
+	def sampling(self):
+		return self._cprofile is not None
+
+	def start_cprofile(self):
+		if self._cprofile is None:
+			import cProfile
+
+			self._cprofile = cProfile.Profile()
+			self._cprofile.enable()
+
+	def stop_cprofile(self, path):
+		"""
+		Stops the cProfile session and writes its stats to path, which can be
+		read with pstats, e.g., python3 -m pstats path
+		"""
+		if self._cprofile is None:
+			return
+
+		self._cprofile.disable()
+		self._cprofile.dump_stats(path)
+		self._cprofile = None
+
+	def toggle_cprofile(self, directory, name):
+		"""
+		Starts a cProfile session, or stops the running one and writes it to
+		<directory>/<name>-<pid>-<time>.pstats. Returns the path written.
+		"""
+		if not self.sampling:
+			log.warning("Profiling started")
+			self.start_cprofile()
+			return None
+
+		path = os.path.join(directory, "{0}-{1}-{2}.pstats".format(name, os.getpid(), int(time.time())))
+		self.stop_cprofile(path)
+
+		log.warning("Profile written to {0}\n{1}".format(path, self.report()))
+
+		return path
+
+
+
+PROFILER = Profiler()
+phase = PROFILER.phase
+
+
+def install_signal_handler(directory, name, loop=None, signum=signal.SIGUSR1):
+	"""
+	Makes signum (SIGUSR1 by default) start and stop a cProfile session in a
+	running process, e.g., kill -USR1 <pid>. Phase timing is turned on as
+	well. With loop the handler runs on the asyncio event loop.
+	"""
+	def handler(*args):
+		PROFILER.enabled = True
+		PROFILER.toggle_cprofile(directory, name)
+
+	if loop is not None:
+		loop.add_signal_handler(signum, handler)
+	else:
+		signal.signal(signum, handler)
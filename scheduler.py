@@ -0,0 +1,200 @@
+"""
+Per-game poll scheduling for the streams.py daemon.
+
+Each game has its own interval, which shrinks while new streams keep
+appearing and grows while nothing changes. A game's weight divides its
+interval, so a game with weight 4 is polled four times as often as one with
+weight 1. If polling every game that often would use more than a share of
+the Helix rate limit, every interval is stretched by the same factor, up to
+the longest interval. While the Helix bucket is below the part left for
+other requests, polls wait for it to refill.
+"""
+
+import logging
+import math
+import time
+
+
+log = logging.getLogger(__name__)
+
+# Streams returned per /streams request
+PAGE_SIZE = 100
+
+# The Helix rate limit for an app access token, until a response says otherwise
+DEFAULT_RATE_LIMIT = 800
+
+
+
+class GameSchedule(object):
+	__slots__ = ("game", "weight", "interval", "next_poll", "cost", "polls")
+
+	def __init__(self, game, weight, interval, next_poll):
+		self.game = game
+		self.weight = weight
+		self.interval = interval
+		self.next_poll = next_poll
+		# Requests a poll of this game is expected to take
+		self.cost = 1
+		self.polls = 0
+
+
+
+class PollScheduler(object):
+	"""
+	:param interval: Starting interval for every game, in seconds
+	:param min_interval: Shortest interval a game can have
+	:param max_interval: Longest interval a game backs off or is stretched
+	                     to, unless the Helix bucket refills later
+	:param weights: Dict of game name to priority weight, defaulting to 1
+	:param rate_limit: A client.RateLimit, for the observed budget
+	:param rate_limit_share: Fraction of the rate limit polling may use,
+	                         leaving the rest for other Helix calls
+	:param speedup: Interval multiplier after a poll finds new streams
+	:param backoff: Interval multiplier after a poll finds none
+	"""
+	def __init__(self, games, interval=900, min_interval=60, max_interval=3600, weights=None,
+	             rate_limit=None, rate_limit_share=0.5, speedup=0.5, backoff=1.5, now=0):
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.rate_limit = rate_limit
+		self.rate_limit_share = rate_limit_share
+		self.speedup = speedup
+		self.backoff = backoff
+		self._interval = interval
+		self._schedules = {}
+
+		self.update_games(games, weights, now)
+
+	def update_games(self, games, weights=None, now=0):
+		"""
+		Sets the games to poll, e.g., after the config is reloaded. Games
+		already being polled keep their intervals and new ones are due now.
+		"""
+		weights = weights or {}
+		schedules = {}
+
+		for game in games:
+			schedule = self._schedules.get(game)
+
+			if schedule is None:
+				schedule = GameSchedule(game, 1, self._interval, now)
+
+			schedule.weight = max(float(weights.get(game, 1)), 0.01)
+			schedules[game] = schedule
+
+		self._schedules = schedules
+
+	def _limit(self):
+		if self.rate_limit is not None and self.rate_limit.limit:
+			return self.rate_limit.limit
+
+		return DEFAULT_RATE_LIMIT
+
+	def budget(self):
+		"""
+		Returns the number of requests per second polling may make: a share
+		of the rate the Helix bucket refills at
+		"""
+		return self.rate_limit_share * self._limit() / 60
+
+	def refill_wait(self, wall_now=None):
+		"""
+		Returns the seconds until the Helix bucket refills if polling now
+		would use the part of it left for other requests, or else 0. The
+		last response's Ratelimit-Remaining is only trusted until its
+		Ratelimit-Reset, as the bucket is full again by then.
+
+		:param wall_now: The time in seconds since the epoch, like reset_at
+		"""
+		rate_limit = self.rate_limit
+
+		if rate_limit is None or rate_limit.remaining is None or rate_limit.reset_at is None:
+			return 0
+
+		if wall_now is None:
+			wall_now = time.time()
+
+		if wall_now >= rate_limit.reset_at:
+			return 0
+
+		if rate_limit.remaining >= (1 - self.rate_limit_share) * self._limit():
+			return 0
+
+		return rate_limit.reset_at - wall_now
+
+	def _target_interval(self, schedule):
+		return min(max(schedule.interval / schedule.weight, self.min_interval), self.max_interval)
+
+	def pressure(self):
+		"""
+		Returns how much every interval has to be stretched to keep the
+		expected request rate inside the budget, at least 1
+		"""
+		demand = sum(
+			schedule.cost / self._target_interval(schedule)
+			for schedule
+			in self._schedules.values()
+		)
+
+		return max(1.0, demand / self.budget())
+
+	def due(self, now):
+		"""
+		Returns the games due to be polled
+		"""
+		return [
+			schedule.game
+			for schedule
+			in self._schedules.values()
+			if schedule.next_poll <= now
+		]
+
+	def record(self, game, streams, new_streams, now):
+		"""
+		Adapts a game's interval after a poll that saw streams current
+		streams, new_streams of them new, and schedules its next poll
+		"""
+		schedule = self._schedules.get(game)
+
+		if schedule is None:
+			return
+
+		# This over-counts, as games polled together share requests
+		schedule.cost = max(1, math.ceil(streams / PAGE_SIZE))
+
+		# The first poll only fills the stream cache, so every stream is new
+		if schedule.polls > 0:
+			if new_streams:
+				schedule.interval = max(schedule.interval * self.speedup, self.min_interval)
+			else:
+				schedule.interval = min(schedule.interval * self.backoff, self.max_interval)
+
+		schedule.polls += 1
+		self._schedule(schedule, now)
+
+	def record_failure(self, game, now):
+		"""
+		Schedules the next poll of a game after a failed poll, without
+		adapting its interval
+		"""
+		schedule = self._schedules.get(game)
+
+		if schedule is not None:
+			self._schedule(schedule, now)
+
+	def _schedule(self, schedule, now):
+		pressure = self.pressure()
+		wait = min(self._target_interval(schedule) * pressure, self.max_interval)
+		schedule.next_poll = now + max(wait, self.refill_wait())
+
+		log.debug("{0}: next poll in {1:.0f}s (interval {2:.0f}s, weight {3}, pressure {4:.2f})".format(
+			schedule.game, schedule.next_poll - now, schedule.interval, schedule.weight, pressure))
+
+	def next_poll(self):
+		"""
+		Returns when the next game is due, or None if there are no games
+		"""
+		if not self._schedules:
+			return None
+
+		return min(schedule.next_poll for schedule in self._schedules.values())
@@ -1,94 +1,225 @@
-import asyncore
-import socket
+import asyncio
 import logging
 import json
 import os
 
-class ListenHandler(asyncore.dispatcher):
+import metrics
+
+
+class ListenHandler(object):
 	"""
 	Incoming data via the socket is passed off to this handler
 	"""
-	def __init__(self, sock):
-		self.logger = logging.getLogger("ListenHandler (%s)" % str(sock.getsockname()))
-		asyncore.dispatcher.__init__(self, sock=sock)
+	def __init__(self, reader, writer, server):
+		self.logger = logging.getLogger("ListenHandler (%s)" % str(writer.get_extra_info("sockname")))
+		self.reader = reader
+		self.writer = writer
+		# The ListenServer, whose broadcasters, checker and filter can change
+		# while the connection is open
+		self.server = server
+
+	async def handle(self):
+		"""
+		Each message is one line of JSON (NDJSON), so a client can keep the
+		connection open and send many messages. A message is either a list of
+		streams or an object:
+
+		  {"streams": [...], "id": 1}
+
+		If the object has an id, {"ack": id} is written back once the streams
+		have been queued for broadcast.
+
+		{"type": "stats"} asks for the metrics instead. The reply is one line:
+
+		  {"metrics": "<Prometheus text format>", "queues": {"IrcBroadcaster": {...}}}
+
+		{"type": "check", "games": [...], "id": 1} asks the server's checker
+		(a streams.StreamChecker) to fetch the current streams for the games
+		and broadcast the new ones. The reply is {"ack": 1, "new": 3}, or
+		{"ack": 1, "error": "..."} if the check failed.
+		"""
+		self.logger.debug("handle()")
+
+		try:
+			while True:
+				try:
+					line = await self.reader.readline()
+				except ValueError as e:
+					self.logger.error("Message too long, closing connection")
+					self.logger.exception(e)
+					break
+
+				if not line:
+					break
 
-	def handle_read(self):
+				await self.handle_message(line)
+		finally:
+			self.writer.close()
+
+	async def handle_message(self, line):
 		"""
 		When a stream notification is sent to the broadcast socket file
 		we read in the JSON data and pass the data onto each broadcaster
 		"""
-		self.logger.debug("handle_read()")
+		self.logger.debug(line)
+
+		# Data is received as bytes, convert to string
+		str_data = line.decode('utf-8').strip()
+
+		if not str_data:
+			return
+
+		try:
+			message = json.loads(str_data)
+		except Exception as e:
+			self.logger.exception(e)
+			self.logger.debug(str_data)
+			return
+
+		if isinstance(message, list):
+			message = {"streams": message}
+
+		if message.get("type") == "stats":
+			await self.send_stats()
+			return
+
+		if message.get("type") == "check":
+			await self.check(message.get("games", []), message.get("id"))
+			return
 
-		buffer = data = self.recv(4096)
+		streams = message.get("streams", [])
 
-		while data:
-			data = self.recv(4096)
-			buffer += data
+		if streams:
+			await self.broadcast(streams)
 
-		if buffer:
-			self.logger.debug(buffer)
+		if message.get("id") is not None:
+			await self.write_message({"ack": message["id"]})
 
-			# Data is received as bytes, convert to string
-			str_data = buffer.decode('utf-8')
+	async def write_message(self, message):
+		self.writer.write(bytes(json.dumps(message) + "\n", "utf-8"))
+		await self.writer.drain()
 
-			try:
-				streams = json.loads(str_data)
-			except Exception as e:
-				self.logger.exception(e)
-				self.logger.debug(str_data)
+	async def check(self, games, message_id):
+		if self.server.checker is None:
+			await self.write_message({"ack": message_id, "error": "Checks are not enabled"})
+			return
+
+		try:
+			# The check makes blocking HTTP requests
+			new_streams = await asyncio.to_thread(self.server.checker.check, games)
+		except Exception as e:
+			self.logger.exception(e)
+			new_streams = None
+
+		if new_streams is None:
+			await self.write_message({"ack": message_id, "error": "Could not fetch the current streams"})
+			return
+
+		if new_streams:
+			await self.broadcast(new_streams)
+
+		await self.write_message({"ack": message_id, "new": len(new_streams)})
+
+	async def send_stats(self):
+		reply = {
+			"metrics": metrics.render(),
+			"queues": {
+				broadcaster.name: broadcaster.stats()
+				for broadcaster
+				in self.server.broadcasters
+				if hasattr(broadcaster, "stats")
+			},
+		}
+
+		await self.write_message(reply)
+
+	async def broadcast(self, streams):
+		# Filter once here rather than in every broadcaster
+		if self.server.stream_filter is not None:
+			streams = self.server.stream_filter.filter(streams)
+
+			if not streams:
 				return
 
-			self.logger.info("Broadcasting")
+		self.logger.info("Broadcasting")
 
-			for broadcaster in self.broadcasters:
-				try:
-					broadcaster.broadcast(streams)
-				except Exception as e:
-					self.logger.exception(e)
+		# Broadcast to every broadcaster at once so a slow one doesn't
+		# hold up the others
+		results = await asyncio.gather(*[
+			broadcaster.broadcast(streams)
+			for broadcaster
+			in self.server.broadcasters
+		], return_exceptions=True)
 
+		for result in results:
+			if isinstance(result, Exception):
+				self.logger.exception(result)
 
-class ListenServer(asyncore.dispatcher):
+
+class ListenServer(object):
 	"""
 	This is the main broadcast listener that creates a UNIX socket to listen
 	for stream notifications (sent from streams.py)
 	"""
-	def __init__(self, socket_path, broadcasters):
+	# The largest message accepted, in bytes
+	MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+	def __init__(self, socket_path, broadcasters, backlog=128, checker=None, stream_filter=None):
+		"""
+		checker is a streams.StreamChecker for answering "check" messages
+
+		stream_filter is a filters.StreamFilter every stream has to match
+		before it is passed to the broadcasters
+		"""
 		self.logger = logging.getLogger("ListenServer")
 		self.logger.debug("__init__()")
 
-		asyncore.dispatcher.__init__(self)
-
 		# Store the list of broadcasters
 		self.broadcasters = broadcasters
+		self.checker = checker
+		self.stream_filter = stream_filter
+		self.socket_path = socket_path
+		self.backlog = backlog
+		self._server = None
 
 		self.logger.debug("broadcasters: {0}".format(broadcasters))
 
-		# Create a new socket file
-		self.logger.debug("Creating socket")
-		self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	async def start(self):
+		"""
+		Create the socket file and start listening for connections
+		"""
+		self.logger.debug("start()")
 
 		# Remove the socket file if it already exists
 		# Failure means there is possibly another broadcaster running
-		if os.path.exists(socket_path):
-			os.remove(socket_path)
+		if os.path.exists(self.socket_path):
+			os.remove(self.socket_path)
+
+		self.logger.debug("Binding to socket_path {0}".format(self.socket_path))
+		self._server = await asyncio.start_unix_server(self.handle_accept,
+		                                               path=self.socket_path,
+		                                               backlog=self.backlog,
+		                                               limit=self.MAX_MESSAGE_SIZE)
 
-		# Create the socket file and start listening for connections
-		self.logger.debug("Binding to socket_path {0}".format(socket_path))
-		self.bind(socket_path)
-		self.listen(1)
+	async def serve_forever(self):
+		await self._server.serve_forever()
 
-	def handle_accept(self):
+	async def handle_accept(self, reader, writer):
 		"""
 		Accept connections
 		"""
 		self.logger.debug("handle_accept()")
+		self.logger.info("Incoming connection from {0}".format(repr(writer.get_extra_info("peername"))))
 
-		client = self.accept()
+		try:
+			await ListenHandler(reader, writer, self).handle()
+		except Exception as e:
+			self.logger.exception(e)
 
-		self.logger.debug(client)
+	async def close(self):
+		if self._server is not None:
+			self._server.close()
+			await self._server.wait_closed()
 
-		if client is not None:
-			sock, addr = client
-			self.logger.info("Incoming connection from {0}".format(repr(addr)))
-			lh = ListenHandler(sock)
-			lh.broadcasters = self.broadcasters
+		if os.path.exists(self.socket_path):
+			os.unlink(self.socket_path)
@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from client import parse_timestamp
+
+
+log = logging.getLogger(__name__)
+
+
+
+class SqliteStreamCache(object):
+	"""
+	Stream cache stored in an SQLite database, indexed by (game, user_id).
+
+	It can be used in place of the dict returned by streams.read_stream_cache:
+	get(game) returns the cached streams for a game and assigning to
+	cache[game] only writes the streams that changed. Every write is its own
+	transaction, so a crash never leaves a truncated cache and processes
+	checking different games don't overwrite each other.
+
+	Only the fields needed to spot new streams are kept: user_id, id and
+	started_at, which is returned in seconds since the epoch.
+
+	The connection can be used from any thread, one at a time, e.g., by a
+	StreamChecker, which holds a lock around every use.
+	"""
+	SCHEMA = """
+		CREATE TABLE IF NOT EXISTS streams (
+			game TEXT NOT NULL,
+			user_id TEXT NOT NULL,
+			stream_id TEXT NOT NULL,
+			started_at INTEGER NOT NULL,
+			PRIMARY KEY (game, user_id)
+		) WITHOUT ROWID;
+
+		CREATE INDEX IF NOT EXISTS streams_user_id ON streams (user_id);
+		CREATE INDEX IF NOT EXISTS streams_started_at ON streams (started_at);
+
+		CREATE TABLE IF NOT EXISTS games (
+			game TEXT PRIMARY KEY,
+			polled_at INTEGER NOT NULL
+		);
+	"""
+
+	def __init__(self, path):
+		self.log = logging.getLogger("SqliteStreamCache")
+		self.log.debug("__init__('{0}')".format(path))
+
+		os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+		self.path = path
+		self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+		self._conn.execute("PRAGMA journal_mode=WAL")
+		self._conn.execute("PRAGMA synchronous=NORMAL")
+		self._conn.executescript(self.SCHEMA)
+
+	def close(self):
+		self._conn.close()
+
+	def is_empty(self):
+		return self._conn.execute("SELECT 1 FROM streams LIMIT 1").fetchone() is None
+
+	def get(self, game, default=None):
+		"""
+		Returns the cached streams for a game
+		"""
+		rows = self._conn.execute("SELECT user_id, stream_id, started_at FROM streams WHERE game = ?", (game,)).fetchall()
+
+		if not rows:
+			return default
+
+		return [
+			{
+				"user_id": user_id,
+				"id": stream_id,
+				"started_at": started_at,
+			}
+			for user_id, stream_id, started_at
+			in rows
+		]
+
+	def __setitem__(self, game, streams):
+		"""
+		Replaces the cached streams for a game, writing only the rows that
+		were added, removed or have a different stream id
+		"""
+		existing = dict(self._conn.execute("SELECT user_id, stream_id FROM streams WHERE game = ?", (game,)))
+		streams_by_user_id = {stream["user_id"]: stream for stream in streams}
+
+		removed = [
+			(game, user_id)
+			for user_id
+			in existing.keys() - streams_by_user_id.keys()
+		]
+		changed = [
+			(game, user_id, stream["id"], parse_timestamp(stream["started_at"]))
+			for user_id, stream
+			in streams_by_user_id.items()
+			if existing.get(user_id) != stream["id"]
+		]
+
+		self.log.debug("{0}: {1} changed, {2} removed".format(game, len(changed), len(removed)))
+
+		with self._conn:
+			self._conn.executemany("DELETE FROM streams WHERE game = ? AND user_id = ?", removed)
+			self._conn.executemany("INSERT OR REPLACE INTO streams VALUES (?, ?, ?, ?)", changed)
+			self._conn.execute("INSERT OR REPLACE INTO games VALUES (?, ?)", (game, int(time.time())))
+
+	def delete_expired(self, max_age):
+		"""
+		Deletes the streams for games that haven't been checked for max_age
+		hours and that started more than max_age hours ago. Streams for games
+		still being checked are expired when the game is updated.
+		"""
+		cutoff = int(time.time() - max_age * 3600)
+
+		with self._conn:
+			cursor = self._conn.execute("""
+				DELETE FROM streams
+				WHERE started_at < ?
+				AND game NOT IN (SELECT game FROM games WHERE polled_at >= ?)
+			""", (cutoff, cutoff))
+
+		if cursor.rowcount:
+			self.log.info("Deleted {0} expired streams".format(cursor.rowcount))
+
+	def import_json(self, cache_file):
+		"""
+		Imports a JSON stream cache written by streams.save_stream_cache
+		"""
+		self.log.info("Importing {0}".format(cache_file))
+
+		with open(cache_file) as f:
+			stream_cache = json.load(f)
+
+		for game, streams in stream_cache.items():
+			self[game] = streams
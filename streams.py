@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 
+import time
+# For --profile, the time spent importing everything below
+_import_started = (time.perf_counter(), time.process_time())
+
 import os
 import argparse
+import signal
 import socket
 import json
 import logging
-from datetime import datetime, timezone
+import sys
+import threading
 from xdg import XDG_CACHE_HOME
 
-from client import get_current_streams
+# client and storage are imported where they're used, so a --thin-client
+# run doesn't pay for http.client, ssl and sqlite3
 import config
+import metrics
+import profiling
 
 
 LOG_FORMAT = "%(asctime)s — %(name)s — %(levelname)s — %(message)s"
@@ -19,28 +28,24 @@ logging.basicConfig(
 )
 log = logging.getLogger()
 
+IMPORT_TIME = (time.perf_counter() - _import_started[0], time.process_time() - _import_started[1])
 
-
-def parse_date_string(s):
-	"""
-	Take a UTC datetime string and return a datetime object
-	"""
-	return datetime.strptime(s, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
-
-
-
-def stream_is_recent(stream, max_age):
-	"""
-	Returns True if stream is less than max_age hours
-	"""
-	now = datetime.now(timezone.utc)
-	stream_start_time = parse_date_string(stream['started_at'])
-	stream_age = now - stream_start_time
-
-	if stream_age.seconds / 3600 <= max_age:
-		return True
-
-	return False
+POLLS = metrics.counter("twitchwatch_polls_total",
+                        "Polls of the current streams by result",
+                        ["result"])
+POLL_SECONDS = metrics.histogram("twitchwatch_poll_seconds",
+                                 "Time taken by a whole poll, from fetching the streams to finding the new ones")
+STREAMS_SEEN = metrics.gauge("twitchwatch_streams_seen",
+                             "Streams seen for each game in the last poll",
+                             ["game"])
+NEW_STREAMS = metrics.histogram("twitchwatch_new_streams",
+                                "New streams found by each poll",
+                                buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000))
+CACHE_SECONDS = metrics.histogram("twitchwatch_cache_seconds",
+                                  "Time taken to load and save the stream cache",
+                                  ["operation"])
+SEND_ERRORS = metrics.counter("twitchwatch_send_errors_total",
+                              "Failures to send new streams to the broadcaster socket")
 
 
 
@@ -59,7 +64,7 @@ def read_stream_cache(cache_file):
 			f = open(cache_file, 'r')
 		except Exception as e:
 			log.exception(e)
-			return []
+			return {}
 
 		# Read the list of old streams from the file
 		try:
@@ -76,106 +81,720 @@ def read_stream_cache(cache_file):
 def save_stream_cache(cache_file, stream_cache):
 	log.debug("save_stream_cache('{0}', '{1}')".format(cache_file, stream_cache))
 
+	if cache_file == os.devnull:
+		return
+
+	# Written to a temporary file first so a crash can't truncate the cache
 	try:
-		f = open(cache_file, "w")
+		config.write_json_atomic(cache_file, stream_cache)
 	except Exception as e:
 		log.exception(e)
+
+
+
+class BroadcasterConnection(object):
+	"""
+	A connection to the broadcaster socket that is kept open between
+	messages. Each message is sent as one line of JSON.
+	"""
+	def __init__(self, socket_path, ack=False, timeout=10):
+		"""
+		With ack, wait for the broadcaster to confirm each message was queued
+		"""
+		self.socket_path = socket_path
+		self._ack = ack
+		self._timeout = timeout
+		self._sock = None
+		self._file = None
+		self._message_id = 0
+
+	def connect(self):
+		log.debug("Talking to socket file {0}".format(self.socket_path))
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.settimeout(self._timeout)
+
+		try:
+			sock.connect(self.socket_path)
+		except OSError:
+			sock.close()
+			raise
+
+		self._sock = sock
+		self._file = sock.makefile("rb")
+
+	def close(self):
+		if self._sock is not None:
+			self._file.close()
+			self._sock.close()
+			self._sock = None
+			self._file = None
+
+	def _write(self, message):
+		if self._sock is None:
+			self.connect()
+
+		self._sock.sendall(bytes(message + "\n", "utf-8"))
+
+	def _read_ack(self):
+		reply = self._file.readline()
+
+		if not reply:
+			raise ConnectionError("Connection closed before the message was acknowledged")
+
+		message = json.loads(reply)
+
+		if message.get("ack") != self._message_id:
+			raise ConnectionError("Unexpected reply {0}".format(reply))
+
+		return message
+
+	def check(self, games):
+		"""
+		Asks the broadcaster to check games itself and broadcast any new
+		streams, for --thin-client.
+
+		:return: The number of new streams
+		"""
+		if self._sock is None:
+			self.connect()
+
+		self._message_id += 1
+		message = json.dumps({"type": "check", "games": games, "id": self._message_id})
+		log.debug("Sending '%s'" % message)
+
+		self._sock.sendall(bytes(message + "\n", "utf-8"))
+		reply = self._read_ack()
+
+		if "error" in reply:
+			raise RuntimeError(reply["error"])
+
+		return reply.get("new", 0)
+
+	def send(self, streams):
+		"""
+		Sends a list of streams, reconnecting once if the connection was lost
+		before the message was written. Once it has been written the
+		broadcaster may have queued it, so a missing ack is an error rather
+		than a reason to send it again.
+		"""
+		message = {"streams": streams}
+
+		if self._ack:
+			self._message_id += 1
+			message["id"] = self._message_id
+
+		message = json.dumps(message)
+
+		# root: Sending '{"streams": [{"id": "36338956736", "user_id": "25590253", "user_name": "Rainoa92", "game_id": "118212", "type": "live", "title": "playing some random games with friends :3", "viewer_count": 4, "started_at": "2019-12-03T00:03:33Z", "language": "en", "thumbnail_url": "https://static-cdn.jtvnw.net/previews-ttv/live_user_rainoa92-{width}x{height}.jpg", "tag_ids": ["6ea6bca4-4712-4ab9-a906-e3336a9d8039"]}]}'
+		log.debug("Sending '%s'" % message)
+
+		try:
+			self._write(message)
+		except OSError:
+			log.info("Lost connection to {0}, reconnecting".format(self.socket_path))
+			self.close()
+			self._write(message)
+
+		if self._ack:
+			try:
+				self._read_ack()
+			except (OSError, ValueError):
+				# A late ack would be read as the reply to the next message
+				self.close()
+				raise
+
+
+
+def send_streams(cfg, streams, connection=None):
+	"""
+	Sends a list of new streams to the broadcaster socket, over connection
+	if given or else a new one
+	"""
+	# Are configured to use a socket file for broadcasting?
+	if "socket" not in cfg:
 		return
 
+	if connection is not None:
+		try:
+			connection.send(streams)
+		except Exception as e:
+			SEND_ERRORS.inc()
+			log.error("Could not send streams to socket file {0}".format(connection.socket_path))
+			log.exception(e)
+			connection.close()
+		return
+
+	connection = BroadcasterConnection(cfg["socket"])
+
 	try:
-		f.write(json.dumps(stream_cache))
+		connection.connect()
 	except Exception as e:
+		SEND_ERRORS.inc()
+		log.error("Could not connect to socket file {0}".format(cfg["socket"]))
+		log.exception(e)
+		return
+
+	try:
+		connection.send(streams)
+	except Exception as e:
+		SEND_ERRORS.inc()
 		log.exception(e)
 	finally:
-		f.close()
+		connection.close()
 
 
 
-def main(cfg):
-	game = cfg.get("game")
+def update_game(cfg, game, current_streams, stream_cache, trackers, now, partial=False):
+	"""
+	Diffs the current streams for a game against its StreamCache, creating
+	it from the stream cache if needed, and updates the stream cache.
 
-	# Stream IDs change each time the stream is started so we actually use the
-	# channel ID instead as this won't change
-	current_streams = get_current_streams(game)
+	:param partial: current_streams are only some of the game's streams
+	:return: Tuple of (new_streams, changed) where changed is True if the
+	         stream cache was updated
+	"""
+	from client import StreamCache
 
-	# Read in the previous list of streams
-	cache_dir = os.path.join(XDG_CACHE_HOME, "twitchwatch")
-	cache_file = os.path.join(cache_dir, "streams.json")
-	stream_cache = read_stream_cache(cache_file)
+	tracker = trackers.get(game)
+
+	if tracker is None:
+		tracker = StreamCache(game, cfg['max_age'], stream_cache.get(game, []))
+		trackers[game] = tracker
+
+	if not partial:
+		STREAMS_SEEN.set(len(current_streams), game=game)
+
+	new_streams = tracker.update(current_streams, now, partial=partial)
+	tracker.expire(now)
+
+	if cfg.get('no_cache', False) is False and tracker.changed:
+		stream_cache[game] = tracker.to_streams()
+		tracker.changed = False
+		return new_streams, True
+
+	return new_streams, False
+
+
+
+def poll_games(cfg, games, stream_cache, token_manager=None, trackers=None, activity=None):
+	"""
+	Fetches the current streams for all games in one batch and diffs them
+	against the in-memory stream cache, updating it.
+
+	:param trackers: Dict of game to StreamCache to keep between checks
+	:param activity: Dict filled with game: (streams, new streams) counts
+	:return: Tuple of (new_streams, changed) where changed is True if the
+	         stream cache was updated, or None if the request failed
+	"""
+	from client import get_current_streams_many
+	from helix import HelixError, HelixRateLimitError, HelixUnavailableError
+
+	if trackers is None:
+		trackers = {}
+
+	started = time.perf_counter()
+
+	try:
+		streams_by_game = get_current_streams_many(games,
+		                                           token_manager=token_manager,
+		                                           max_pages=cfg.get("max-pages"))
+	except HelixRateLimitError as e:
+		POLLS.inc(result="rate_limited")
+		log.error("Rate limited by Twitch: {0}".format(e))
+		return None
+	except HelixUnavailableError as e:
+		POLLS.inc(result="unavailable")
+		log.error("Twitch is failing, skipping this poll: {0}".format(e))
+		return None
+	except HelixError as e:
+		POLLS.inc(result="error")
+		log.error("Could not fetch the current streams: {0}".format(e))
+		return None
+
+	# Every game is compared against the same time
+	now = time.time()
 
-	previous_streams = []
 	new_streams = []
-	if current_streams:
-		previous_streams = stream_cache.get(game, [])
-		max_age = cfg['max_age']
-
-		if previous_streams:
-			# Get the list of channel ids for old streams
-			previous_streams_by_user_id = {
-				stream["user_id"]: stream
-				for stream
-				in previous_streams
-			}
-
-			# Iterate through the list of current streams
-			for stream in current_streams:
-				previous_stream = previous_streams_by_user_id.pop(stream['user_id'], None)
-
-				# Check if stream ID is different and it has
-				# been a while since the previous stream
-				if previous_stream is not None:
-					if previous_stream['id'] != stream['id']:
-						if not stream_is_recent(previous_stream, max_age):
-							new_streams.append(stream)
-
-			# discard any cached stream by someone currently streaming
-			previous_streams = [
-				stream
-				for stream
-				in previous_streams_by_user_id.values()
-			]
-		else:
-			new_streams = current_streams
+	changed = False
+	with profiling.phase("diff"):
+		for game, current_streams in streams_by_game.items():
+			game_new_streams, game_changed = update_game(cfg, game, current_streams, stream_cache, trackers, now)
+			new_streams += game_new_streams
+			changed = changed or game_changed
+
+			if activity is not None:
+				activity[game] = (len(current_streams), len(game_new_streams))
+
+	NEW_STREAMS.observe(len(new_streams))
+	POLLS.inc(result="ok")
+	POLL_SECONDS.observe(time.perf_counter() - started)
+
+	return new_streams, changed
+
+
+
+def check_games(cfg, games, stream_cache, token_manager=None, connection=None, trackers=None):
+	"""
+	Fetches the current streams for all games in one batch, broadcasts any
+	new ones and updates the in-memory stream cache.
+
+	:param trackers: Dict of game to StreamCache to keep between checks
+	:return: True if the stream cache was updated
+	"""
+	result = poll_games(cfg, games, stream_cache, token_manager=token_manager, trackers=trackers)
+
+	if result is None:
+		# The request failed, leave the cache as it is
+		return False
+
+	new_streams, changed = result
 
 	if new_streams:
-		# Are configured to use a socket file for broadcasting?
-		if "socket" in cfg:
-			try:
-				sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-				server_address = cfg["socket"]
+		with profiling.phase("socket_send"):
+			send_streams(cfg, new_streams, connection=connection)
 
-				try:
-					log.debug("Talking to socket file {0}".format(server_address))
-					sock.connect(server_address)
-				except Exception as e:
-					log.error("Could not connect to socket file {0}".format(server_address))
-					log.exception(e)
-					return
+	return changed
 
-				message = json.dumps(new_streams)
-				message_bytes = bytes(message, "utf-8")
 
-				# root: Sending '[{"id": "36338956736", "user_id": "25590253", "user_name": "Rainoa92", "game_id": "118212", "type": "live", "title": "playing some random games with friends :3", "viewer_count": 4, "started_at": "2019-12-03T00:03:33Z", "language": "en", "thumbnail_url": "https://static-cdn.jtvnw.net/previews-ttv/live_user_rainoa92-{width}x{height}.jpg", "tag_ids": ["6ea6bca4-4712-4ab9-a906-e3336a9d8039"]}]'
-				log.debug("Sending '%s'" % message)
 
-				sock.sendall(message_bytes)
+class StreamChecker(object):
+	"""
+	Keeps the app access token, stream cache and StreamCache trackers in
+	memory between checks, for long-running processes. The stream cache is
+	opened on the first check and saved whenever it changes. Checks are run
+	one at a time, so check() can be called from several threads.
+	"""
+	# Settings that need the stream cache reopened when they change
+	CACHE_SETTINGS = ("cache-backend", "cache-db", "cache-file", "cache_file", "max_age")
+
+	def __init__(self, cfg):
+		self.cfg = cfg
+		self.token_manager = None
+		self.stream_cache = None
+		self.trackers = {}
+		self._lock = threading.Lock()
+
+	def update_config(self, cfg):
+		"""
+		Uses a reloaded config from the next check on. The token manager is
+		looked up again and the stream cache is only reopened if its
+		settings changed.
+		"""
+		with self._lock:
+			if any(self.cfg.get(k) != cfg.get(k) for k in self.CACHE_SETTINGS):
+				if self.stream_cache is not None and not isinstance(self.stream_cache, dict):
+					self.stream_cache.close()
+
+				self.stream_cache = None
+				self.trackers = {}
+
+			self.cfg = cfg
+			self.token_manager = None
+
+	def check(self, games, activity=None):
+		"""
+		:param activity: Dict filled with game: (streams, new streams) counts
+		:return: List of new streams, or None if the request failed
+		"""
+		from client import get_token_manager
+
+		with self._lock:
+			if self.token_manager is None:
+				self.token_manager = get_token_manager(self.cfg)
+
+			if self.stream_cache is None:
+				self.stream_cache = open_stream_cache(self.cfg)
+
+			result = poll_games(self.cfg, games, self.stream_cache,
+			                    token_manager=self.token_manager,
+			                    trackers=self.trackers,
+			                    activity=activity)
+
+			if result is None:
+				return None
+
+			new_streams, changed = result
+
+			if changed:
+				save_cache(self.cfg, self.stream_cache)
+
+			return new_streams
+
+	def add_streams(self, streams):
+		"""
+		Records streams found without polling, e.g., from EventSub
+		stream.online events, so a poll doesn't announce them again.
+		Streams are kept with the configured game of the same name, if any.
+
+		:return: List of the streams that are new
+		"""
+		games = {game.lower(): game for game in daemon_games(self.cfg)}
+		by_game = {}
+
+		for stream in streams:
+			game = games.get(stream["game_name"].lower(), stream["game_name"])
+			by_game.setdefault(game, []).append(stream)
+
+		with self._lock:
+			if self.stream_cache is None:
+				self.stream_cache = open_stream_cache(self.cfg)
+
+			now = time.time()
+			new_streams = []
+			changed = False
+
+			for game, game_streams in by_game.items():
+				game_new_streams, game_changed = update_game(self.cfg, game, game_streams, self.stream_cache,
+				                                             self.trackers, now, partial=True)
+				new_streams += game_new_streams
+				changed = changed or game_changed
+
+			if changed:
+				save_cache(self.cfg, self.stream_cache)
+
+			return new_streams
+
+	def set_offline(self, user_id):
+		"""
+		Marks a user as no longer streaming, e.g., after an EventSub
+		stream.offline event, so their stream expires from every game it's
+		tracked under without waiting for a poll of that game
+		"""
+		with self._lock:
+			now = time.time()
+			changed = False
+
+			for game, tracker in self.trackers.items():
+				tracker.set_offline(user_id)
+				tracker.expire(now)
+
+				if self.cfg.get('no_cache', False) is False and tracker.changed:
+					self.stream_cache[game] = tracker.to_streams()
+					tracker.changed = False
+					changed = True
+
+			if changed:
+				save_cache(self.cfg, self.stream_cache)
+
+
+
+def get_cache_file(cfg):
+	cache_file = cfg.get("cache-file") or cfg.get("cache_file")
+
+	if cache_file:
+		return cache_file
+
+	cache_dir = os.path.join(XDG_CACHE_HOME, "twitchwatch")
+	return os.path.join(cache_dir, "streams.json")
+
+
+
+def open_stream_cache(cfg):
+	"""
+	Returns the stream cache: a dict read from the JSON cache file or, if
+	cache-backend is "sqlite", a SqliteStreamCache. A new SQLite cache
+	starts with the contents of the JSON cache file.
+	"""
+	with CACHE_SECONDS.time(operation="load"), profiling.phase("cache_load"):
+		return _open_stream_cache(cfg)
+
+
+
+def _open_stream_cache(cfg):
+	if cfg.get("cache-backend") == "sqlite":
+		from storage import SqliteStreamCache
+
+		stream_cache = SqliteStreamCache(cfg["cache-db"])
+
+		json_cache_file = get_cache_file(cfg)
+		if stream_cache.is_empty() and os.path.exists(json_cache_file):
+			try:
+				stream_cache.import_json(json_cache_file)
 			except Exception as e:
+				log.error("Could not import {0}".format(json_cache_file))
 				log.exception(e)
-			finally:
-				sock.close()
 
-	if cfg.get('no_cache', False) is False:
-		# save current streams
-		# save streams from users currently not streaming that have expired
+		return stream_cache
+
+	return read_stream_cache(get_cache_file(cfg))
+
+
+
+def save_cache(cfg, stream_cache):
+	"""
+	Saves the stream cache. The SQLite cache is written as it changes, so it
+	only needs expired streams removed.
+	"""
+	with CACHE_SECONDS.time(operation="save"), profiling.phase("cache_save"):
+		if isinstance(stream_cache, dict):
+			save_stream_cache(get_cache_file(cfg), stream_cache)
+		else:
+			stream_cache.delete_expired(cfg['max_age'])
+
+
+
+def main(cfg):
+	from client import get_token_manager
+
+	game = cfg.get("game")
+
+	# Read in the previous list of streams
+	stream_cache = open_stream_cache(cfg)
+
+	if check_games(cfg, [game], stream_cache, token_manager=get_token_manager(cfg)):
+		save_cache(cfg, stream_cache)
+
+
+
+def thin_client(cfg):
+	"""
+	Hands the check to the running broadcaster.py, which keeps the Twitch
+	login and stream cache in memory, so this process never has to import
+	the HTTP client. Checks the game here instead if the broadcaster can't
+	be reached.
+	"""
+	connection = BroadcasterConnection(cfg["socket"], timeout=cfg.get("thin-client-timeout", 60))
+
+	try:
+		with profiling.phase("socket_send"):
+			new_streams = connection.check([cfg.get("game")])
+	except socket.timeout:
+		# The broadcaster may still be checking, so checking here as well
+		# could announce the same streams twice
+		log.error("Timed out waiting for the broadcaster to check the game")
+		return
+	except (OSError, ValueError) as e:
+		log.warning("Could not reach the broadcaster at {0}, checking here".format(cfg["socket"]))
+		log.exception(e)
+		main(cfg)
+		return
+	except RuntimeError as e:
+		log.error("The broadcaster could not check the game: {0}".format(e))
+		return
+	finally:
+		connection.close()
+
+	log.info("{0} new streams".format(new_streams))
+
+
+
+def daemon_games(cfg):
+	games = cfg.get("games", [])
+	if cfg.get("game") and cfg["game"] not in games:
+		games = games + [cfg["game"]]
+
+	return games
+
+
+
+def make_scheduler(cfg, games, scheduler=None):
+	"""
+	Returns a PollScheduler for the games if adaptive-polling is on, reusing
+	scheduler if given, or else None
+	"""
+	if not cfg.get("adaptive-polling"):
+		return None
+
+	from client import RATE_LIMIT
+	from scheduler import PollScheduler
+
+	now = time.monotonic()
+
+	if scheduler is None:
+		scheduler = PollScheduler(games,
+		                          interval=int(cfg["poll-interval"]),
+		                          rate_limit=RATE_LIMIT,
+		                          now=now)
+
+	scheduler.update_games(games, cfg.get("game-weights"), now)
+	scheduler.min_interval = cfg.get("min-poll-interval", 60)
+	scheduler.max_interval = cfg.get("max-poll-interval", 3600)
+	scheduler.rate_limit_share = cfg.get("rate-limit-share", 0.5)
+
+	return scheduler
+
+
+
+# Settings that need the EventSub client restarted when they change
+EVENTSUB_SETTINGS = ("eventsub-channels", "eventsub-token", "eventsub-url", "client-id", "api-url", "auth-url")
+
 
-		# discard old streams and then add the current streams
-		stream_cache[game] = [
-			stream
-			for stream
-			in previous_streams
-			if stream_is_recent(stream, max_age)
-		] + current_streams
-		save_stream_cache(cache_file, stream_cache)
+def start_eventsub(cfg, checker):
+	"""
+	Starts an EventSub client in a background thread that announces the
+	channels in eventsub-channels as soon as they go live, through the
+	checker's stream cache so polls don't announce them again. Returns the
+	EventSubThread, or None if there are no channels.
+	"""
+	if not cfg.get("eventsub-channels"):
+		return None
+
+	if not cfg.get("eventsub-token"):
+		log.error("eventsub-channels needs an eventsub-token, a user access token")
+		return None
+
+	import asyncio
+	from client import get_token_manager
+	from eventsub import EVENTSUB_URL, EventSubClient, EventSubThread, stream_from_event
+
+	token_manager = get_token_manager(cfg)
+
+	def announce(event):
+		with profiling.phase("eventsub"):
+			stream = stream_from_event(token_manager, event)
+			new_streams = checker.add_streams([stream])
+
+		if new_streams:
+			with profiling.phase("socket_send"):
+				send_streams(cfg, new_streams)
+
+	async def on_online(event):
+		# Helix requests, the stream cache and the socket all block
+		await asyncio.to_thread(announce, event)
+
+	async def on_offline(event):
+		await asyncio.to_thread(checker.set_offline, event["broadcaster_user_id"])
+
+	client = EventSubClient(token_manager,
+	                        cfg["eventsub-token"],
+	                        cfg["eventsub-channels"],
+	                        on_online,
+	                        on_offline,
+	                        url=cfg.get("eventsub-url", EVENTSUB_URL))
+
+	log.info("Listening for {0} channels going live".format(len(cfg["eventsub-channels"])))
+
+	thread = EventSubThread(client)
+	thread.start()
+
+	return thread
+
+
+
+def run_daemon(cfg):
+	"""
+	Polls every game in the configured "games" list on a schedule, keeping
+	one app access token and the stream cache in memory between
+	checks. The cache file is only written when it changes.
+
+	With adaptive-polling each game is polled when a PollScheduler says it
+	is due, instead of every game every poll-interval seconds.
+
+	Channels in eventsub-channels are announced as soon as they go live,
+	using EventSub, as well.
+
+	The config is reloaded before a poll if the config file has changed or
+	after kill -HUP, so games can be added without a restart.
+	"""
+	games = daemon_games(cfg)
+
+	if not games and not cfg.get("eventsub-channels"):
+		log.error("No games to watch, add a \"games\" list to the config file")
+		return
+
+	interval = int(cfg["poll-interval"])
+	log.info("Watching {0} games every {1} seconds".format(len(games), interval))
+
+	if cfg.get("metrics-port"):
+		metrics.start_metrics_server(int(cfg["metrics-port"]), cfg.get("metrics-host", "127.0.0.1"))
+
+	import tempfile
+
+	# kill -USR1 starts and stops a cProfile session
+	profiling.install_signal_handler(cfg.get("profile-dir") or tempfile.gettempdir(), "twitchwatch-streams")
+
+	checker = StreamChecker(cfg)
+	scheduler = make_scheduler(cfg, games)
+	eventsub = start_eventsub(cfg, checker)
+
+	reload_requested = threading.Event()
+	signal.signal(signal.SIGHUP, lambda *args: reload_requested.set())
+
+	# Keep one connection to the broadcaster open for every poll
+	connection = None
+	if "socket" in cfg:
+		connection = BroadcasterConnection(cfg["socket"], ack=cfg.get("socket-ack", False))
+
+	# When the next poll of every game is due without adaptive-polling
+	next_poll = time.monotonic()
+
+	try:
+		while True:
+			if reload_requested.is_set() or config.config_changed():
+				reload_requested.clear()
+				log.info("Reloading the config")
+
+				old_cfg = cfg
+
+				try:
+					cfg = config.reload_config()
+				except Exception:
+					log.error("Could not reload the config, keeping the old one")
+				else:
+					checker.update_config(cfg)
+
+					if any(old_cfg.get(k) != cfg.get(k) for k in EVENTSUB_SETTINGS):
+						if eventsub is not None:
+							eventsub.stop()
+						eventsub = start_eventsub(cfg, checker)
+
+					games = daemon_games(cfg)
+					interval = int(cfg["poll-interval"])
+					scheduler = make_scheduler(cfg, games, scheduler)
+
+			started = time.monotonic()
+
+			if scheduler is not None:
+				due_games = scheduler.due(started)
+			elif started >= next_poll:
+				due_games = games
+				next_poll = started + interval
+			else:
+				due_games = []
+
+			if due_games:
+				activity = {}
+
+				try:
+					new_streams = checker.check(due_games, activity)
+				except Exception as e:
+					POLLS.inc(result="error")
+					log.error("Could not check streams")
+					log.exception(e)
+					new_streams = None
+
+				if scheduler is not None:
+					now = time.monotonic()
+
+					for game in due_games:
+						if new_streams is None:
+							scheduler.record_failure(game, now)
+						else:
+							scheduler.record(game, *activity.get(game, (0, 0)), now)
+
+				if new_streams:
+					with profiling.phase("socket_send"):
+						send_streams(cfg, new_streams, connection=connection)
+
+			# Wake up now and then to notice config changes, and straight
+			# away on kill -HUP, which wouldn't cut a time.sleep() short.
+			# Keep checking even if there are no games, e.g., with only
+			# eventsub-channels.
+			wait = cfg.get("config-check-interval", 10)
+			due = next_poll if scheduler is None else scheduler.next_poll()
+
+			if due is not None:
+				wait = min(due - time.monotonic(), wait)
+
+			reload_requested.wait(max(wait, 0))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if eventsub is not None:
+			eventsub.stop()
+
+		if connection is not None:
+			connection.close()
 
 
 if __name__ == "__main__":
@@ -199,9 +818,39 @@ if __name__ == "__main__":
 	                    default=False,
 	                    action="store_true",
 	                    help="Do not add the streams found to the cache")
+	parser.add_argument("--daemon",
+	                    default=False,
+	                    action="store_true",
+	                    help="Keep running and poll every game in the configured \"games\" list")
+	parser.add_argument("--interval",
+	                    type=int,
+	                    help="Number of seconds between polls in daemon mode. Default: 900")
+	parser.add_argument("--metrics-port",
+	                    type=int,
+	                    help="Serve Prometheus metrics on this local port in daemon mode. Default: off")
+	parser.add_argument("--thin-client",
+	                    default=None,
+	                    action="store_true",
+	                    help="Ask the running broadcaster.py to check the game, instead of checking it here. Falls back to checking it here if the broadcaster can't be reached")
+	parser.add_argument("--profile",
+	                    default=False,
+	                    action="store_true",
+	                    help="Print the wall and CPU time taken by each phase to stderr on exit")
+	parser.add_argument("--profile-output",
+	                    help="Profile the whole run with cProfile and write the stats to this file, for reading with pstats")
 
 	args = parser.parse_args()
 
+	profile = args.profile or args.profile_output is not None
+	profile_output = args.profile_output
+
+	if profile:
+		profiling.PROFILER.enabled = True
+		profiling.PROFILER.record("import", *IMPORT_TIME)
+
+	if profile_output:
+		profiling.PROFILER.start_cprofile()
+
 	log.setLevel({
 		'debug': logging.DEBUG,
 		'info': logging.INFO,
@@ -210,6 +859,19 @@ if __name__ == "__main__":
 		'critical': logging.CRITICAL,
 	}[args.log_level])
 
-	cfg = config.get_config(args)
+	with profiling.phase("config"):
+		cfg = config.get_config(args)
+
+	try:
+		if cfg.get("daemon"):
+			run_daemon(cfg)
+		elif cfg.get("thin-client"):
+			thin_client(cfg)
+		else:
+			main(cfg)
+	finally:
+		if profile_output:
+			profiling.PROFILER.stop_cprofile(profile_output)
 
-	main(cfg)
+		if profile:
+			sys.stderr.write(profiling.PROFILER.report() + "\n")
@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import RateLimit
+from scheduler import DEFAULT_RATE_LIMIT, PollScheduler
+
+
+
+def rate_limit(limit=800, remaining=800, reset_in=60):
+	rate_limit = RateLimit()
+	rate_limit.limit = limit
+	rate_limit.remaining = remaining
+	rate_limit.reset_at = time.time() + reset_in
+	return rate_limit
+
+
+
+class BudgetTest(unittest.TestCase):
+	def test_default_limit(self):
+		scheduler = PollScheduler(["Game"], rate_limit_share=0.5)
+		self.assertAlmostEqual(scheduler.budget(), 0.5 * DEFAULT_RATE_LIMIT / 60)
+
+	def test_observed_limit(self):
+		scheduler = PollScheduler(["Game"], rate_limit=rate_limit(limit=120), rate_limit_share=0.5)
+		self.assertAlmostEqual(scheduler.budget(), 1.0)
+
+	def test_drained_bucket_doesnt_shrink_budget(self):
+		scheduler = PollScheduler(["Game"], rate_limit=rate_limit(remaining=0), rate_limit_share=0.5)
+		self.assertAlmostEqual(scheduler.budget(), 0.5 * 800 / 60)
+
+	def test_refill_wait(self):
+		scheduler = PollScheduler(["Game"], rate_limit=rate_limit(remaining=0, reset_in=30), rate_limit_share=0.5)
+		self.assertAlmostEqual(scheduler.refill_wait(), 30, delta=1)
+
+	def test_refill_wait_after_reset(self):
+		scheduler = PollScheduler(["Game"], rate_limit=rate_limit(remaining=0, reset_in=-1))
+		self.assertEqual(scheduler.refill_wait(), 0)
+
+	def test_refill_wait_with_enough_left(self):
+		scheduler = PollScheduler(["Game"], rate_limit=rate_limit(remaining=500), rate_limit_share=0.5)
+		self.assertEqual(scheduler.refill_wait(), 0)
+
+
+
+class PressureTest(unittest.TestCase):
+	def test_within_budget(self):
+		scheduler = PollScheduler(["Game {0}".format(i) for i in range(10)], interval=900)
+		self.assertEqual(scheduler.pressure(), 1.0)
+
+	def test_over_budget(self):
+		# 2 requests per second allowed, 4 wanted
+		scheduler = PollScheduler(["Game {0}".format(i) for i in range(240)], interval=60, min_interval=60,
+		                          rate_limit=rate_limit(limit=240), rate_limit_share=0.5)
+		self.assertAlmostEqual(scheduler.pressure(), 2.0)
+
+	def test_drained_bucket(self):
+		scheduler = PollScheduler(["Game {0}".format(i) for i in range(50)], interval=900,
+		                          rate_limit=rate_limit(remaining=0))
+		self.assertEqual(scheduler.pressure(), 1.0)
+
+
+
+class RecordTest(unittest.TestCase):
+	def test_first_poll_keeps_interval(self):
+		scheduler = PollScheduler(["Game"], interval=900)
+		scheduler.record("Game", 10, 10, 0)
+		self.assertEqual(scheduler.next_poll(), 900)
+
+	def test_new_streams_speed_up(self):
+		scheduler = PollScheduler(["Game"], interval=900, speedup=0.5)
+		scheduler.record("Game", 10, 10, 0)
+		scheduler.record("Game", 10, 1, 900)
+		self.assertEqual(scheduler.next_poll(), 900 + 450)
+
+	def test_no_new_streams_back_off(self):
+		scheduler = PollScheduler(["Game"], interval=900, max_interval=1000, backoff=1.5)
+		scheduler.record("Game", 10, 10, 0)
+		scheduler.record("Game", 10, 0, 900)
+		self.assertEqual(scheduler.next_poll(), 900 + 1000)
+
+	def test_weight(self):
+		scheduler = PollScheduler(["Game"], interval=900, weights={"Game": 3})
+		scheduler.record("Game", 10, 10, 0)
+		self.assertEqual(scheduler.next_poll(), 300)
+
+	def test_stretch_is_bounded(self):
+		scheduler = PollScheduler(["Game {0}".format(i) for i in range(1000)], interval=3600, max_interval=3600,
+		                          rate_limit=rate_limit(limit=60), rate_limit_share=0.01)
+		self.assertGreater(scheduler.pressure(), 1)
+		scheduler.record("Game 0", 1000, 0, 0)
+		self.assertEqual(scheduler.next_poll(), 0)
+		self.assertEqual(scheduler._schedules["Game 0"].next_poll, 3600)
+
+	def test_drained_bucket_waits_for_reset(self):
+		games = ["Game {0}".format(i) for i in range(50)]
+		scheduler = PollScheduler(games, interval=900, rate_limit=rate_limit(remaining=0, reset_in=30))
+		scheduler.record("Game 0", 10, 0, 0)
+		self.assertEqual(scheduler._schedules["Game 0"].next_poll, 900)
+
+		scheduler = PollScheduler(games, interval=10, min_interval=10, rate_limit=rate_limit(remaining=0, reset_in=30))
+		scheduler.record("Game 0", 10, 0, 0)
+		self.assertAlmostEqual(scheduler._schedules["Game 0"].next_poll, 30, delta=1)
+
+	def test_unknown_game(self):
+		scheduler = PollScheduler(["Game"], interval=900)
+		scheduler.record("Other", 10, 10, 0)
+		self.assertEqual(scheduler.next_poll(), 0)
+
+
+
+if __name__ == "__main__":
+	unittest.main()